@@ -1,13 +1,19 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import Any, AsyncIterator, Awaitable, List, Optional, Dict, Union
 import uvicorn
+import asyncio
 from pathlib import Path
 import logging
+import json
 import os
+import time
 
+from core.admission import ModelOverloadedError, QueueTimeoutError
 from core.model_manager import ModelManager
+from core.model_worker import WorkerUnavailableError
 from core.knowledge_base import KnowledgeBase
 
 # 配置日志
@@ -34,7 +40,21 @@ app.add_middleware(
 
 # 初始化模型管理器和知识库
 model_manager = ModelManager()
-knowledge_base = KnowledgeBase()
+# 知识库的入库、检索与语义缓存都使用模型管理器中合批的嵌入引擎，嵌入模型只加载一次
+knowledge_base = KnowledgeBase(embed=model_manager.embed_texts)
+model_manager.attach_semantic_cache(knowledge_base.embed)
+
+@app.on_event("startup")
+async def preload_models():
+    """服务启动后在后台加载并预热配置的模型，不阻塞启动"""
+    model_manager.preload(model_manager.config.get('loading', {}).get('preload', []))
+
+@app.on_event("shutdown")
+async def close_backends():
+    """关闭Ollama连接池，断开与模型工作进程的连接（工作进程空闲一段时间后自行退出）"""
+    await model_manager.ollama.close()
+    for worker in model_manager.workers.values():
+        worker.close()
 
 class ChatRequest(BaseModel):
     prompt: str
@@ -43,6 +63,12 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     use_knowledge_base: Optional[bool] = False
+    priority: Optional[str] = None  # interactive / batch / background，默认使用租户的默认优先级
+
+class EmbeddingsRequest(BaseModel):
+    input: Union[str, List[str]]
+    model: Optional[str] = None
+    dtype: Optional[str] = None  # float32 / float16 / int8，默认使用embeddings.dtype
 
 class ChatResponse(BaseModel):
     response: str
@@ -50,37 +76,257 @@ class ChatResponse(BaseModel):
     knowledge_base_used: bool
     knowledge_base_results: Optional[List[Dict]] = None
 
+def _http_error(e: Exception) -> HTTPException:
+    """将模型调用异常转换为HTTP错误
+
+    请求参数错误（未知的模型、适配器或优先级，提示词超过max_length等ValueError）返回400，
+    排队已满返回429，排队超时或工作进程不可用返回503。
+    """
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, ValueError):
+        return HTTPException(status_code=400, detail=str(e))
+    if isinstance(e, ModelOverloadedError):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    if isinstance(e, QueueTimeoutError):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    if isinstance(e, WorkerUnavailableError):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return HTTPException(status_code=500, detail=str(e))
+
+async def _wait_for_disconnect(http_request: Request):
+    """等待HTTP客户端断开连接（请求体已读取完，之后只会收到http.disconnect）"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def _cancel_on_disconnect(http_request: Request, awaitable: Awaitable[Any]) -> Any:
+    """执行awaitable，客户端在完成前断开时取消它，使排队与生成立即停止"""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            # 等待取消传递到排队与生成循环
+            await asyncio.wait({task})
+    if task.cancelled():
+        logger.info("Client disconnected, generation cancelled")
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    return task.result()
+
+def _resolve_model(request: ChatRequest) -> str:
+    """获取请求使用的模型，未指定时使用默认模型"""
+    return request.model or model_manager.config['models']['default']
+
+async def _build_context(request: ChatRequest):
+    """启用知识库时检索相关文档，返回 (知识库上下文, 知识库结果)
+
+    上下文与问题分开传给模型管理器，由其构建完整提示词；带上下文的请求不使用语义缓存
+    （不同问题配上相同的检索结果时，整段提示词的嵌入几乎相同）。
+    检索要阻塞等待嵌入引擎计算查询向量（首次还要加载嵌入模型），在线程池中执行，
+    不阻塞事件循环，并发请求的查询在嵌入引擎中合批。
+    """
+    knowledge_base_results = None
+    context = None
+    if request.use_knowledge_base:
+        knowledge_base_results = await asyncio.get_running_loop().run_in_executor(
+            None, knowledge_base.search, request.prompt
+        )
+        if knowledge_base_results:
+            context = "\n".join([r["content"] for r in knowledge_base_results])
+    return context, knowledge_base_results
+
+async def _stream_chat(request: ChatRequest, tenant: str) -> AsyncIterator[Dict]:
+    """流式生成聊天回复，依次产出delta事件和最终的done事件"""
+    model_name = _resolve_model(request)
+    context, knowledge_base_results = await _build_context(request)
+    
+    start = time.monotonic()
+    first_token_at = None
+    chunks = []
+    # model为auto时记录级联路由实际选择的模型
+    usage = {}
+    async for delta in model_manager.generate_stream(
+        prompt=request.prompt,
+        model_name=model_name,
+        max_length=request.max_length,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        use_knowledge=context is not None,
+        knowledge_context=context,
+        tenant=tenant,
+        priority=request.priority,
+        usage=usage
+    ):
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        chunks.append(delta)
+        yield {"type": "delta", "content": delta}
+    
+    end = time.monotonic()
+    model_name = usage.get('model', model_name)
+    time_to_first_token = (first_token_at or end) - start
+    logger.info(
+        f"Streamed response from {model_name}: "
+        f"ttft={time_to_first_token * 1000:.1f}ms total={(end - start) * 1000:.1f}ms"
+    )
+    yield {
+        "type": "done",
+        "response": "".join(chunks),
+        "model": model_name,
+        "knowledge_base_used": request.use_knowledge_base,
+        "knowledge_base_results": knowledge_base_results,
+        "time_to_first_token_ms": round(time_to_first_token * 1000, 1)
+    }
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """处理聊天请求"""
-    try:
-        # 如果启用了知识库，先搜索相关文档
-        knowledge_base_results = None
-        if request.use_knowledge_base:
-            knowledge_base_results = knowledge_base.search(request.prompt)
-            if knowledge_base_results:
-                # 将知识库结果添加到提示中
-                context = "\n".join([r["content"] for r in knowledge_base_results])
-                request.prompt = f"Context:\n{context}\n\nQuestion:\n{request.prompt}"
+async def chat(
+    request: ChatRequest,
+    http_request: Request,
+    x_api_key: Optional[str] = Header(None)
+):
+    """处理聊天请求，按X-API-Key识别租户参与公平排队；客户端断开时取消生成"""
+    try:
+        model_name = _resolve_model(request)
+        context, knowledge_base_results = await _build_context(request)
         
-        # 生成回复
-        response = await model_manager.generate(
+        # 生成回复（model为auto时usage中记录级联路由实际选择的模型）
+        usage = {}
+        response = await _cancel_on_disconnect(http_request, model_manager.generate(
             prompt=request.prompt,
-            model_name=request.model,
+            model_name=model_name,
             max_length=request.max_length,
             temperature=request.temperature,
-            top_p=request.top_p
-        )
+            top_p=request.top_p,
+            use_knowledge=context is not None,
+            knowledge_context=context,
+            tenant=model_manager.resolve_tenant(x_api_key),
+            priority=request.priority,
+            usage=usage
+        ))
         
         return ChatResponse(
             response=response,
-            model=request.model or model_manager.config['model']['default'],
+            model=usage.get('model', model_name),
             knowledge_base_used=request.use_knowledge_base,
             knowledge_base_results=knowledge_base_results
         )
         
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
+        raise _http_error(e)
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, x_api_key: Optional[str] = Header(None)):
+    """以Server-Sent Events流式返回聊天回复
+
+    客户端断开时StreamingResponse会取消event_stream，取消随之传递到生成循环。
+    """
+    events = _stream_chat(request, model_manager.resolve_tenant(x_api_key))
+    # 先取第一个事件，使排队拒绝等错误能以HTTP状态码返回
+    try:
+        first_event = await events.__anext__()
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {str(e)}")
+        raise _http_error(e)
+    
+    async def event_stream():
+        try:
+            yield f"data: {json.dumps(first_event, ensure_ascii=False)}\n\n"
+            async for event in events:
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/chat")
+async def websocket_chat(websocket: WebSocket):
+    """WebSocket流式聊天，每条消息为一个ChatRequest
+
+    后台持续接收消息以便及时发现断开：生成过程中客户端断开时立即取消生成。
+    """
+    await websocket.accept()
+    tenant = model_manager.resolve_tenant(websocket.headers.get("x-api-key"))
+    messages: asyncio.Queue = asyncio.Queue()
+    
+    async def receive_messages():
+        try:
+            while True:
+                await messages.put(await websocket.receive_json())
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error(f"Error receiving chat websocket message: {str(e)}")
+        finally:
+            await messages.put(None)
+    
+    receiver = asyncio.ensure_future(receive_messages())
+    try:
+        while True:
+            data = await messages.get()
+            if data is None:
+                break
+            stream = asyncio.ensure_future(_send_chat_events(websocket, data, tenant))
+            await asyncio.wait({stream, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not stream.done():
+                stream.cancel()
+                logger.info("Chat websocket disconnected, generation cancelled")
+                break
+            if stream.exception() is not None:
+                raise stream.exception()
+    except WebSocketDisconnect:
+        logger.info("Chat websocket disconnected")
+    finally:
+        receiver.cancel()
+
+async def _send_chat_events(websocket: WebSocket, data: Dict, tenant: str):
+    """处理一条WebSocket聊天消息，逐个发送流式事件"""
+    try:
+        request = ChatRequest(**data)
+        async for event in _stream_chat(request, tenant):
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        logger.error(f"Error in chat websocket: {str(e)}")
+        await websocket.send_json({
+            "type": "error",
+            "error": str(e),
+            "status_code": _http_error(e).status_code
+        })
+
+@app.post("/embeddings")
+async def create_embeddings(request: EmbeddingsRequest):
+    """计算文本向量，并发请求在嵌入引擎中合批"""
+    try:
+        return await model_manager.embeddings(
+            input_texts=request.input,
+            model_id=request.model,
+            dtype=request.dtype
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error computing embeddings: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/embeddings/stats")
+async def get_embedding_stats():
+    """获取嵌入引擎的合批大小、补齐比例与吞吐（texts/sec）"""
+    try:
+        return model_manager.get_embedding_stats()
+    except Exception as e:
+        logger.error(f"Error getting embedding stats: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/models")
@@ -92,6 +338,98 @@ async def get_models():
         logger.error(f"Error getting models: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/models/stats")
+async def get_model_stats():
+    """获取各模型的排队深度、等待时间与调度统计（含各租户/优先级的等待分位数与已服务token数）"""
+    try:
+        return model_manager.get_stats()
+    except Exception as e:
+        logger.error(f"Error getting model stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/residency")
+async def get_model_residency():
+    """获取模型常驻状态、显存预算使用、命中率与加载/驱逐事件"""
+    try:
+        return model_manager.get_residency_stats()
+    except Exception as e:
+        logger.error(f"Error getting model residency: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/routing")
+async def get_model_routing():
+    """获取model为auto时级联路由的各模型开销、节省的开销与最近的路由决策"""
+    try:
+        return model_manager.get_routing_stats()
+    except Exception as e:
+        logger.error(f"Error getting routing stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/cache")
+async def get_response_cache_stats():
+    """获取生成结果缓存的命中率与占用"""
+    try:
+        return model_manager.get_response_cache_stats()
+    except Exception as e:
+        logger.error(f"Error getting response cache stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/cache/semantic/audit")
+async def get_semantic_cache_audit(limit: int = 100):
+    """获取语义缓存最近的命中/未命中/误命中记录"""
+    if model_manager.semantic_cache is None:
+        raise HTTPException(status_code=404, detail="Semantic cache is not enabled")
+    return model_manager.semantic_cache.get_audit(limit)
+
+@app.post("/models/cache/semantic/audit/{event_id}/false-hit")
+async def mark_semantic_false_hit(event_id: int):
+    """将一次语义缓存命中标记为误命中，并移除对应的缓存条目"""
+    if model_manager.semantic_cache is None:
+        raise HTTPException(status_code=404, detail="Semantic cache is not enabled")
+    if not model_manager.semantic_cache.mark_false_hit(event_id):
+        raise HTTPException(status_code=404, detail=f"Cache hit {event_id} not found")
+    return {"message": "Marked as false hit"}
+
+@app.get("/models/status")
+async def get_model_status():
+    """获取各模型的加载状态（cold/loading/warming/ready/failed）"""
+    try:
+        return model_manager.get_model_status()
+    except Exception as e:
+        logger.error(f"Error getting model status: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/models/{model_name}/load")
+async def load_model(model_name: str):
+    """在后台加载并预热模型，立即返回当前状态"""
+    status = model_manager.get_model_status()
+    if model_name not in status:
+        raise HTTPException(status_code=404, detail=f"Model {model_name} not found")
+    model_manager.preload([model_name])
+    return model_manager.get_model_status()[model_name]
+
+@app.post("/models/{model_name}/reload")
+async def reload_model(model_name: str, rolling: Optional[bool] = None):
+    """在后台热更新模型权重（蓝绿或滚动，rolling为空时自动选择），立即返回更新进度"""
+    if model_name not in model_manager.models:
+        raise HTTPException(status_code=404, detail=f"Model {model_name} not found")
+    try:
+        return await model_manager.start_reload(model_name, rolling)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except WorkerUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/models/{model_name}/reload")
+async def get_reload_status(model_name: str):
+    """获取模型最近一次热更新的进度（阶段、已替换的副本数、各副本加载耗时）"""
+    status = model_manager.get_reload_status(model_name)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No reload found for model {model_name}")
+    return status
+
 @app.post("/knowledge-base/upload")
 async def upload_document(
     file: UploadFile = File(...),
@@ -0,0 +1,359 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+
+class ModelOverloadedError(Exception):
+    """模型排队已满，请求被立即拒绝（对应HTTP 429）"""
+
+
+class QueueTimeoutError(Exception):
+    """请求排队超过最长等待时间（对应HTTP 503）"""
+
+
+DEFAULT_TENANT = "default"
+DEFAULT_PRIORITY_WEIGHTS = {'interactive': 8.0, 'batch': 2.0, 'background': 1.0}
+
+
+@dataclass
+class Ticket:
+    """一次准入请求：所属租户、优先级、预估token开销、预测输出长度与虚拟完成时间
+
+    served_tokens与output_tokens由生成过程填写实际处理（含提示词）与生成的token数，
+    释放名额时按实际开销结算。
+    """
+    tenant: str = DEFAULT_TENANT
+    priority: str = "interactive"
+    cost: float = 1.0
+    predicted_tokens: Optional[float] = None
+    finish_tag: float = 0.0
+    seq: int = 0
+    enqueued_at: float = 0.0
+    wait: float = 0.0
+    served_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    future: Optional[asyncio.Future] = field(default=None, compare=False, repr=False)
+
+    @property
+    def flow(self) -> Tuple[str, str]:
+        return self.tenant, self.priority
+
+
+class _FlowStats:
+    """单个租户或优先级的排队与服务统计"""
+
+    def __init__(self, window: int):
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.served_tokens = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=window)
+
+    def record_admit(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def to_dict(self) -> Dict:
+        waits = sorted(self.recent_waits)
+        return {
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'cancelled': self.cancelled,
+            'served_tokens': self.served_tokens,
+            'avg_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait': self.max_wait,
+            'p50_wait': _percentile(waits, 0.50),
+            'p99_wait': _percentile(waits, 0.99)
+        }
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class AdmissionQueue:
+    """单个模型的有界准入队列
+
+    同时执行的请求数不超过max_concurrency，其余请求排队；排队数达到
+    max_queue_depth时直接拒绝，排队超过max_queue_wait秒则超时。
+
+    排队请求按(租户, 优先级)分流，以token开销做加权公平排队（自计时公平排队，
+    SCFQ）：流开始排队时的虚拟开始时间为 max(系统虚拟时间, 该流上一个请求的完成
+    时间)，队首请求的虚拟完成时间为开始时间 + 开销 / 权重，名额空出时交给完成时间
+    最小的流。权重为优先级权重乘以租户权重，因此批量任务大量排队时交互请求仍按
+    权重比例获得名额。
+
+    设置aging_rate时，流内按预测输出长度短者优先（而不是到达顺序），排队每过一秒
+    预测长度折减aging_rate个token，长请求不会一直被插队。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 1,
+        max_queue_depth: int = 64,
+        max_queue_wait: Optional[float] = 30.0,
+        priority_weights: Optional[Dict[str, float]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        default_priority: str = "interactive",
+        aging_rate: Optional[float] = None,
+        stats_window: int = 1000
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self.priority_weights = dict(priority_weights or DEFAULT_PRIORITY_WEIGHTS)
+        self.tenant_weights = dict(tenant_weights or {})
+        if default_priority not in self.priority_weights:
+            raise ValueError(f"Unknown default priority: {default_priority}")
+        self.default_priority = default_priority
+        self.aging_rate = aging_rate
+        self.stats_window = stats_window
+        self.in_flight = 0
+        # 各流排队中的请求，以及排队中的流的虚拟开始时间
+        self._flows: Dict[Tuple[str, str], List[Ticket]] = {}
+        self._flow_start: Dict[Tuple[str, str], float] = {}
+        self._flow_finish: Dict[Tuple[str, str], float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+        self.stats: Dict[str, float] = {
+            'admitted': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'cancelled': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0
+        }
+        self._tenant_stats: Dict[str, _FlowStats] = {}
+        self._priority_stats: Dict[str, _FlowStats] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(
+            1 for waiters in self._flows.values() for waiter in waiters if not waiter.future.done()
+        )
+
+    def weight(self, tenant: str, priority: str) -> float:
+        return self.priority_weights[priority] * self.tenant_weights.get(tenant, 1.0)
+
+    async def acquire(
+        self,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+        predicted_tokens: Optional[float] = None
+    ) -> Ticket:
+        """获取一个执行名额，必要时排队等待
+
+        Args:
+            tenant: 租户（通常由API密钥确定），None表示默认租户
+            priority: 优先级（interactive/batch/background），None使用默认优先级
+            cost: 预估的token开销，用于公平排队
+            predicted_tokens: 预测的输出长度，用于流内短请求优先
+        """
+        ticket = self._make_ticket(tenant, priority, cost, predicted_tokens)
+        if self.in_flight < self.max_concurrency and not self.queue_depth:
+            self.in_flight += 1
+            self._flow_start[ticket.flow] = self._next_start(ticket.flow)
+            self._dispatch(ticket)
+            self._record_admit(ticket)
+            return ticket
+
+        if self.queue_depth >= self.max_queue_depth:
+            self.stats['rejected'] += 1
+            for flow in self._flow_stats(ticket):
+                flow.rejected += 1
+            raise ModelOverloadedError(
+                f"Model {self.name} is saturated ({self.queue_depth} requests queued)"
+            )
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        if not self._flows.get(ticket.flow):
+            self._flow_start[ticket.flow] = self._next_start(ticket.flow)
+        self._flows.setdefault(ticket.flow, []).append(ticket)
+        try:
+            await asyncio.wait_for(ticket.future, self.max_queue_wait)
+        except asyncio.TimeoutError:
+            self._abandon(ticket)
+            self.stats['timed_out'] += 1
+            for flow in self._flow_stats(ticket):
+                flow.timed_out += 1
+            raise QueueTimeoutError(
+                f"Request for model {self.name} waited more than {self.max_queue_wait}s in queue"
+            )
+        except asyncio.CancelledError:
+            self._abandon(ticket)
+            self._record_cancel(ticket)
+            raise
+        self._record_admit(ticket)
+        return ticket
+
+    def release(self, ticket: Optional[Ticket] = None):
+        """释放执行名额并按实际token数结算，再把名额移交给虚拟完成时间最小的排队请求"""
+        if ticket is not None:
+            self._settle(ticket)
+        waiter = self._select_next()
+        if waiter is None:
+            self.in_flight -= 1
+            return
+        self._dispatch(waiter)
+        waiter.future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+        predicted_tokens: Optional[float] = None
+    ) -> AsyncIterator[Ticket]:
+        """在执行名额内运行代码块，调用方取消（如客户端断开）时计入cancelled"""
+        ticket = await self.acquire(tenant, priority, cost, predicted_tokens)
+        try:
+            yield ticket
+        except (asyncio.CancelledError, GeneratorExit):
+            self._record_cancel(ticket)
+            raise
+        finally:
+            self.release(ticket)
+
+    def get_stats(self) -> Dict:
+        """获取排队统计信息，包括各租户与各优先级的等待时间和已服务token数"""
+        stats = dict(self.stats)
+        admitted = stats['admitted']
+        stats['avg_wait'] = stats['total_wait'] / admitted if admitted else 0.0
+        stats['queue_depth'] = self.queue_depth
+        stats['in_flight'] = self.in_flight
+        stats['max_concurrency'] = self.max_concurrency
+        stats['max_queue_depth'] = self.max_queue_depth
+        stats['tenants'] = {
+            tenant: flow.to_dict() for tenant, flow in self._tenant_stats.items()
+        }
+        stats['priorities'] = {
+            priority: flow.to_dict() for priority, flow in self._priority_stats.items()
+        }
+        return stats
+
+    def _make_ticket(
+        self,
+        tenant: Optional[str],
+        priority: Optional[str],
+        cost: float,
+        predicted_tokens: Optional[float]
+    ) -> Ticket:
+        tenant = tenant or DEFAULT_TENANT
+        priority = priority or self.default_priority
+        if priority not in self.priority_weights:
+            raise ValueError(
+                f"Unknown priority {priority}, expected one of {list(self.priority_weights)}"
+            )
+        return Ticket(
+            tenant=tenant,
+            priority=priority,
+            cost=max(float(cost), 1.0),
+            predicted_tokens=predicted_tokens,
+            seq=next(self._seq),
+            enqueued_at=time.monotonic()
+        )
+
+    def _next_start(self, flow: Tuple[str, str]) -> float:
+        """流开始排队时的虚拟开始时间"""
+        return max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+
+    def _order_key(self, ticket: Ticket, now: float):
+        """流内的出队顺序：启用长度感知时按老化后的预测长度，否则按到达顺序"""
+        if self.aging_rate is None or ticket.predicted_tokens is None:
+            return (0.0, ticket.seq)
+        aged = ticket.predicted_tokens - self.aging_rate * (now - ticket.enqueued_at)
+        return (aged, ticket.seq)
+
+    def _select_next(self) -> Optional[Ticket]:
+        """选出虚拟完成时间最小的流，并从中取出流内排在最前的请求"""
+        now = time.monotonic()
+        best, best_key = None, None
+        for flow in list(self._flows):
+            waiters = [waiter for waiter in self._flows[flow] if not waiter.future.done()]
+            if not waiters:
+                del self._flows[flow]
+                self._flow_start.pop(flow, None)
+                continue
+            self._flows[flow] = waiters
+            head = min(waiters, key=lambda waiter: self._order_key(waiter, now))
+            finish_tag = self._flow_start[flow] + head.cost / self.weight(*flow)
+            if best_key is None or (finish_tag, head.seq) < best_key:
+                best, best_key = head, (finish_tag, head.seq)
+        if best is not None:
+            self._flows[best.flow].remove(best)
+        return best
+
+    def _dispatch(self, ticket: Ticket):
+        """为即将执行的请求计算虚拟完成时间，推进系统虚拟时间与该流的开始时间"""
+        flow = ticket.flow
+        ticket.finish_tag = self._flow_start[flow] + ticket.cost / self.weight(*flow)
+        self._flow_finish[flow] = ticket.finish_tag
+        self._virtual_time = max(self._virtual_time, ticket.finish_tag)
+        if self._flows.get(flow):
+            self._flow_start[flow] = ticket.finish_tag
+        else:
+            self._flows.pop(flow, None)
+            self._flow_start.pop(flow, None)
+
+    def _settle(self, ticket: Ticket):
+        """按实际处理的token数修正该流的虚拟完成时间，并计入已服务token数"""
+        served = ticket.cost if ticket.served_tokens is None else ticket.served_tokens
+        self._refund(ticket, ticket.cost - served)
+        for flow in self._flow_stats(ticket):
+            flow.served_tokens += int(served)
+
+    def _refund(self, ticket: Ticket, tokens: float):
+        """从该流的虚拟完成时间中退回tokens的开销（为负时追加）"""
+        if ticket.flow in self._flow_finish:
+            self._flow_finish[ticket.flow] -= tokens / self.weight(ticket.tenant, ticket.priority)
+
+    def _abandon(self, ticket: Ticket):
+        """放弃排队；若名额已经移交给该请求则归还"""
+        if ticket.future.done() and not ticket.future.cancelled():
+            ticket.served_tokens = 0
+            self.release(ticket)
+            return
+        waiters = self._flows.get(ticket.flow, [])
+        if ticket in waiters:
+            waiters.remove(ticket)
+        if not waiters:
+            self._flows.pop(ticket.flow, None)
+            self._flow_start.pop(ticket.flow, None)
+
+    def _flow_stats(self, ticket: Ticket) -> Tuple[_FlowStats, _FlowStats]:
+        """获取（必要时创建）请求所属租户与优先级的统计"""
+        return (
+            self._tenant_stats.setdefault(ticket.tenant, _FlowStats(self.stats_window)),
+            self._priority_stats.setdefault(ticket.priority, _FlowStats(self.stats_window))
+        )
+
+    def _record_cancel(self, ticket: Ticket):
+        self.stats['cancelled'] += 1
+        for flow in self._flow_stats(ticket):
+            flow.cancelled += 1
+
+    def _record_admit(self, ticket: Ticket):
+        wait = time.monotonic() - ticket.enqueued_at
+        ticket.wait = wait
+        self.stats['admitted'] += 1
+        self.stats['total_wait'] += wait
+        self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        for flow in self._flow_stats(ticket):
+            flow.record_admit(wait)
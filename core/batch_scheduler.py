@@ -0,0 +1,1024 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import AsyncIterator, Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+import torch
+
+from core.kv_cache import KVCacheFullError, PagedKVCache
+from core.lora import LoRAManager
+from core.prefix_cache import PrefixCache
+from core.sampling import sample_next_tokens
+
+# 部分模型的KV缓存布局与HF默认的 [batch, heads, seq, dim] 不同
+# 取值为 (batch维, 序列维)
+_KV_LAYOUTS = {
+    'chatglm': (1, 0),
+    'qwen': (0, 1),
+}
+
+
+def _kv_layout(model) -> Tuple[int, int]:
+    """获取模型KV缓存的 (batch维, 序列维)"""
+    model_type = getattr(getattr(model, 'config', None), 'model_type', None)
+    return _KV_LAYOUTS.get(model_type, (0, 2))
+
+
+def _map_cache(cache, fn: Callable):
+    """对嵌套tuple形式的past_key_values中的每个张量应用fn"""
+    if isinstance(cache, torch.Tensor):
+        return fn(cache)
+    return type(cache)(_map_cache(item, fn) for item in cache)
+
+
+def _zip_cache(left, right, fn: Callable):
+    """逐张量合并两个结构相同的past_key_values"""
+    if isinstance(left, torch.Tensor):
+        return fn(left, right)
+    return type(left)(_zip_cache(a, b, fn) for a, b in zip(left, right))
+
+
+def _cat_caches(caches: List, dim: int):
+    """沿指定维度拼接多个结构相同的past_key_values"""
+    first = caches[0]
+    if isinstance(first, torch.Tensor):
+        return torch.cat(caches, dim=dim)
+    return type(first)(_cat_caches([cache[i] for cache in caches], dim) for i in range(len(first)))
+
+
+def _cache_nbytes(cache) -> int:
+    if isinstance(cache, torch.Tensor):
+        return cache.numel() * cache.element_size()
+    return sum(_cache_nbytes(item) for item in cache)
+
+
+def _pad_left(tensor: torch.Tensor, n: int, dim: int) -> torch.Tensor:
+    """在指定维度左侧补n个0"""
+    if n <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = n
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _set_future_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_future_exception(future: asyncio.Future, exc: BaseException):
+    if not future.done():
+        future.set_exception(exc)
+
+
+def _call_in_loop(loop: asyncio.AbstractEventLoop, fn: Callable, *args):
+    """从解码线程安全地回调到事件循环，事件循环已关闭时忽略"""
+    try:
+        loop.call_soon_threadsafe(fn, *args)
+    except RuntimeError:
+        pass
+
+
+class GenerationRequest:
+    """一个生成请求在调度器中的状态"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        loop: asyncio.AbstractEventLoop,
+        stream: bool = False,
+        adapter: Optional[str] = None
+    ):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+        # 流式请求逐个推送生成的token，结束时推送None
+        self.token_queue: Optional[asyncio.Queue] = asyncio.Queue() if stream else None
+        self.output_ids: List[int] = []
+        # 生成的各token在模型分布（未经温度与top_p调整）下的对数概率之和，用于估计回答的置信度
+        self.logprob_sum = 0.0
+        # 推测解码中草稿模型提出与被目标模型接受的token数，普通解码保持为0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.submitted_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 由事件循环线程设置，解码线程在下一个解码步检查（停止条件）
+        self.cancelled = False
+        # 使用的LoRA适配器，None表示基座模型；adapter_held表示已占用其常驻槽位
+        self.adapter = adapter
+        self.adapter_held = False
+        # 分块prefill：已处理的输入token数；连续模式下暂存已处理部分的KV，
+        # 分页模式下暂存命中的前缀块（写入第一块时转移给序列）
+        self.prefilled = 0
+        self.prefill_cache = None
+        self.prefill_blocks: List[int] = []
+
+    def cancel(self):
+        """取消请求（调用方已断开或不再需要结果），需在事件循环中调用"""
+        self.cancelled = True
+        if not self.future.done():
+            self.future.cancel()
+
+    @property
+    def position(self) -> int:
+        """下一个输入token的位置（即已写入KV缓存的token数）"""
+        return len(self.input_ids) + len(self.output_ids) - 1
+
+
+class BatchScheduler:
+    """transformers后端的连续批处理调度器
+
+    在后台线程中运行解码循环：每个解码步之间接纳新请求（先做prefill再并入批次），
+    并移除已完成的序列，使GPU始终以尽可能大的batch运行。
+    提供prefix_cache时，输入前缀已缓存的请求只对未命中的后缀做prefill。
+    被取消的请求在下一个解码步移出批次，尚未开始的请求直接从队列中丢弃。
+
+    提供kv_cache（分页KV缓存）时，各序列的KV存放在定长块中而不是批次的连续张量里：
+    空闲块足够时才接纳新请求；解码中块不足时抢占最晚加入的序列，换出到主机内存
+    （主机交换空间不足时丢弃KV、恢复时重新prefill），之后优先于新请求恢复。
+    前缀缓存的块与序列共享，不再复制。
+
+    提供lora时，请求可以指定LoRA适配器，使用不同适配器的序列在同一批次中解码；
+    适配器在接纳时换入，常驻槽位都被占用时请求留在等待队列中。
+
+    设置prefill_chunk_size时，需要prefill的部分超过该长度的输入按块prefill：
+    每个循环只处理一块，与其他序列的解码步交替进行，限制单次前向的激活内存，
+    也避免长输入的prefill长时间阻塞正在解码的序列；短输入的批量prefill同样
+    按该token数拆分。
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        eos_token_id: Optional[Union[int, Iterable[int]]] = None,
+        pad_token_id: int = 0,
+        name: str = "model",
+        prefix_cache: Optional[PrefixCache] = None,
+        num_threads: Optional[int] = None,
+        kv_cache: Optional[PagedKVCache] = None,
+        lora: Optional[LoRAManager] = None,
+        prefill_chunk_size: Optional[int] = None
+    ):
+        """
+        Args:
+            prefill_chunk_size: 单次prefill前向的最大token数，None或0表示不分块
+        """
+        if prefill_chunk_size is not None and prefill_chunk_size < 0:
+            raise ValueError("prefill_chunk_size must not be negative")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        if eos_token_id is None:
+            self.eos_token_ids = set()
+        elif isinstance(eos_token_id, int):
+            self.eos_token_ids = {eos_token_id}
+        else:
+            self.eos_token_ids = set(eos_token_id)
+        self.pad_token_id = pad_token_id
+        self.name = name
+        self.prefix_cache = prefix_cache
+        # CPU推理时解码线程使用的intra-op线程数（只影响本调度线程）
+        self.num_threads = num_threads
+        self.batch_dim, self.seq_dim = _kv_layout(model)
+        self.lora = lora
+        self.prefill_chunk_size = prefill_chunk_size or None
+        if lora is not None:
+            lora.batch_dim = self.batch_dim
+        self.kv_cache = kv_cache
+        if kv_cache is not None:
+            kv_cache.batch_dim, kv_cache.seq_dim = self.batch_dim, self.seq_dim
+            if prefix_cache is not None:
+                if prefix_cache.block_size != kv_cache.block_size:
+                    raise ValueError("prefix_cache and kv_cache must use the same block_size")
+                # 前缀缓存的值是共享的KV块，淘汰时释放引用；块不足时先回收前缀缓存
+                prefix_cache.on_evict = kv_cache.release
+                kv_cache.reclaim = prefix_cache.evict_lru
+
+        self._pending: queue.Queue = queue.Queue()
+        # 因KV块不足暂缓接纳或被抢占的请求，优先于新请求接纳
+        self._deferred: Deque[GenerationRequest] = deque()
+        # 正在分块prefill的请求，按接纳顺序逐块处理
+        self._prefilling: Deque[GenerationRequest] = deque()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+        # 当前批次状态
+        self._active: List[GenerationRequest] = []
+        self._cache = None
+        self._attention_mask: Optional[torch.Tensor] = None
+
+        self.stats: Dict[str, int] = {
+            'requests': 0,
+            'completed': 0,
+            'failed': 0,
+            'prefill_tokens': 0,
+            'generated_tokens': 0,
+            'decode_steps': 0,
+            'batched_sequences': 0,
+            'cancelled': 0,
+            # 被取消的请求已生成（被浪费）的token数，与因提前停止而省下的token数
+            'cancelled_tokens': 0,
+            'saved_tokens': 0,
+            # 分页KV缓存：抢占次数、其中换出到主机内存的次数、重新prefill的token数
+            'preemptions': 0,
+            'swapped': 0,
+            'recomputed_tokens': 0,
+            # 分块prefill的前向次数
+            'prefill_chunks': 0
+        }
+
+    def start(self):
+        """启动后台解码线程"""
+        if self._running:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError(f"Scheduler for {self.name} is still stopping")
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._serve,
+            name=f"batch-scheduler-{self.name}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """停止解码线程，未完成的请求以异常结束
+
+        批次状态只由解码线程修改，未完成的请求在解码线程退出时结束；超时后线程仍在执行
+        当前的前向计算时不等待，由它在该步完成后自行结束请求。
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._pending.put(None)
+        if self._thread is None:
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning(
+                f"Scheduler for {self.name} did not stop within {timeout}s, "
+                "pending requests will fail when the current step finishes"
+            )
+        else:
+            self._thread = None
+
+    def _serve(self):
+        """解码线程入口：运行解码主循环，退出时结束所有未完成的请求"""
+        try:
+            self._run()
+        finally:
+            self._fail_remaining()
+
+    def _fail_remaining(self):
+        """以异常结束批次中、prefill中、延后与排队中的请求，在解码线程退出时调用"""
+        error = RuntimeError(f"Scheduler for {self.name} stopped")
+        self._fail(self._active, error)
+        self._reset_batch()
+        self._fail(list(self._prefilling), error)
+        self._prefilling.clear()
+        self._fail(list(self._deferred), error)
+        self._deferred.clear()
+        while True:
+            try:
+                request = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                self._fail([request], error)
+
+    def submit(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        stream: bool = False,
+        adapter: Optional[str] = None
+    ) -> GenerationRequest:
+        """提交生成请求，需在事件循环中调用；结果通过request.future返回"""
+        if not self._running:
+            raise RuntimeError(f"Scheduler for {self.name} is not running")
+        if not input_ids:
+            raise ValueError("input_ids must not be empty")
+        if adapter is not None and (self.lora is None or adapter not in self.lora):
+            raise ValueError(f"LoRA adapter {adapter} not found for {self.name}")
+
+        request = GenerationRequest(
+            input_ids,
+            max_new_tokens,
+            temperature,
+            top_p,
+            asyncio.get_running_loop(),
+            stream=stream,
+            adapter=adapter
+        )
+        self.stats['requests'] += 1
+        if max_new_tokens <= 0:
+            request.future.set_result([])
+            if request.token_queue is not None:
+                request.token_queue.put_nowait(None)
+            return request
+
+        self._pending.put(request)
+        return request
+
+    async def generate(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        adapter: Optional[str] = None,
+        usage: Optional[dict] = None
+    ) -> List[int]:
+        """提交请求并等待生成的token id（不含输入）
+
+        Args:
+            usage: 若提供，写入生成token的平均对数概率（mean_logprob），
+                推测解码时另写入草稿token数（draft_tokens）与被接受的token数（accepted_tokens）
+        """
+        request = self.submit(input_ids, max_new_tokens, temperature, top_p, adapter=adapter)
+        try:
+            output_ids = await request.future
+        except asyncio.CancelledError:
+            request.cancel()
+            raise
+        if usage is not None and output_ids:
+            usage['mean_logprob'] = request.logprob_sum / len(output_ids)
+        if usage is not None and request.draft_tokens:
+            usage['draft_tokens'] = request.draft_tokens
+            usage['accepted_tokens'] = request.accepted_tokens
+        return output_ids
+
+    async def stream(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        adapter: Optional[str] = None
+    ) -> AsyncIterator[int]:
+        """提交请求并逐个产出生成的token id
+
+        调用方提前结束迭代时，请求会被取消并在下一个解码步移出批次。
+        """
+        request = self.submit(input_ids, max_new_tokens, temperature, top_p, stream=True, adapter=adapter)
+        try:
+            while True:
+                token = await request.token_queue.get()
+                if token is None:
+                    break
+                yield token
+            # 传播调度器中的异常
+            await request.future
+        finally:
+            if not request.future.done():
+                request.cancel()
+
+    def get_stats(self) -> Dict:
+        """获取调度统计信息"""
+        stats = dict(self.stats)
+        steps = stats['decode_steps']
+        stats['avg_batch_size'] = stats['batched_sequences'] / steps if steps else 0.0
+        stats['active'] = len(self._active)
+        stats['pending'] = self._pending.qsize()
+        stats['deferred'] = len(self._deferred)
+        stats['prefilling'] = len(self._prefilling)
+        if self.prefix_cache is not None:
+            stats['prefix_cache'] = self.prefix_cache.get_stats()
+        if self.lora is not None:
+            stats['lora'] = self.lora.get_stats()
+        if self.kv_cache is not None:
+            stats['kv_cache'] = self.kv_cache.get_stats()
+        return stats
+
+    def _run(self):
+        """解码主循环"""
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        while self._running:
+            new_requests = self._collect_new_requests()
+            try:
+                with torch.inference_mode():
+                    if new_requests:
+                        self._prefill(new_requests)
+                        new_requests = []
+                    if self._prefilling:
+                        self._prefill_chunk()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                logging.error(f"Error in batch scheduler for {self.name}: {str(e)}")
+                failed = dict.fromkeys(new_requests + self._active + list(self._prefilling))
+                self._fail([r for r in failed if r not in self._deferred], e)
+                self._prefilling.clear()
+                self._reset_batch()
+
+    def _collect_new_requests(self) -> List[GenerationRequest]:
+        """收集可以接纳进当前批次的新请求
+
+        批次为空时阻塞等待第一个请求，并在max_wait窗口内尽量凑批；
+        批次运行中则只取已到达的请求，不拖慢解码。
+        """
+        capacity = self.max_batch_size - len(self._active) - len(self._prefilling)
+        if capacity <= 0:
+            return []
+
+        requests: List[GenerationRequest] = []
+        while self._deferred and len(requests) < capacity:
+            requests.append(self._deferred.popleft())
+        if not self._active and not self._prefilling and not requests:
+            try:
+                first = self._pending.get(timeout=0.1)
+            except queue.Empty:
+                return []
+            if first is None:
+                return []
+            requests.append(first)
+            deadline = time.monotonic() + self.max_wait
+            while len(requests) < capacity:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                requests.append(item)
+        else:
+            while len(requests) < capacity:
+                try:
+                    item = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    requests.append(item)
+
+        # 丢弃已被调用方取消的请求，不再做prefill
+        for request in requests:
+            if request.cancelled or request.future.done():
+                self._retire_cancelled(request)
+        return [r for r in requests if not (r.cancelled or r.future.done())]
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        """对新请求做prefill，采样首个token后并入当前批次
+
+        前缀命中缓存的请求逐个只对后缀做prefill，其余请求批量prefill；
+        需要prefill的部分超过prefill_chunk_size的请求转入分块prefill。
+        """
+        if self.lora is not None:
+            requests = self._acquire_adapters(requests)
+        if self.kv_cache is not None:
+            requests = self._admit_paged(requests)
+        uncached = []
+        for request in requests:
+            blocks = []
+            if self.prefix_cache is not None:
+                # 至少保留最后一个token做prefill以得到下一个token的logits
+                blocks = self.prefix_cache.match(
+                    request.input_ids, max_tokens=len(request.input_ids) - 1,
+                    namespace=request.adapter
+                )
+                if self.kv_cache is not None:
+                    # 持有命中块的引用，避免为本请求分配块时被回收
+                    blocks = [self.kv_cache.retain(block) for block in blocks]
+            prefix_len = len(blocks) * self.prefix_cache.block_size if blocks else 0
+            if self.prefill_chunk_size and len(request.input_ids) - prefix_len > self.prefill_chunk_size:
+                request.prefilled = prefix_len
+                if self.kv_cache is not None:
+                    request.prefill_blocks = blocks
+                elif blocks:
+                    request.prefill_cache = _cat_caches(blocks, self.seq_dim)
+                self._prefilling.append(request)
+            elif blocks:
+                self._prefill_cached(request, blocks)
+            else:
+                uncached.append(request)
+        for group in self._prefill_groups(uncached):
+            self._prefill_batch(group)
+
+    def _prefill_groups(self, requests: List[GenerationRequest]) -> List[List[GenerationRequest]]:
+        """按prefill_chunk_size拆分批量prefill，使每次前向的token数（含padding）不超过该值"""
+        if not requests or not self.prefill_chunk_size:
+            return [requests] if requests else []
+        groups: List[List[GenerationRequest]] = []
+        group: List[GenerationRequest] = []
+        width = 0
+        for request in requests:
+            new_width = max(width, len(request.input_ids))
+            if group and new_width * (len(group) + 1) > self.prefill_chunk_size:
+                groups.append(group)
+                group, new_width = [], len(request.input_ids)
+            group.append(request)
+            width = new_width
+        groups.append(group)
+        return groups
+
+    def _prefill_chunk(self):
+        """对分块prefill队列中的第一个请求处理一块输入
+
+        最后一块完成后采样首个token，并入当前批次。分页模式下每块的KV随即写入块中，
+        块不足时等待解码中的序列释放，批次为空仍放不下时以KVCacheFullError结束。
+        """
+        request = self._prefilling[0]
+        if request.cancelled or request.future.done():
+            self._prefilling.popleft()
+            self._retire_cancelled(request)
+            return
+        device = self.model.device
+        start = request.prefilled
+        length = len(request.input_ids)
+        end = min(start + self.prefill_chunk_size, length)
+
+        if self.kv_cache is not None:
+            if request in self.kv_cache:
+                needed = self.kv_cache.blocks_needed([request], end - start)
+            else:
+                needed = self.kv_cache.blocks_for(end) - len(request.prefill_blocks)
+            if not self.kv_cache.can_allocate(needed):
+                if not self._active:
+                    self._prefilling.popleft()
+                    self._fail([request], KVCacheFullError(
+                        f"Sequence of {length} tokens does not fit in the KV cache of {self.name}"
+                    ))
+                return
+            if request in self.kv_cache:
+                past_key_values = self.kv_cache.gather([request])[0]
+            elif request.prefill_blocks:
+                past_key_values = self.kv_cache.gather_blocks(request.prefill_blocks)
+            else:
+                past_key_values = None
+        else:
+            past_key_values = request.prefill_cache
+
+        with self._adapters([request]):
+            outputs = self.model(
+                input_ids=torch.tensor([request.input_ids[start:end]], dtype=torch.long, device=device),
+                attention_mask=torch.ones((1, end), dtype=torch.long, device=device),
+                position_ids=torch.arange(start, end, dtype=torch.long, device=device).unsqueeze(0),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        self.stats['prefill_tokens'] += end - start
+        self.stats['prefill_chunks'] += 1
+        if self.kv_cache is not None:
+            if request in self.kv_cache:
+                self.kv_cache.extend(request, outputs.past_key_values, 0, start, end - start)
+            else:
+                blocks, request.prefill_blocks = request.prefill_blocks, []
+                self.kv_cache.write(
+                    request, outputs.past_key_values, 0, start, end - start, prefix_blocks=blocks
+                )
+        else:
+            request.prefill_cache = outputs.past_key_values
+        request.prefilled = end
+        if end < length:
+            return
+
+        self._prefilling.popleft()
+        cache, request.prefill_cache = request.prefill_cache, None
+        self._append_tokens([request], outputs.logits[:, -1, :])
+        if self.kv_cache is not None:
+            self._active.append(request)
+        else:
+            self._merge([request], cache, torch.ones((1, length), dtype=torch.long, device=device))
+        self._cache_prefixes([request], cache, [0])
+        self._retire_finished()
+
+    def _prefill_cached(self, request: GenerationRequest, blocks: List):
+        """复用已缓存前缀的KV，只对后缀做prefill"""
+        device = self.model.device
+        prefix_len = len(blocks) * self.prefix_cache.block_size
+        length = len(request.input_ids)
+
+        input_ids = torch.tensor([request.input_ids[prefix_len:]], dtype=torch.long, device=device)
+        attention_mask = torch.ones((1, length), dtype=torch.long, device=device)
+        position_ids = torch.arange(prefix_len, length, dtype=torch.long, device=device).unsqueeze(0)
+
+        if self.kv_cache is not None:
+            past_key_values = self.kv_cache.gather_blocks(blocks)
+        else:
+            past_key_values = _cat_caches(blocks, self.seq_dim)
+        try:
+            with self._adapters([request]):
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
+        except Exception:
+            if self.kv_cache is not None:
+                for block in blocks:
+                    self.kv_cache.release(block)
+            raise
+        self.stats['prefill_tokens'] += length - prefix_len
+
+        self._append_tokens([request], outputs.logits[:, -1, :])
+        if self.kv_cache is not None:
+            # 命中的前缀块直接成为序列块表的开头，只写入后缀的KV
+            self.kv_cache.write(
+                request, outputs.past_key_values, 0, prefix_len, length - prefix_len,
+                prefix_blocks=blocks
+            )
+            self._active.append(request)
+        else:
+            self._merge([request], outputs.past_key_values, attention_mask)
+        self._cache_prefixes([request], outputs.past_key_values, [0])
+        self._retire_finished()
+
+    def _prefill_batch(self, requests: List[GenerationRequest]):
+        """对新请求做批量prefill（左侧padding对齐）"""
+        device = self.model.device
+        lengths = [len(r.input_ids) for r in requests]
+        max_len = max(lengths)
+
+        input_ids = torch.full(
+            (len(requests), max_len), self.pad_token_id, dtype=torch.long, device=device
+        )
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long, device=device)
+        for i, request in enumerate(requests):
+            input_ids[i, max_len - lengths[i]:] = torch.tensor(request.input_ids, device=device)
+            attention_mask[i, max_len - lengths[i]:] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        with self._adapters(requests):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=True
+            )
+        self.stats['prefill_tokens'] += sum(lengths)
+
+        self._append_tokens(requests, outputs.logits[:, -1, :])
+        offsets = [max_len - length for length in lengths]
+        if self.kv_cache is not None:
+            for row, (request, offset) in enumerate(zip(requests, offsets)):
+                self.kv_cache.write(request, outputs.past_key_values, row, offset, lengths[row])
+            self._active.extend(requests)
+        else:
+            self._merge(requests, outputs.past_key_values, attention_mask)
+        self._cache_prefixes(requests, outputs.past_key_values, offsets)
+        self._retire_finished()
+
+    def _cache_prefixes(self, requests: List[GenerationRequest], cache, offsets: List[int]):
+        """将prefill得到的输入KV按块存入前缀缓存
+
+        Args:
+            offsets: 各请求在批次中左侧padding的长度
+        """
+        if self.prefix_cache is None:
+            return
+        block_size = self.prefix_cache.block_size
+        for row, (request, offset) in enumerate(zip(requests, offsets)):
+            if self.kv_cache is not None:
+                # 分页模式下缓存序列自己的块（增加引用），不复制KV
+                table = self.kv_cache.block_table(request)
+                self.prefix_cache.insert(
+                    request.input_ids,
+                    lambda index, table=table: (
+                        self.kv_cache.retain(table[index]), self.kv_cache.block_bytes
+                    ),
+                    namespace=request.adapter
+                )
+                continue
+
+            def block_value(index: int, row: int = row, offset: int = offset):
+                # clone使缓存块不引用整个批次的KV存储
+                block = _map_cache(
+                    cache,
+                    lambda t: t.narrow(self.batch_dim, row, 1)
+                    .narrow(self.seq_dim, offset + index * block_size, block_size)
+                    .clone()
+                )
+                return block, _cache_nbytes(block)
+
+            self.prefix_cache.insert(request.input_ids, block_value, namespace=request.adapter)
+
+    def _decode_step(self):
+        """对当前批次执行一步解码"""
+        if self.kv_cache is not None:
+            self._decode_step_paged()
+            return
+        device = self.model.device
+        input_ids = torch.tensor(
+            [[r.output_ids[-1]] for r in self._active], dtype=torch.long, device=device
+        )
+        position_ids = torch.tensor(
+            [[r.position] for r in self._active], dtype=torch.long, device=device
+        )
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))],
+            dim=1
+        )
+
+        with self._adapters(self._active):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True
+            )
+        self._cache = outputs.past_key_values
+        self._attention_mask = attention_mask
+        self.stats['decode_steps'] += 1
+        self.stats['batched_sequences'] += len(self._active)
+
+        self._append_tokens(self._active, outputs.logits[:, -1, :])
+        self._retire_finished()
+
+    def _decode_step_paged(self):
+        """分页KV缓存下的一步解码：按块表拼出KV，前向后写回新token的KV"""
+        self._ensure_decode_blocks()
+        if not self._active:
+            return
+        device = self.model.device
+        past_key_values, attention_mask = self.kv_cache.gather(self._active)
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((len(self._active), 1))], dim=1
+        )
+        input_ids = torch.tensor(
+            [[r.output_ids[-1]] for r in self._active], dtype=torch.long, device=device
+        )
+        position_ids = torch.tensor(
+            [[r.position] for r in self._active], dtype=torch.long, device=device
+        )
+
+        with self._adapters(self._active):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        self.kv_cache.append(self._active, outputs.past_key_values)
+        self.stats['decode_steps'] += 1
+        self.stats['batched_sequences'] += len(self._active)
+
+        self._append_tokens(self._active, outputs.logits[:, -1, :])
+        self._retire_finished()
+
+    def _ensure_decode_blocks(self):
+        """块不足以让每个序列再解码一个token时，抢占最晚加入的序列"""
+        while self._active and not self.kv_cache.can_allocate(
+            self.kv_cache.blocks_needed(self._active, 1)
+        ):
+            self._preempt(self._active.pop())
+
+    def _preempt(self, request: GenerationRequest):
+        """换出序列的KV（主机交换空间不足时丢弃，恢复时重新prefill），放回等待队列最前"""
+        self.stats['preemptions'] += 1
+        if self.kv_cache.swap_out(request):
+            self.stats['swapped'] += 1
+        else:
+            self.kv_cache.free(request)
+        self._deferred.appendleft(request)
+        logging.info(
+            f"Preempted a sequence of {len(request.input_ids) + len(request.output_ids)} tokens "
+            f"in {self.name} ({'swapped' if self.kv_cache.is_swapped(request) else 'recompute'})"
+        )
+
+    def _admit_paged(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """按空闲KV块接纳请求：恢复被抢占的序列，返回需要prefill的新请求
+
+        放不下的请求按原顺序留在等待队列最前；批次为空仍放不下的请求以KVCacheFullError结束。
+        """
+        admitted = []
+        for index, request in enumerate(requests):
+            if request.output_ids:
+                resumed = self._resume(request)
+            else:
+                # 预留输入与首个解码token的块
+                resumed = self.kv_cache.can_allocate(
+                    sum(self.kv_cache.blocks_for(len(r.input_ids) + 1) for r in admitted + [request])
+                )
+                if resumed:
+                    admitted.append(request)
+            if resumed:
+                continue
+            if not self._active and not admitted:
+                self._fail([request], KVCacheFullError(
+                    f"Sequence of {len(request.input_ids) + len(request.output_ids)} tokens "
+                    f"does not fit in the KV cache of {self.name}"
+                ))
+                continue
+            self._deferred.extendleft(reversed(requests[index:]))
+            break
+        return admitted
+
+    def _resume(self, request: GenerationRequest) -> bool:
+        """恢复被抢占的序列：从主机内存换入，或对输入与已生成的token重新prefill"""
+        if self.kv_cache.is_swapped(request):
+            if not self.kv_cache.swap_in(request):
+                return False
+        else:
+            tokens = request.input_ids + request.output_ids[:-1]
+            if not self.kv_cache.can_allocate(self.kv_cache.blocks_for(len(tokens) + 1)):
+                return False
+            device = self.model.device
+            with self._adapters([request]):
+                outputs = self.model(
+                    input_ids=torch.tensor([tokens], dtype=torch.long, device=device),
+                    attention_mask=torch.ones((1, len(tokens)), dtype=torch.long, device=device),
+                    position_ids=torch.arange(len(tokens), dtype=torch.long, device=device).unsqueeze(0),
+                    use_cache=True
+                )
+            self.kv_cache.write(request, outputs.past_key_values, 0, 0, len(tokens))
+            self.stats['prefill_tokens'] += len(tokens)
+            self.stats['recomputed_tokens'] += len(tokens)
+        self._active.append(request)
+        return True
+
+    def _acquire_adapters(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """为请求换入LoRA适配器，适配器加载中或常驻槽位都被占用时请求按原顺序留在等待队列最前"""
+        admitted = []
+        waiting = []
+        for request in requests:
+            if request.adapter is not None and not request.adapter_held:
+                try:
+                    request.adapter_held = self.lora.acquire(request.adapter)
+                except Exception as e:
+                    logging.error(f"Error loading LoRA adapter {request.adapter}: {str(e)}")
+                    self._fail([request], e)
+                    continue
+                if not request.adapter_held:
+                    waiting.append(request)
+                    continue
+            admitted.append(request)
+        self._deferred.extendleft(reversed(waiting))
+        if waiting and not admitted and not self._active and not self._prefilling:
+            # 没有可以解码的请求，只在等待适配器加载：短暂等待而不是空转重试
+            self.lora.wait_for_loads(timeout=0.01)
+        return admitted
+
+    def _adapters(self, requests: List[GenerationRequest]):
+        """在前向期间按行应用各请求的LoRA适配器"""
+        if self.lora is None:
+            return nullcontext()
+        return self.lora.activate([r.adapter for r in requests])
+
+    def _append_tokens(self, requests: List[GenerationRequest], logits: torch.Tensor):
+        """按各请求的采样参数采样下一个token"""
+        temperatures = torch.tensor(
+            [r.temperature for r in requests], dtype=torch.float, device=logits.device
+        )
+        top_ps = torch.tensor(
+            [r.top_p for r in requests], dtype=torch.float, device=logits.device
+        )
+        tokens = sample_next_tokens(logits, temperatures, top_ps)
+        logprobs = torch.log_softmax(logits.float(), dim=-1).gather(1, tokens.unsqueeze(-1)).squeeze(-1)
+        for request, token, logprob in zip(requests, tokens.tolist(), logprobs.tolist()):
+            request.logprob_sum += logprob
+            self._push_token(request, token)
+
+    def _push_token(self, request: GenerationRequest, token: int):
+        """记录请求生成的token，流式请求同时推送给调用方"""
+        if request.first_token_at is None:
+            request.first_token_at = time.monotonic()
+        request.output_ids.append(token)
+        if request.token_queue is not None:
+            _call_in_loop(request.loop, request.token_queue.put_nowait, token)
+        self.stats['generated_tokens'] += 1
+
+    def _merge(self, requests: List[GenerationRequest], cache, attention_mask: torch.Tensor):
+        """将新prefill的序列并入当前批次，较短的一方在左侧补齐"""
+        if not self._active:
+            self._active = list(requests)
+            self._cache = cache
+            self._attention_mask = attention_mask
+            return
+
+        old_len = self._attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        target = max(old_len, new_len)
+
+        self._cache = _zip_cache(
+            _map_cache(self._cache, lambda t: _pad_left(t, target - old_len, self.seq_dim)),
+            _map_cache(cache, lambda t: _pad_left(t, target - new_len, self.seq_dim)),
+            lambda a, b: torch.cat([a, b], dim=self.batch_dim)
+        )
+        self._attention_mask = torch.cat([
+            _pad_left(self._attention_mask, target - old_len, 1),
+            _pad_left(attention_mask, target - new_len, 1)
+        ], dim=0)
+        self._active.extend(requests)
+
+    def _is_finished(self, request: GenerationRequest) -> bool:
+        if request.cancelled or request.future.done():
+            return True
+        if len(request.output_ids) >= request.max_new_tokens:
+            return True
+        return request.output_ids[-1] in self.eos_token_ids
+
+    def _retire_finished(self):
+        """移除已完成的序列并返回结果，同时裁剪批次中多余的左侧padding"""
+        if self.kv_cache is not None:
+            active = []
+            for request in self._active:
+                if self._is_finished(request):
+                    self._complete(request)
+                else:
+                    active.append(request)
+            self._active = active
+            return
+
+        keep = []
+        for i, request in enumerate(self._active):
+            if self._is_finished(request):
+                self._complete(request)
+            else:
+                keep.append(i)
+
+        if not keep:
+            self._reset_batch()
+            return
+        if len(keep) == len(self._active):
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self._attention_mask.device)
+        self._active = [self._active[i] for i in keep]
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._cache = _map_cache(
+            self._cache,
+            lambda t: t.index_select(self.batch_dim, index.to(t.device))
+        )
+
+        # 去掉所有行都是padding的前导列
+        empty_columns = (self._attention_mask.sum(0) == 0).long()
+        trim = int(empty_columns.cumprod(0).sum())
+        if trim:
+            self._attention_mask = self._attention_mask[:, trim:]
+            self._cache = _map_cache(
+                self._cache,
+                lambda t: t.narrow(self.seq_dim, trim, t.shape[self.seq_dim] - trim)
+            )
+
+    def _complete(self, request: GenerationRequest):
+        if request.cancelled or request.future.done():
+            self._retire_cancelled(request)
+            return
+        self._release(request)
+        request.finished_at = time.monotonic()
+        self.stats['completed'] += 1
+        _call_in_loop(
+            request.loop, _set_future_result, request.future, list(request.output_ids)
+        )
+        self._close_stream(request)
+
+    def _retire_cancelled(self, request: GenerationRequest):
+        """记录被取消的请求：已生成的token计为浪费，剩余的生成预算计为节省"""
+        self._release(request)
+        request.finished_at = time.monotonic()
+        self.stats['cancelled'] += 1
+        self.stats['cancelled_tokens'] += len(request.output_ids)
+        self.stats['saved_tokens'] += max(0, request.max_new_tokens - len(request.output_ids))
+        self._close_stream(request)
+
+    def _fail(self, requests: List[GenerationRequest], exc: BaseException):
+        for request in requests:
+            self._release(request)
+            self.stats['failed'] += 1
+            _call_in_loop(request.loop, _set_future_exception, request.future, exc)
+            self._close_stream(request)
+
+    def _close_stream(self, request: GenerationRequest):
+        if request.token_queue is not None:
+            _call_in_loop(request.loop, request.token_queue.put_nowait, None)
+
+    def _release(self, request: GenerationRequest):
+        """释放请求占用的KV块与LoRA适配器槽位"""
+        if self.kv_cache is not None:
+            self.kv_cache.free(request)
+            for block in request.prefill_blocks:
+                self.kv_cache.release(block)
+        request.prefill_blocks = []
+        request.prefill_cache = None
+        if request.adapter_held:
+            request.adapter_held = False
+            self.lora.release(request.adapter)
+
+    def _reset_batch(self):
+        for request in self._active:
+            self._release(request)
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
@@ -0,0 +1,227 @@
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from core.admission import _percentile
+
+AUTO_MODEL = "auto"
+
+# 模型规模（如 "7b"、"0.5B"）-> 十亿参数
+_SIZE = re.compile(r'^\s*([\d.]+)\s*[bB]\s*$')
+
+DEFAULT_HEDGES = (
+    "i don't know", "i do not know", "i'm not sure", "i am not sure", "cannot answer",
+    "不知道", "不确定", "无法回答"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖tokenizer粗略估计文本的token数（路由时模型可能尚未加载）"""
+    return max(len(text.split()) * 4 // 3, len(text.encode('utf-8')) // 4, 1)
+
+
+def model_cost(model_config: dict) -> float:
+    """模型每千token的相对开销：配置的cost，否则按size中的参数量（十亿）估计"""
+    if 'cost' in model_config:
+        return float(model_config['cost'])
+    match = _SIZE.match(str(model_config.get('size', '')))
+    if match:
+        return float(match.group(1))
+    logging.warning(f"Model {model_config['name']} has no cost or size, assuming cost 1.0 for routing")
+    return 1.0
+
+
+class CascadeRouter:
+    """model为auto时在多个模型之间按开销选择（级联路由）
+
+    候选模型按开销从低到高排列，选择第一个满足请求的模型：
+    1. 估计的提示词长度加上最少生成长度不超过模型的max_length，请求指定的max_length也不超过它；
+    2. 预期延迟（该模型最近请求的p50延迟 × (1 + 排队数 / 并发数)）不超过max_latency。
+    都不满足延迟要求时选择预期延迟最低的合格模型。
+    小模型的回答置信度低（平均token概率低于min_confidence，或回答为空、含有不确定的措辞）时
+    可以升级到下一个更大的合格模型重新生成。
+
+    每次路由决策都记录日志，并按相对开销统计节省：以最贵的候选模型为基准，
+    节省 = (基准开销 - 实际开销) × 处理的token数 / 1000，升级时两次生成的开销都计入。
+    """
+
+    def __init__(
+        self,
+        models: Sequence[dict],
+        min_new_tokens: int = 64,
+        max_latency: Optional[float] = None,
+        escalate: bool = True,
+        min_confidence: float = 0.5,
+        hedges: Sequence[str] = DEFAULT_HEDGES,
+        window: int = 100,
+        max_decisions: int = 1000,
+        log_interval: int = 100
+    ):
+        """
+        Args:
+            models: 候选模型的配置（name、max_length以及cost或size）
+            min_new_tokens: 选择模型时为回答预留的最少token数
+            max_latency: 可接受的预期延迟（秒），None表示不按延迟跳过
+            escalate: 是否在回答置信度低时升级到更大的模型
+        """
+        if not models:
+            raise ValueError("Cascade routing needs at least one model")
+        self.candidates: List[Tuple[str, float, int]] = sorted(
+            ((model['name'], model_cost(model), model['max_length']) for model in models),
+            key=lambda candidate: candidate[1]
+        )
+        self.baseline_cost = self.candidates[-1][1]
+        self.min_new_tokens = min_new_tokens
+        self.max_latency = max_latency
+        self.escalate = escalate
+        self.min_confidence = min_confidence
+        self.hedges = tuple(hedge.lower() for hedge in hedges)
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Deque[float]] = {
+            name: deque(maxlen=window) for name, _, _ in self.candidates
+        }
+        self.decisions: Deque[dict] = deque(maxlen=max_decisions)
+        self.stats: Dict[str, float] = {
+            'requests': 0,
+            'escalations': 0,
+            'cost': 0.0,
+            'baseline_cost': 0.0
+        }
+        self._per_model: Dict[str, Dict[str, float]] = {
+            name: {'requests': 0, 'tokens': 0, 'cost': 0.0} for name, _, _ in self.candidates
+        }
+
+    @property
+    def models(self) -> List[str]:
+        return [name for name, _, _ in self.candidates]
+
+    def select(
+        self,
+        prompt_tokens: int,
+        max_length: Optional[int],
+        load: Dict[str, Tuple[int, int]]
+    ) -> Tuple[str, str]:
+        """为请求选择模型，返回 (模型名, 选择原因)
+
+        Args:
+            prompt_tokens: 估计的提示词token数
+            max_length: 请求指定的max_length，None表示使用各模型的配置
+            load: 模型名 -> (排队数, 最大并发数)
+        """
+        eligible = self._eligible(prompt_tokens, max_length)
+        if not eligible:
+            # 没有模型放得下时交给上下文最长的模型，由它返回长度错误
+            name = max(self.candidates, key=lambda candidate: candidate[2])[0]
+            return name, "prompt exceeds every model's max_length"
+        expected = {name: self.expected_latency(name, *load.get(name, (0, 1))) for name in eligible}
+        for name in eligible:
+            if self.max_latency is None or expected[name] <= self.max_latency:
+                if name == eligible[0]:
+                    return name, "cheapest model that fits"
+                return name, f"cheaper models over latency budget {self.max_latency}s"
+        name = min(eligible, key=lambda candidate: expected[candidate])
+        return name, f"all models over latency budget, lowest expected latency {expected[name]:.2f}s"
+
+    def escalation_target(self, model_name: str, prompt_tokens: int, max_length: Optional[int]) -> Optional[str]:
+        """比model_name更贵的下一个合格模型，没有时返回None"""
+        eligible = self._eligible(prompt_tokens, max_length)
+        if model_name not in eligible:
+            return None
+        index = eligible.index(model_name)
+        return eligible[index + 1] if index + 1 < len(eligible) else None
+
+    def is_confident(self, response: str, confidence: Optional[float] = None) -> bool:
+        """判断回答是否可信：有平均token概率时与min_confidence比较，并检查空回答与不确定的措辞"""
+        text = response.strip().lower()
+        if not text:
+            return False
+        if confidence is not None and confidence < self.min_confidence:
+            return False
+        return not any(hedge in text for hedge in self.hedges)
+
+    def expected_latency(self, model_name: str, queue_depth: int, max_concurrency: int) -> float:
+        """按最近请求的p50延迟与排队情况估计新请求的延迟（没有记录时为0）"""
+        with self._lock:
+            latencies = sorted(self._latencies[model_name])
+        return _percentile(latencies, 0.50) * (1 + queue_depth / max(max_concurrency, 1))
+
+    def record(
+        self,
+        request_id: int,
+        model_name: str,
+        reason: str,
+        latency: float,
+        tokens: int,
+        escalated_from: Optional[str] = None,
+        confidence: Optional[float] = None
+    ):
+        """记录一次生成：更新延迟窗口与开销统计，并输出路由决策日志"""
+        cost = self._cost(model_name) * tokens / 1000
+        with self._lock:
+            self._latencies[model_name].append(latency)
+            per_model = self._per_model[model_name]
+            per_model['requests'] += 1
+            per_model['tokens'] += tokens
+            per_model['cost'] += cost
+            self.stats['cost'] += cost
+            if escalated_from is None:
+                self.stats['requests'] += 1
+                self.stats['baseline_cost'] += self.baseline_cost * tokens / 1000
+            else:
+                self.stats['escalations'] += 1
+            requests = self.stats['requests']
+            decision = {
+                'time': time.time(),
+                'request': request_id,
+                'model': model_name,
+                'reason': reason,
+                'escalated_from': escalated_from,
+                'latency': latency,
+                'tokens': tokens,
+                'cost': cost,
+                'confidence': confidence
+            }
+            self.decisions.append(decision)
+
+        logging.info(
+            f"Auto routing request {request_id} -> {model_name} ({reason}): "
+            f"{tokens} tokens in {latency * 1000:.0f}ms, cost {cost:.3f}"
+            + (f", confidence {confidence:.2f}" if confidence is not None else "")
+            + (f", escalated from {escalated_from}" if escalated_from else "")
+        )
+        if self.log_interval and escalated_from is None and requests % self.log_interval == 0:
+            stats = self.get_stats()
+            logging.info(
+                f"Auto routing saved {stats['saved_cost']:.2f} ({stats['saved_ratio']:.0%}) of the cost of "
+                f"always using {self.candidates[-1][0]} over {requests} requests "
+                f"({stats['escalations']} escalations): {stats['models']}"
+            )
+
+    def get_stats(self) -> Dict:
+        """获取路由次数、升级次数、各模型开销与相对最贵模型节省的开销"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['models'] = {name: dict(values) for name, values in self._per_model.items()}
+        stats['saved_cost'] = stats['baseline_cost'] - stats['cost']
+        stats['saved_ratio'] = stats['saved_cost'] / stats['baseline_cost'] if stats['baseline_cost'] else 0.0
+        return stats
+
+    def get_decisions(self, limit: int = 100) -> List[dict]:
+        """获取最近的路由决策"""
+        with self._lock:
+            return list(self.decisions)[-limit:]
+
+    def _eligible(self, prompt_tokens: int, max_length: Optional[int]) -> List[str]:
+        """按开销从低到高排列的、放得下请求的模型"""
+        return [
+            name for name, _, model_max_length in self.candidates
+            if prompt_tokens + self.min_new_tokens <= model_max_length
+            and (max_length is None or max_length <= model_max_length)
+        ]
+
+    def _cost(self, model_name: str) -> float:
+        return next(cost for name, cost, _ in self.candidates if name == model_name)
@@ -0,0 +1,74 @@
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import torch
+
+
+def quantize_dynamic_int8(model):
+    """对模型的线性层做动态int8量化（权重int8，激活在推理时动态量化）
+
+    动态量化只支持float32权重，半精度模型会先转换为float32。
+    """
+    if next(model.parameters()).dtype != torch.float32:
+        model = model.float()
+    # 原地替换，避免量化时再复制一份完整的模型
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def measure_tokens_per_sec(model, num_tokens: int = 16, prompt_length: int = 16) -> float:
+    """用固定输入做一次贪心解码，返回解码阶段每秒生成的token数"""
+    vocab_size = model.config.vocab_size
+    input_ids = (torch.arange(prompt_length, dtype=torch.long) % (vocab_size - 1) + 1).unsqueeze(0)
+    with torch.inference_mode():
+        outputs = model(input_ids=input_ids, use_cache=True)
+        start = time.perf_counter()
+        for _ in range(num_tokens):
+            next_ids = outputs.logits[:, -1:, :].argmax(dim=-1)
+            outputs = model(
+                input_ids=next_ids,
+                past_key_values=outputs.past_key_values,
+                use_cache=True
+            )
+        elapsed = time.perf_counter() - start
+    return num_tokens / elapsed if elapsed > 0 else float('inf')
+
+
+def prepare_cpu_model(
+    model,
+    quantize: Optional[str] = "int8",
+    num_threads: Optional[int] = None,
+    benchmark: bool = False
+) -> Tuple[object, Dict]:
+    """为CPU推理准备模型，返回 (模型, 报告)
+
+    Args:
+        quantize: "int8"表示动态int8量化，None表示保持原精度
+        num_threads: 基准测试使用的线程数（调度线程会单独设置）
+        benchmark: 是否对比量化前后的解码速度（tokens/sec）
+    """
+    report: Dict = {'quantize': quantize}
+    previous_threads = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    try:
+        model.eval()
+        if benchmark:
+            report['baseline_tokens_per_sec'] = measure_tokens_per_sec(model)
+        if quantize == "int8":
+            model = quantize_dynamic_int8(model)
+        elif quantize:
+            raise ValueError(f"Unsupported CPU quantization: {quantize}")
+        if benchmark:
+            report['tokens_per_sec'] = measure_tokens_per_sec(model)
+            report['speedup'] = report['tokens_per_sec'] / report['baseline_tokens_per_sec']
+            logging.info(
+                f"CPU decode speed: {report['baseline_tokens_per_sec']:.1f} tok/s (fp32) -> "
+                f"{report['tokens_per_sec']:.1f} tok/s ({quantize or 'fp32'}), "
+                f"{report['speedup']:.2f}x"
+            )
+    finally:
+        torch.set_num_threads(previous_threads)
+    return model, report
@@ -0,0 +1,352 @@
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import struct
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+import yaml
+
+from core.replicas import plan_replica_devices
+from core.weight_cache import WeightCache
+
+GiB = 1 << 30
+
+# 重复的层：transformer.h.0、model.layers.11、transformer.encoder.layers.3、blocks.2 等
+_LAYER = re.compile(r'^(.*?(?:^|\.)(?:h|layers|layer|blocks|block)\.\d+)\.')
+# 位于所有层之后的模块：最后的norm与输出头
+_TAIL = re.compile(r'(?:^|\.)(?:ln_f|norm|final_layernorm|final_layer_norm|lm_head|output_layer|score)$')
+
+_DTYPE_BYTES = {
+    'F64': 8, 'I64': 8, 'U64': 8,
+    'F32': 4, 'I32': 4, 'U32': 4,
+    'F16': 2, 'BF16': 2, 'I16': 2, 'U16': 2,
+    'F8_E4M3': 1, 'F8_E5M2': 1, 'I8': 1, 'U8': 1, 'BOOL': 1
+}
+
+Device = Union[int, str]
+# (模块名, 权重字节数, 是否为重复层)
+Module = Tuple[str, int, bool]
+
+
+class DeviceMapError(ValueError):
+    """模型（含KV缓存预留）放不进可用设备"""
+
+
+def read_weight_sizes(model_path: str) -> Dict[str, int]:
+    """从权重索引读取各张量的字节数，只读取safetensors文件头，不加载权重
+
+    本地目录读取 model.safetensors.index.json 列出的分片（或单个 model.safetensors）；
+    否则视为Hub上的模型名，通过HTTP range请求只获取各分片的文件头。
+    """
+    if not os.path.isdir(model_path):
+        from huggingface_hub import get_safetensors_metadata
+
+        metadata = get_safetensors_metadata(model_path)
+        return {
+            name: math.prod(info.shape) * _DTYPE_BYTES[info.dtype]
+            for file in metadata.files_metadata.values()
+            for name, info in file.tensors.items()
+        }
+
+    index_path = os.path.join(model_path, 'model.safetensors.index.json')
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            files = sorted(set(json.load(f)['weight_map'].values()))
+    elif os.path.exists(os.path.join(model_path, 'model.safetensors')):
+        files = ['model.safetensors']
+    else:
+        raise FileNotFoundError(f"No safetensors weights found in {model_path}")
+
+    sizes = {}
+    for file in files:
+        with open(os.path.join(model_path, file), 'rb') as f:
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_len))
+        for name, info in header.items():
+            if name != '__metadata__':
+                start, end = info['data_offsets']
+                sizes[name] = end - start
+    return sizes
+
+
+def group_modules(tensor_sizes: Dict[str, int]) -> List[Module]:
+    """把张量按模块聚合，按前向顺序排列
+
+    顺序为：输入端模块（嵌入等）、按编号排列的各层、输出端模块（最后的norm与输出头）。
+    """
+    layers: Dict[str, int] = {}
+    others: Dict[str, int] = {}
+    for name, size in tensor_sizes.items():
+        match = _LAYER.match(name)
+        if match:
+            layers[match.group(1)] = layers.get(match.group(1), 0) + size
+        else:
+            module = name.rsplit('.', 1)[0] if '.' in name else name
+            others[module] = others.get(module, 0) + size
+
+    def layer_key(name: str):
+        prefix, index = name.rsplit('.', 1)
+        return prefix, int(index)
+
+    head = [(name, size, False) for name, size in others.items() if not _TAIL.search(name)]
+    tail = [(name, size, False) for name, size in others.items() if _TAIL.search(name)]
+    body = [(name, size, True) for name, size in sorted(layers.items(), key=lambda item: layer_key(item[0]))]
+    return head + body + tail
+
+
+class DevicePlan:
+    """设备映射规划结果：传给from_pretrained的device_map与各设备的占用明细（字节）"""
+
+    def __init__(self, device_map: Dict[str, Device], devices: Dict[Device, dict]):
+        self.device_map = device_map
+        self.devices = devices
+
+    def to_dict(self) -> Dict:
+        return {
+            'device_map': dict(self.device_map),
+            'devices': {str(device): dict(info) for device, info in self.devices.items()}
+        }
+
+    def format(self) -> str:
+        """可读的规划表：每个设备的层范围、权重、KV预留与预算使用率"""
+        lines = [f"{'device':>8} {'layers':>10} {'weights':>10} {'kv_cache':>10} {'capacity':>10} {'used':>6}"]
+        for device, info in self.devices.items():
+            layers = info['layers']
+            layer_range = f"{layers[0]}-{layers[-1]}" if layers else "-"
+            capacity = info['capacity']
+            used = (info['weights'] + info['kv_cache']) / capacity if capacity else 0.0
+            lines.append(
+                f"{device!s:>8} {layer_range:>10} {info['weights'] / GiB:>9.2f}G "
+                f"{info['kv_cache'] / GiB:>9.2f}G {capacity / GiB:>9.2f}G {used:>6.0%}"
+            )
+        return "\n".join(lines)
+
+
+def plan_device_map(
+    modules: Sequence[Module],
+    capacities: Dict[Device, float],
+    kv_cache_bytes: float = 0
+) -> DevicePlan:
+    """把按前向顺序排列的模块连续地切分到各设备，使各设备的占用与其预算成比例
+
+    KV缓存随层分布在层所在的设备上，因此kv_cache_bytes平均分摊到各层，作为层的
+    额外开销一起规划。切分使 max(设备占用 / 设备预算) 最小，模块不会被拆开；
+    超过预算时抛出DeviceMapError。预算未知（无穷大）时全部放在第一个设备上。
+
+    Args:
+        modules: group_modules返回的 [(模块名, 字节数, 是否为重复层)]
+        capacities: 设备 -> 可用字节数（已乘以memory_fraction），按流水线顺序排列
+        kv_cache_bytes: 每个副本为KV缓存预留的总字节数
+    """
+    if not capacities:
+        raise DeviceMapError("No devices to place the model on")
+    devices = list(capacities)
+    num_layers = sum(1 for _, _, is_layer in modules if is_layer)
+    kv_per_layer = kv_cache_bytes / num_layers if num_layers else 0.0
+    costs = [size + (kv_per_layer if is_layer else 0.0) for _, size, is_layer in modules]
+
+    def assign(ratio: float) -> Optional[List[int]]:
+        """每个设备最多占用 ratio × 预算时的贪心切分，放不下时返回None"""
+        placement = []
+        for position, device in enumerate(devices):
+            limit = ratio * capacities[device]
+            load = 0.0
+            while len(placement) < len(costs) and load + costs[len(placement)] <= limit:
+                load += costs[len(placement)]
+                placement.append(position)
+        return placement if len(placement) == len(costs) else None
+
+    total = sum(costs)
+    if any(math.isinf(capacity) for capacity in capacities.values()):
+        placement = [0] * len(costs)
+    else:
+        placement = assign(1.0)
+        if placement is None:
+            raise DeviceMapError(
+                f"Model needs {total / GiB:.2f} GiB for weights and KV cache, which does not fit "
+                f"in devices {devices} with {sum(capacities.values()) / GiB:.2f} GiB"
+            )
+        # 二分查找最小的占用比例
+        low, high = 0.0, 1.0
+        for _ in range(50):
+            middle = (low + high) / 2
+            if assign(middle) is None:
+                low = middle
+            else:
+                high = middle
+        placement = assign(high)
+
+    device_map: Dict[str, Device] = {}
+    summary = {
+        device: {'capacity': capacities[device], 'weights': 0, 'kv_cache': 0.0, 'layers': [], 'modules': []}
+        for device in devices
+    }
+    layer_index = 0
+    for (name, size, is_layer), position in zip(modules, placement):
+        device = devices[position]
+        device_map[name] = device
+        info = summary[device]
+        info['weights'] += size
+        info['modules'].append(name)
+        if is_layer:
+            info['kv_cache'] += kv_per_layer
+            info['layers'].append(layer_index)
+            layer_index += 1
+    return DevicePlan(device_map, summary)
+
+
+def align_device_map(device_map: Dict[str, Device], tensor_names: Sequence[str]) -> Dict[str, Device]:
+    """把按权重文件命名的device_map对应到实际加载的模型的模块名
+
+    权重可能来自带LM头的模型（transformer.h.0...），而AutoModel加载的是基座模型（h.0...），
+    反之亦然，因此允许两边各去掉一个开头的部分再匹配。对应不上的张量（未保存的共享权重、
+    buffer等）放在前一个张量所在的设备上，使每个张量都有设备。
+
+    Args:
+        tensor_names: 模型state_dict中的张量名，按模型中的顺序排列
+    """
+    lookup: Dict[str, Device] = {}
+    for key, device in device_map.items():
+        lookup[key] = device
+    for key, device in device_map.items():
+        if '.' in key:
+            lookup.setdefault(key.split('.', 1)[1], device)
+
+    aligned: Dict[str, Device] = {}
+    previous = next(iter(device_map.values()))
+    for name in tensor_names:
+        parts = name.split('.')
+        found = None
+        for skip in (0, 1):
+            for end in range(len(parts) - 1, skip, -1):
+                if '.'.join(parts[skip:end]) in lookup:
+                    found = ('.'.join(parts[:end]), lookup['.'.join(parts[skip:end])])
+                    break
+            if found:
+                break
+        if found is None:
+            found = ('.'.join(parts[:-1]) or name, previous)
+        module, previous = found
+        aligned.setdefault(module, previous)
+    return aligned
+
+
+def model_tensor_names(model_path: str) -> List[str]:
+    """在meta设备上构建模型（不加载权重），返回其state_dict中的张量名"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModel
+
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModel.from_config(config, trust_remote_code=True)
+    return list(model.state_dict())
+
+
+def device_budgets(gpu_config: dict, device_memory: Optional[float] = None) -> Dict[int, float]:
+    """各设备可用于模型的显存（GB）：单卡显存 × memory_fraction
+
+    单卡显存依次取device_memory参数、gpu.device_memory配置与CUDA报告的总显存，都没有时为无穷大。
+    """
+    budgets = {}
+    for device in gpu_config['devices']:
+        if device_memory is not None:
+            total = device_memory
+        elif 'device_memory' in gpu_config:
+            total = gpu_config['device_memory']
+        elif torch.cuda.is_available():
+            total = torch.cuda.get_device_properties(device).total_memory / GiB
+        else:
+            total = float('inf')
+        budgets[device] = total * gpu_config.get('memory_fraction', 1.0)
+    return budgets
+
+
+def plan_model(
+    config: dict,
+    model_name: str,
+    devices: Sequence[int],
+    device_memory: Optional[float] = None
+) -> DevicePlan:
+    """按配置为模型的一个副本规划device_map，不加载权重
+
+    权重大小来自本地权重缓存（已转换时）或模型自身的safetensors索引。每个副本的KV缓存预留取
+    模型声明的gpu_memory减去权重大小，启用分页KV缓存时至少为其存储池大小。
+    """
+    model_config = next(
+        (model for model in config['models']['available'] if model['name'] == model_name), None
+    )
+    if model_config is None:
+        raise ValueError(f"Model {model_name} not found")
+    if model_config['type'] != 'transformers':
+        raise ValueError(f"Device maps are only planned for transformers models: {model_name}")
+
+    source = model_name
+    cache_config = config.get('weight_cache', {})
+    if cache_config.get('enabled', True):
+        weight_cache = WeightCache(cache_config.get('cache_dir', 'models'))
+        if weight_cache.is_cached(model_name):
+            source = weight_cache.path(model_name)
+    modules = group_modules(read_weight_sizes(source))
+    weights = sum(size for _, size, _ in modules)
+
+    declared = model_config.get('gpu_memory', 0) * GiB
+    if declared and weights > declared:
+        logging.warning(
+            f"Weights of {model_name} ({weights / GiB:.2f} GiB) exceed its declared "
+            f"gpu_memory ({declared / GiB:.2f} GiB)"
+        )
+    kv_cache_bytes = max(declared - weights, 0)
+    kv_config = config.get('scheduler', {}).get('kv_cache', {}) or {}
+    if kv_config.get('enabled', False):
+        kv_cache_bytes = max(kv_cache_bytes, kv_config.get('max_memory_mb', 1024) * (1 << 20))
+
+    budgets = device_budgets(config['gpu'], device_memory)
+    capacities = {device: budgets[device] * GiB for device in devices}
+    return plan_device_map(modules, capacities, kv_cache_bytes)
+
+
+def main(argv=None) -> int:
+    """打印配置中transformers模型各副本的设备规划（dry run，不加载权重）"""
+    parser = argparse.ArgumentParser(description="Print the planned device map of each model without loading weights")
+    parser.add_argument('--config', default='config/config.yaml')
+    parser.add_argument('--model', action='append', help="Only plan these models (repeatable)")
+    parser.add_argument('--device-memory', type=float, help="Override the memory of each device (GB)")
+    parser.add_argument('--json', action='store_true', help="Print the plans as JSON")
+    args = parser.parse_args(argv)
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+
+    available = config['models']['available']
+    replica_devices = plan_replica_devices(available, config['gpu']['devices'])
+    plans = {}
+    status = 0
+    for model_config in available:
+        model_name = model_config['name']
+        if model_config['type'] != 'transformers' or (args.model and model_name not in args.model):
+            continue
+        for index, device in enumerate(replica_devices[model_name]):
+            devices = config['gpu']['devices'] if device is None else [device]
+            key = f"{model_name} replica {index}"
+            try:
+                plan = plan_model(config, model_name, devices, args.device_memory)
+            except Exception as e:
+                plans[key] = {'error': str(e)}
+                status = 1
+                if not args.json:
+                    print(f"{key}: {e}\n")
+                continue
+            plans[key] = plan.to_dict()
+            if not args.json:
+                print(f"{key} on devices {list(devices)}:\n{plan.format()}\n")
+    if args.json:
+        print(json.dumps(plans, indent=2, ensure_ascii=False))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
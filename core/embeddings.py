@@ -0,0 +1,246 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+EMBEDDING_DTYPES = ('float32', 'float16', 'int8')
+# 与Chroma默认嵌入函数相同的模型，已有集合的向量保持兼容
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def convert_embeddings(vectors: torch.Tensor, dtype: str = 'float32') -> List[List]:
+    """按输出精度转换向量 [n, dim]
+
+    float16降低响应体积与存储占用；int8为归一化向量乘127后取整，
+    点积整体放大127²倍，相似度排序与float32基本一致。
+    """
+    if dtype == 'float32':
+        return vectors.float().tolist()
+    if dtype == 'float16':
+        return vectors.half().tolist()
+    if dtype == 'int8':
+        return torch.round(vectors.float() * 127).clamp(-127, 127).to(torch.int8).tolist()
+    raise ValueError(f"Unsupported embedding dtype: {dtype}")
+
+
+class _Job:
+    """一次嵌入调用（可包含多条文本）"""
+
+    __slots__ = ('texts', 'future')
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+
+
+class EmbeddingEngine:
+    """在专用线程中合批计算文本向量
+
+    工作线程在max_wait窗口内收集并发的调用，一次分词后按长度排序，
+    切分为补齐后token数（批大小 × 最长文本长度）不超过max_batch_tokens的小批做前向，
+    对最后一层隐藏状态按attention mask做平均池化并L2归一化。
+    调用返回concurrent.futures.Future，同步代码（Chroma）与事件循环均可等待。
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        name: str = "embedding",
+        max_batch_size: int = 64,
+        max_batch_tokens: int = 8192,
+        max_wait_ms: float = 2.0,
+        max_length: int = 256,
+        normalize: bool = True
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_length = max_length
+        self.normalize = normalize
+
+        self._jobs: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, float] = {
+            'requests': 0,
+            'texts': 0,
+            'tokens': 0,
+            'padded_tokens': 0,
+            'batches': 0,
+            'forward_passes': 0,
+            'busy_seconds': 0.0
+        }
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def start(self):
+        """启动工作线程"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"embeddings-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """处理完已提交的调用后停止工作线程"""
+        if not self._running:
+            return
+        self._running = False
+        self._jobs.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+        error = RuntimeError(f"Embedding engine {self.name} stopped")
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and not job.future.done():
+                job.future.set_exception(error)
+
+    def submit(self, texts: Sequence[str]) -> Future:
+        """提交一组文本，Future的结果为 (向量 [n, dim] float32 CPU张量, token数)"""
+        if not self._running:
+            raise RuntimeError(f"Embedding engine {self.name} is not running")
+        job = _Job(list(texts))
+        with self._stats_lock:
+            self.stats['requests'] += 1
+        if not job.texts:
+            job.future.set_result((torch.empty(0, 0), 0))
+            return job.future
+        self._jobs.put(job)
+        return job.future
+
+    def embed(self, texts: Sequence[str], dtype: str = 'float32') -> List[List]:
+        """同步计算文本向量（阻塞当前线程）"""
+        vectors, _ = self.submit(texts).result()
+        return convert_embeddings(vectors, dtype)
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        batches = stats['batches']
+        stats['avg_batch_size'] = stats['texts'] / batches if batches else 0.0
+        busy = stats['busy_seconds']
+        stats['texts_per_sec'] = stats['texts'] / busy if busy else 0.0
+        padded = stats['padded_tokens']
+        stats['padding_ratio'] = 1 - stats['tokens'] / padded if padded else 0.0
+        stats['pending'] = self._jobs.qsize()
+        return stats
+
+    def _run(self):
+        """工作线程主循环：收集一批调用后合批计算"""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            jobs = [job]
+            num_texts = len(job.texts)
+            stop = False
+            deadline = time.monotonic() + self.max_wait
+            while num_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    job = self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+                num_texts += len(job.texts)
+
+            self._process([job for job in jobs if job.future.set_running_or_notify_cancel()])
+            if stop:
+                return
+
+    def _process(self, jobs: List[_Job]):
+        if not jobs:
+            return
+        start = time.perf_counter()
+        texts = [text for job in jobs for text in job.texts]
+        try:
+            vectors, lengths = self._encode(texts)
+        except Exception as e:
+            logging.error(f"Error in embedding engine {self.name}: {str(e)}")
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+
+        offset = 0
+        for job in jobs:
+            count = len(job.texts)
+            job.future.set_result((vectors[offset:offset + count], sum(lengths[offset:offset + count])))
+            offset += count
+        with self._stats_lock:
+            self.stats['batches'] += 1
+            self.stats['texts'] += len(texts)
+            self.stats['busy_seconds'] += time.perf_counter() - start
+
+    def _encode(self, texts: List[str]) -> Tuple[torch.Tensor, List[int]]:
+        """计算一组文本的向量，返回 (按输入顺序的向量, 各文本token数)"""
+        input_ids = self.tokenizer(
+            texts, truncation=True, max_length=self.max_length
+        )['input_ids']
+        lengths = [len(ids) for ids in input_ids]
+        # 按长度排序后切分，相近长度的文本放在同一批以减少补齐
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        results: List[Optional[torch.Tensor]] = [None] * len(texts)
+        for batch in self._micro_batches(order, lengths):
+            for index, vector in zip(batch, self._forward([input_ids[i] for i in batch])):
+                results[index] = vector
+        return torch.stack(results), lengths
+
+    def _micro_batches(self, order: List[int], lengths: List[int]) -> List[List[int]]:
+        """按max_batch_size与补齐后的token预算切分（order已按长度升序）"""
+        batches: List[List[int]] = []
+        current: List[int] = []
+        for index in order:
+            padded = (len(current) + 1) * max(lengths[index], 1)
+            if current and (len(current) >= self.max_batch_size or padded > self.max_batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(index)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _forward(self, sequences: List[List[int]]) -> torch.Tensor:
+        """一次前向计算一小批序列，返回池化后的float32 CPU向量"""
+        device = self.device
+        width = max(max(len(ids) for ids in sequences), 1)
+        pad_token_id = self.tokenizer.pad_token_id or 0
+        input_ids = torch.full((len(sequences), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+
+        with torch.inference_mode():
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        hidden = outputs.last_hidden_state.float()
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        vectors = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        if self.normalize:
+            vectors = torch.nn.functional.normalize(vectors, dim=-1)
+
+        with self._stats_lock:
+            self.stats['forward_passes'] += 1
+            self.stats['tokens'] += int(attention_mask.sum())
+            self.stats['padded_tokens'] += attention_mask.numel()
+        return vectors.cpu()
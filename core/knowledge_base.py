@@ -1,8 +1,9 @@
 import os
 import yaml
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict
 import chromadb
 from chromadb.config import Settings
+from chromadb.utils import embedding_functions
 from langchain.document_loaders import (
     PyPDFLoader,
     Docx2txtLoader,
@@ -12,10 +13,30 @@ from langchain.document_loaders import (
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import logging
 
+class _EmbeddingFunction:
+    """把文本向量函数适配为Chroma的嵌入函数接口（参数名必须为input）"""
+
+    def __init__(self, embed: Callable[[List[str]], List[List[float]]]):
+        self._embed = embed
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self._embed(input)
+
+
 class KnowledgeBase:
-    def __init__(self, config_path: str = "config/config.yaml"):
+    def __init__(
+        self,
+        config_path: str = "config/config.yaml",
+        embed: Optional[Callable[[List[str]], List[List[float]]]] = None
+    ):
         self.config = self._load_config(config_path)
         self.vector_db = None
+        # Chroma集合与语义缓存共用同一个嵌入函数，避免重复加载嵌入模型；
+        # 传入embed（通常是ModelManager.embed_texts）时与/embeddings接口共用合批的嵌入引擎
+        if embed is not None:
+            self.embedding_function = _EmbeddingFunction(embed)
+        else:
+            self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
         self._init_vector_db()
         
     def _load_config(self, config_path: str) -> dict:
@@ -75,18 +96,24 @@ class KnowledgeBase:
             texts = text_splitter.split_documents(documents)
             
             # 获取或创建集合
-            collection = self.vector_db.get_or_create_collection(collection_name)
+            collection = self.vector_db.get_or_create_collection(
+                collection_name,
+                embedding_function=self.embedding_function
+            )
             
-            # 添加文档到向量数据库
-            for i, text in enumerate(texts):
+            # 一次添加全部片段，嵌入函数对整批文本合批计算向量
+            if texts:
                 collection.add(
-                    documents=[text.page_content],
-                    metadatas=[{
-                        "source": file_path,
-                        "chunk": i,
-                        "page": text.metadata.get("page", 0)
-                    }],
-                    ids=[f"{os.path.basename(file_path)}_{i}"]
+                    documents=[text.page_content for text in texts],
+                    metadatas=[
+                        {
+                            "source": file_path,
+                            "chunk": i,
+                            "page": text.metadata.get("page", 0)
+                        }
+                        for i, text in enumerate(texts)
+                    ],
+                    ids=[f"{os.path.basename(file_path)}_{i}" for i in range(len(texts))]
                 )
             
             logging.info(f"Successfully added document: {file_path}")
@@ -108,7 +135,10 @@ class KnowledgeBase:
             return []
             
         try:
-            collection = self.vector_db.get_collection(collection_name)
+            collection = self.vector_db.get_collection(
+                collection_name,
+                embedding_function=self.embedding_function
+            )
             results = collection.query(
                 query_texts=[query],
                 n_results=n_results
@@ -131,6 +161,10 @@ class KnowledgeBase:
             logging.error(f"Error searching documents: {str(e)}")
             return []
     
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """使用知识库的嵌入函数计算文本向量"""
+        return self.embedding_function(texts)
+    
     def delete_document(self, file_path: str, collection_name: str = "default") -> bool:
         """从知识库中删除文档"""
         if not self.vector_db:
@@ -0,0 +1,353 @@
+import math
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class KVCacheFullError(RuntimeError):
+    """KV缓存块不足，且无法通过回收前缀缓存腾出空间"""
+
+
+def _flatten(cache) -> List[torch.Tensor]:
+    """按顺序取出嵌套tuple形式的past_key_values中的全部张量"""
+    if isinstance(cache, torch.Tensor):
+        return [cache]
+    return [leaf for item in cache for leaf in _flatten(item)]
+
+
+def _skeleton(cache):
+    """复制past_key_values的嵌套结构，张量替换为None（不持有张量）"""
+    if isinstance(cache, torch.Tensor):
+        return None
+    return type(cache)(_skeleton(item) for item in cache)
+
+
+def _unflatten(skeleton, leaves):
+    if skeleton is None:
+        return next(leaves)
+    return type(skeleton)(_unflatten(item, leaves) for item in skeleton)
+
+
+class PagedKVCache:
+    """按定长块管理KV缓存的分配器
+
+    首次写入时按模型KV的形状预分配固定大小的存储池（max_bytes），切成block_size个token
+    一块的物理块，每个张量在池中的布局为 [槽位, 其余维度...]。每个序列持有一张块表，
+    按需从空闲链表分配新块，序列结束即归还，不产生外部碎片。
+
+    块带引用计数，可被多个序列与前缀缓存共享；向共享的未满块追加时先复制（copy-on-write）。
+    块不足时先通过reclaim回收前缀缓存；调用方可把序列换出到主机内存（swap_out），
+    稍后再换入（swap_in）。
+
+    transformers的注意力实现需要连续的past_key_values，计算时由gather按块表
+    拼出左侧补齐的临时KV，前向结束后用append写回新token的KV。
+    """
+
+    def __init__(
+        self,
+        block_size: int = 16,
+        max_bytes: int = 1 << 30,
+        swap_max_bytes: int = 1 << 30,
+        batch_dim: int = 0,
+        seq_dim: int = 2
+    ):
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.swap_max_bytes = swap_max_bytes
+        self.batch_dim = batch_dim
+        self.seq_dim = seq_dim
+        # 块不足时调用，返回是否释放了缓存项（通常是PrefixCache.evict_lru）
+        self.reclaim: Optional[Callable[[], bool]] = None
+
+        self.num_blocks = 0
+        self.bytes_per_token = 0
+        self._pool: Optional[List[torch.Tensor]] = None
+        self._skeleton = None
+        self._free: List[int] = []
+        self._refcounts: List[int] = []
+        self._tables: Dict[Hashable, List[int]] = {}
+        self._lengths: Dict[Hashable, int] = {}
+        # 序列 -> (各张量在主机内存中的副本, token数)
+        self._swapped: Dict[Hashable, Tuple[List[torch.Tensor], int]] = {}
+        self.swap_used_bytes = 0
+        self.stats: Dict[str, int] = {
+            'allocated_blocks': 0,
+            'peak_used_blocks': 0,
+            'cow_copies': 0,
+            'swap_outs': 0,
+            'swap_ins': 0,
+            'alloc_failures': 0
+        }
+
+    @property
+    def block_bytes(self) -> int:
+        return self.bytes_per_token * self.block_size
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    def __contains__(self, seq: Hashable) -> bool:
+        return seq in self._tables
+
+    def length(self, seq: Hashable) -> int:
+        return self._lengths[seq]
+
+    def block_table(self, seq: Hashable) -> List[int]:
+        return list(self._tables[seq])
+
+    def is_swapped(self, seq: Hashable) -> bool:
+        return seq in self._swapped
+
+    def blocks_for(self, num_tokens: int) -> int:
+        """容纳num_tokens个token的新序列需要的块数"""
+        return math.ceil(num_tokens / self.block_size)
+
+    def can_allocate(self, num_blocks: int) -> bool:
+        """是否能分配num_blocks个块（必要时回收前缀缓存）；存储池尚未创建时总是返回True"""
+        if self._pool is None:
+            return True
+        return self._reserve(num_blocks)
+
+    def blocks_needed(self, seqs: Sequence[Hashable], num_tokens: int = 1) -> int:
+        """各序列再追加num_tokens个token共需的新块数（含copy-on-write）"""
+        needed = 0
+        for seq in seqs:
+            length = self._lengths[seq]
+            table = self._tables[seq]
+            needed += max(0, self.blocks_for(length + num_tokens) - len(table))
+            if length % self.block_size and self._refcounts[table[-1]] > 1:
+                needed += 1
+        return needed
+
+    def write(
+        self,
+        seq: Hashable,
+        cache,
+        row: int,
+        start: int,
+        length: int,
+        prefix_blocks: Sequence[int] = ()
+    ):
+        """为新序列分配块并写入KV
+
+        Args:
+            cache: 模型输出的past_key_values（连续存储）
+            row: 序列在cache中的batch行
+            start, length: 要写入的token在cache中的位置区间
+            prefix_blocks: 序列开头复用的完整块，调用方已持有其引用，引用转移给该序列（写入失败时释放）
+        """
+        if seq in self._tables or seq in self._swapped:
+            raise ValueError("Sequence already has a KV cache")
+        self._ensure_pool(cache)
+        if not self._reserve(self.blocks_for(len(prefix_blocks) * self.block_size + length) - len(prefix_blocks)):
+            for block in prefix_blocks:
+                self.release(block)
+            raise KVCacheFullError(f"Not enough KV cache blocks for {length} tokens")
+        self._tables[seq] = list(prefix_blocks)
+        self._lengths[seq] = len(prefix_blocks) * self.block_size
+        slots = self._extend(seq, length)
+        for pool, tensor in zip(self._pool, _flatten(cache)):
+            pool.index_copy_(0, slots, self._token_major(tensor)[row, start:start + length])
+
+    def extend(self, seq: Hashable, cache, row: int, start: int, length: int):
+        """把cache中 [start, start + length) 位置的KV追加到已有序列（分块prefill的后续块）"""
+        if not self._reserve(self.blocks_needed([seq], length)):
+            raise KVCacheFullError(f"Not enough KV cache blocks for {length} tokens")
+        slots = self._extend(seq, length)
+        for pool, tensor in zip(self._pool, _flatten(cache)):
+            pool.index_copy_(0, slots, self._token_major(tensor)[row, start:start + length])
+
+    def append(self, seqs: Sequence[Hashable], cache):
+        """把cache中每行最后一个位置的KV追加到对应序列（解码一步之后调用）"""
+        if not self._reserve(self.blocks_needed(seqs, 1)):
+            raise KVCacheFullError(f"Not enough KV cache blocks to extend {len(seqs)} sequences")
+        slots = torch.cat([self._extend(seq, 1) for seq in seqs])
+        for pool, tensor in zip(self._pool, _flatten(cache)):
+            pool.index_copy_(0, slots, self._token_major(tensor)[:, -1])
+
+    def gather(self, seqs: Sequence[Hashable]) -> Tuple[object, torch.Tensor]:
+        """按块表拼出左侧补齐的连续past_key_values与attention mask [batch, 最长长度]"""
+        lengths = [self._lengths[seq] for seq in seqs]
+        width = max(lengths)
+        slots = torch.zeros((len(seqs), width), dtype=torch.long)
+        attention_mask = torch.zeros((len(seqs), width), dtype=torch.long)
+        for row, (seq, length) in enumerate(zip(seqs, lengths)):
+            slots[row, width - length:] = self._slots(self._tables[seq], 0, length)
+            attention_mask[row, width - length:] = 1
+        device = self._pool[0].device
+        return self._gather(slots.to(device)), attention_mask.to(device)
+
+    def gather_blocks(self, blocks: Sequence[int]):
+        """拼出由完整块组成的单个前缀的past_key_values（batch为1）"""
+        slots = self._slots(list(blocks), 0, len(blocks) * self.block_size).unsqueeze(0)
+        return self._gather(slots.to(self._pool[0].device))
+
+    def retain(self, block: int) -> int:
+        """增加块的引用（前缀缓存共享序列的块），返回块号"""
+        self._refcounts[block] += 1
+        return block
+
+    def release(self, block: int):
+        """释放一次块引用，引用归零时放回空闲链表"""
+        self._refcounts[block] -= 1
+        if self._refcounts[block] == 0:
+            self._free.append(block)
+
+    def free(self, seq: Hashable):
+        """释放序列的全部块（或换出到主机内存的副本）"""
+        table = self._tables.pop(seq, None)
+        self._lengths.pop(seq, None)
+        if table is not None:
+            for block in table:
+                self.release(block)
+        swapped = self._swapped.pop(seq, None)
+        if swapped is not None:
+            self.swap_used_bytes -= swapped[1] * self.bytes_per_token
+
+    def swap_out(self, seq: Hashable) -> bool:
+        """把序列的KV复制到主机内存并释放其块，主机交换空间不足时返回False"""
+        length = self._lengths[seq]
+        size = length * self.bytes_per_token
+        if self.swap_used_bytes + size > self.swap_max_bytes:
+            return False
+        slots = self._slots(self._tables[seq], 0, length).to(self._pool[0].device)
+        host = []
+        for pool in self._pool:
+            data = pool.index_select(0, slots).cpu()
+            if torch.cuda.is_available():
+                data = data.pin_memory()
+            host.append(data)
+        self.free(seq)
+        self._swapped[seq] = (host, length)
+        self.swap_used_bytes += size
+        self.stats['swap_outs'] += 1
+        return True
+
+    def swap_in(self, seq: Hashable) -> bool:
+        """把换出的序列写回新分配的块，块不足时返回False"""
+        host, length = self._swapped[seq]
+        if not self._reserve(self.blocks_for(length)):
+            return False
+        del self._swapped[seq]
+        self.swap_used_bytes -= length * self.bytes_per_token
+        self._tables[seq] = []
+        self._lengths[seq] = 0
+        slots = self._extend(seq, length)
+        for pool, data in zip(self._pool, host):
+            pool.index_copy_(0, slots, data.to(pool.device, non_blocking=True))
+        self.stats['swap_ins'] += 1
+        return True
+
+    def get_stats(self) -> Dict:
+        """获取块利用率、内部碎片率、共享与换出统计"""
+        stats = dict(self.stats)
+        used = self.num_blocks - len(self._free)
+        # 各物理块实际存放的token数；不属于任何序列的在用块只被前缀缓存引用，总是满的
+        fills: Dict[int, int] = {}
+        for seq, table in self._tables.items():
+            length = self._lengths[seq]
+            for index, block in enumerate(table):
+                fill = min(self.block_size, length - index * self.block_size)
+                fills[block] = max(fills.get(block, 0), fill)
+        stored = sum(fills.values()) + (used - len(fills)) * self.block_size
+        stats.update({
+            'block_size': self.block_size,
+            'num_blocks': self.num_blocks,
+            'used_blocks': used,
+            'free_blocks': len(self._free),
+            'shared_blocks': sum(1 for count in self._refcounts if count > 1),
+            'utilization': used / self.num_blocks if self.num_blocks else 0.0,
+            'fragmentation': 1 - stored / (used * self.block_size) if used else 0.0,
+            'sequences': len(self._tables),
+            'swapped_sequences': len(self._swapped),
+            'swap_used_bytes': self.swap_used_bytes,
+            'used_bytes': used * self.block_bytes,
+            'max_bytes': self.num_blocks * self.block_bytes
+        })
+        return stats
+
+    def _token_major(self, tensor: torch.Tensor) -> torch.Tensor:
+        """把 [..batch.., ..seq.., ...] 布局的张量转为 [batch, seq, 其余维度...]"""
+        return tensor.movedim((self.batch_dim, self.seq_dim), (0, 1))
+
+    def _ensure_pool(self, cache):
+        """按第一次写入的KV形状创建存储池"""
+        if self._pool is not None:
+            return
+        leaves = [self._token_major(tensor) for tensor in _flatten(cache)]
+        self.bytes_per_token = sum(
+            math.prod(leaf.shape[2:]) * leaf.element_size() for leaf in leaves
+        )
+        self.num_blocks = self.max_bytes // self.block_bytes
+        if self.num_blocks == 0:
+            raise ValueError(
+                f"KV cache budget {self.max_bytes} bytes is smaller than one block ({self.block_bytes} bytes)"
+            )
+        num_slots = self.num_blocks * self.block_size
+        self._pool = [
+            torch.zeros((num_slots,) + tuple(leaf.shape[2:]), dtype=leaf.dtype, device=leaf.device)
+            for leaf in leaves
+        ]
+        self._skeleton = _skeleton(cache)
+        self._refcounts = [0] * self.num_blocks
+        # 倒序入栈，使低编号的块先被分配
+        self._free = list(range(self.num_blocks - 1, -1, -1))
+
+    def _reserve(self, num_blocks: int) -> bool:
+        """确保至少有num_blocks个空闲块，不足时回收前缀缓存"""
+        while len(self._free) < num_blocks:
+            if self.reclaim is None or not self.reclaim():
+                self.stats['alloc_failures'] += 1
+                return False
+        return True
+
+    def _allocate(self) -> int:
+        block = self._free.pop()
+        self._refcounts[block] = 1
+        self.stats['allocated_blocks'] += 1
+        used = self.num_blocks - len(self._free)
+        if used > self.stats['peak_used_blocks']:
+            self.stats['peak_used_blocks'] = used
+        return block
+
+    def _extend(self, seq: Hashable, num_tokens: int) -> torch.Tensor:
+        """为序列追加num_tokens个槽位（空闲块需已预留），返回槽位号"""
+        table = self._tables[seq]
+        length = self._lengths[seq]
+        if length % self.block_size and self._refcounts[table[-1]] > 1:
+            self._copy_on_write(table)
+        while len(table) * self.block_size < length + num_tokens:
+            table.append(self._allocate())
+        self._lengths[seq] = length + num_tokens
+        return self._slots(table, length, length + num_tokens).to(self._pool[0].device)
+
+    def _copy_on_write(self, table: List[int]):
+        """序列要写入的最后一块被共享时，复制一份再写"""
+        old = table[-1]
+        new = self._allocate()
+        size = self.block_size
+        for pool in self._pool:
+            pool[new * size:(new + 1) * size] = pool[old * size:(old + 1) * size]
+        self.release(old)
+        table[-1] = new
+        self.stats['cow_copies'] += 1
+
+    def _slots(self, table: List[int], start: int, end: int) -> torch.Tensor:
+        positions = torch.arange(start, end, dtype=torch.long)
+        blocks = torch.tensor(table, dtype=torch.long)[positions // self.block_size]
+        return blocks * self.block_size + positions % self.block_size
+
+    def _gather(self, slots: torch.Tensor):
+        """按槽位 [batch, 长度] 取出各张量并还原为模型的KV布局"""
+        rows, width = slots.shape
+        flat = slots.reshape(-1)
+        leaves = [
+            pool.index_select(0, flat)
+            .view((rows, width) + tuple(pool.shape[1:]))
+            .movedim((0, 1), (self.batch_dim, self.seq_dim))
+            for pool in self._pool
+        ]
+        return _unflatten(self._skeleton, iter(leaves))
@@ -0,0 +1,128 @@
+import logging
+import math
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+from core.admission import _percentile
+
+
+class OutputLengthPredictor:
+    """按单个模型的历史完成情况预测请求的输出长度（token数）
+
+    依次使用以下特征，取第一个有历史记录的估计值，并以请求的最大生成长度为上限：
+    1. 相似提示词：规范化后的前prefix_words个词相同（模板化的任务往往长度相近）
+    2. 提示词长度分桶（按词数取log2）
+    3. 该模型的全局平均输出长度
+    都没有记录时返回最大生成长度。各估计值为指数滑动平均。
+
+    同时记录预测误差与端到端延迟，用于对比长度感知调度与FIFO。
+    """
+
+    def __init__(
+        self,
+        name: str = "model",
+        history_size: int = 1000,
+        prefix_words: int = 8,
+        smoothing: float = 0.2,
+        stats_window: int = 1000,
+        log_interval: int = 100
+    ):
+        self.name = name
+        self.history_size = history_size
+        self.prefix_words = prefix_words
+        self.smoothing = smoothing
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._by_prefix: "OrderedDict[str, float]" = OrderedDict()
+        self._by_bucket: Dict[int, float] = {}
+        self._global: Optional[float] = None
+
+        self.stats: Dict[str, float] = {
+            'predictions': 0,
+            'observations': 0,
+            'prefix_hits': 0,
+            'total_abs_error': 0.0
+        }
+        self._errors: Deque[float] = deque(maxlen=stats_window)
+        self._latencies: Deque[float] = deque(maxlen=stats_window)
+
+    def _features(self, prompt: str):
+        words = prompt.lower().split()
+        prefix = " ".join(words[:self.prefix_words])
+        bucket = int(math.log2(len(words) + 1))
+        return prefix, bucket
+
+    def predict(self, prompt: str, max_new_tokens: int) -> float:
+        """预测输出长度，不超过max_new_tokens"""
+        prefix, bucket = self._features(prompt)
+        with self._lock:
+            self.stats['predictions'] += 1
+            estimate = self._by_prefix.get(prefix)
+            if estimate is not None:
+                self._by_prefix.move_to_end(prefix)
+                self.stats['prefix_hits'] += 1
+            else:
+                estimate = self._by_bucket.get(bucket, self._global)
+        if estimate is None:
+            return float(max_new_tokens)
+        return min(float(max_new_tokens), estimate)
+
+    def record(
+        self,
+        prompt: str,
+        predicted: float,
+        actual: int,
+        latency: Optional[float] = None
+    ):
+        """记录一次完成的请求：更新历史，并累计预测误差与延迟"""
+        prefix, bucket = self._features(prompt)
+        with self._lock:
+            self._by_prefix[prefix] = self._update(self._by_prefix.get(prefix), actual)
+            self._by_prefix.move_to_end(prefix)
+            while len(self._by_prefix) > self.history_size:
+                self._by_prefix.popitem(last=False)
+            self._by_bucket[bucket] = self._update(self._by_bucket.get(bucket), actual)
+            self._global = self._update(self._global, actual)
+
+            error = abs(predicted - actual)
+            self.stats['observations'] += 1
+            self.stats['total_abs_error'] += error
+            self._errors.append(error)
+            if latency is not None:
+                self._latencies.append(latency)
+            observations = self.stats['observations']
+
+        logging.debug(
+            f"Output length for {self.name}: predicted {predicted:.0f}, actual {actual}"
+            + (f", latency {latency * 1000:.0f}ms" if latency is not None else "")
+        )
+        if self.log_interval and observations % self.log_interval == 0:
+            stats = self.get_stats()
+            logging.info(
+                f"Output length prediction for {self.name}: "
+                f"mae={stats['mean_abs_error']:.1f} tokens "
+                f"(p50={stats['p50_abs_error']:.0f}, p99={stats['p99_abs_error']:.0f}), "
+                f"latency p50={stats['p50_latency'] * 1000:.0f}ms "
+                f"p99={stats['p99_latency'] * 1000:.0f}ms over {observations} requests"
+            )
+
+    def _update(self, current: Optional[float], actual: int) -> float:
+        if current is None:
+            return float(actual)
+        return current + self.smoothing * (actual - current)
+
+    def get_stats(self) -> Dict:
+        """获取预测误差与延迟分位数"""
+        with self._lock:
+            stats = dict(self.stats)
+            errors = sorted(self._errors)
+            latencies = sorted(self._latencies)
+            stats['history_entries'] = len(self._by_prefix)
+        observations = stats['observations']
+        stats['mean_abs_error'] = stats['total_abs_error'] / observations if observations else 0.0
+        stats['p50_abs_error'] = _percentile(errors, 0.50)
+        stats['p99_abs_error'] = _percentile(errors, 0.99)
+        stats['p50_latency'] = _percentile(latencies, 0.50)
+        stats['p99_latency'] = _percentile(latencies, 0.99)
+        return stats
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+
+# PEFT保存的权重名：base_model.model.<模块路径>.lora_A.weight（旧版本带适配器名）
+_LORA_KEY = re.compile(r'^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$')
+
+
+def _resolve_module(modules: Dict[str, torch.nn.Module], path: str) -> Optional[str]:
+    """把适配器中的模块路径对应到模型的模块名
+
+    适配器可能基于带LM头的模型保存（transformer.h.0...），而本地模型可能是基座模型（h.0...），
+    反之亦然，因此依次尝试去掉路径开头的部分，或匹配以该路径结尾的模块名。
+    """
+    parts = path.split('.')
+    for start in range(len(parts)):
+        candidate = '.'.join(parts[start:])
+        if candidate in modules:
+            return candidate
+    suffix = '.' + path
+    matches = [name for name in modules if name.endswith(suffix)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _module_device(module: torch.nn.Module, default: torch.device) -> torch.device:
+    for tensor in list(module.parameters(recurse=False)) + list(module.buffers(recurse=False)):
+        return tensor.device
+    return default
+
+
+class LoRAAdapter:
+    """一个LoRA适配器的权重：模块名 -> (A [r, in], B [out, r])，增量为 x @ Aᵀ @ Bᵀ × scale"""
+
+    def __init__(self, name: str, weights: Dict[str, Tuple[torch.Tensor, torch.Tensor]], scale: float):
+        self.name = name
+        self.weights = weights
+        self.scale = scale
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            a.numel() * a.element_size() + b.numel() * b.element_size()
+            for a, b in self.weights.values()
+        )
+
+    @classmethod
+    def load(
+        cls,
+        name: str,
+        path: str,
+        model: torch.nn.Module,
+        dtype: Optional[torch.dtype] = None
+    ) -> "LoRAAdapter":
+        """从PEFT格式的目录（adapter_config.json + adapter_model.safetensors/.bin）加载
+
+        权重放到各目标模块所在的设备上（多设备切分的模型同样适用）。
+        """
+        with open(os.path.join(path, 'adapter_config.json'), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        rank = config['r']
+        alpha = config.get('lora_alpha', rank)
+        scale = alpha / rank ** 0.5 if config.get('use_rslora') else alpha / rank
+
+        safetensors_path = os.path.join(path, 'adapter_model.safetensors')
+        if os.path.exists(safetensors_path):
+            from safetensors.torch import load_file
+            state_dict = load_file(safetensors_path)
+        else:
+            state_dict = torch.load(os.path.join(path, 'adapter_model.bin'), map_location='cpu')
+
+        modules = dict(model.named_modules())
+        default_device = next(model.parameters()).device
+        if dtype is None:
+            dtype = next(
+                (p.dtype for p in model.parameters() if p.is_floating_point()), torch.float32
+            )
+        pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+        for key, tensor in state_dict.items():
+            match = _LORA_KEY.match(key)
+            if match is None:
+                logging.warning(f"Skipping unsupported weight {key} in LoRA adapter {name}")
+                continue
+            module_name = _resolve_module(modules, match.group(1))
+            if module_name is None:
+                raise ValueError(f"LoRA adapter {name} targets unknown module {match.group(1)}")
+            device = _module_device(modules[module_name], default_device)
+            pairs.setdefault(module_name, {})[match.group(2)] = tensor.to(device, dtype)
+
+        weights = {}
+        for module_name, pair in pairs.items():
+            if set(pair) != {'A', 'B'}:
+                raise ValueError(f"LoRA adapter {name} is missing lora_A or lora_B for {module_name}")
+            weights[module_name] = (pair['A'], pair['B'])
+        return cls(name, weights, scale)
+
+
+class LoRAManager:
+    """在一个常驻的基座模型上复用多个LoRA适配器
+
+    适配器不合并进基座权重，而是在目标模块上注册forward hook：前向时按行所属的
+    适配器分组，对各组的行加上各自的低秩增量，因此使用不同适配器（或不使用适配器）
+    的请求可以在同一次前向中合批。
+
+    常驻的适配器最多max_loaded个，按LRU换入换出；正在被请求使用的适配器（acquire之后、
+    release之前）不会被换出，常驻槽位都被占用时acquire返回False，调用方稍后重试。
+    冷适配器在后台线程中从磁盘加载，加载期间acquire同样返回False，不阻塞解码；
+    加载完成后由下一次acquire在调度线程中换入并注册hook。
+    只应在调度线程中调用acquire/release/activate。
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        adapters: Dict[str, str],
+        max_loaded: int = 4,
+        batch_dim: int = 0
+    ):
+        """
+        Args:
+            adapters: 适配器名 -> PEFT格式目录
+            batch_dim: 隐藏状态的batch维（ChatGLM为1）
+        """
+        if max_loaded <= 0:
+            raise ValueError("max_loaded must be positive")
+        self.model = model
+        self.paths = dict(adapters)
+        self.max_loaded = max_loaded
+        self.batch_dim = batch_dim
+        # 按最近使用顺序排列的常驻适配器
+        self._resident: "OrderedDict[str, LoRAAdapter]" = OrderedDict()
+        self._refcounts: Dict[str, int] = {}
+        self._hooks: Dict[str, torch.utils.hooks.RemovableHandle] = {}
+        # 正在后台加载（或已加载、等待换入）的适配器
+        self._loading: Dict[str, Future] = {}
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lora-loader")
+        # 当前前向中各适配器负责的行：[(适配器, 行号张量)]
+        self._groups: List[Tuple[LoRAAdapter, torch.Tensor]] = []
+        self._lock = threading.Lock()
+        self.stats: Dict[str, float] = {
+            'hits': 0,
+            'loads': 0,
+            'evictions': 0,
+            'load_seconds': 0.0,
+            'batched_forwards': 0,
+            'mixed_forwards': 0
+        }
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.paths
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.paths)
+
+    def acquire(self, name: str) -> bool:
+        """确保适配器常驻并增加其使用计数
+
+        适配器不在常驻集合中时开始在后台加载并返回False；常驻槽位都在使用中时同样返回False，
+        调用方稍后重试。后台加载失败时抛出加载时的异常。
+        """
+        with self._lock:
+            if name in self._resident:
+                self._resident.move_to_end(name)
+                self._refcounts[name] += 1
+                self.stats['hits'] += 1
+                return True
+            if len(self._resident) >= self.max_loaded and all(self._refcounts.values()):
+                return False
+
+            future = self._loading.get(name)
+            if future is None:
+                self._loading[name] = self._loader.submit(self._load, name)
+                return False
+            if not future.done():
+                return False
+            del self._loading[name]
+            adapter, seconds = future.result()
+
+            if len(self._resident) >= self.max_loaded:
+                victim = next(n for n in self._resident if not self._refcounts[n])
+                del self._resident[victim]
+                del self._refcounts[victim]
+                self.stats['evictions'] += 1
+                logging.info(f"Evicted LoRA adapter {victim}")
+            for module_name in adapter.weights:
+                self._install_hook(module_name)
+            self._resident[name] = adapter
+            self._refcounts[name] = 1
+            self.stats['loads'] += 1
+            self.stats['load_seconds'] += seconds
+            return True
+
+    def wait_for_loads(self, timeout: float):
+        """等待任一后台加载完成（最多timeout秒），调度线程空闲时用于避免空转重试"""
+        with self._lock:
+            pending = [future for future in self._loading.values() if not future.done()]
+        if pending:
+            wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def _load(self, name: str) -> Tuple[LoRAAdapter, float]:
+        """在加载线程中读取适配器权重，返回适配器与耗时"""
+        start = time.monotonic()
+        adapter = LoRAAdapter.load(name, self.paths[name], self.model)
+        seconds = time.monotonic() - start
+        logging.info(
+            f"Loaded LoRA adapter {name} ({len(adapter.weights)} modules, "
+            f"{adapter.nbytes / (1 << 20):.1f} MB) in {seconds:.2f}s"
+        )
+        return adapter, seconds
+
+    def release(self, name: str):
+        """减少适配器的使用计数，归零后可被换出"""
+        with self._lock:
+            if self._refcounts.get(name):
+                self._refcounts[name] -= 1
+
+    @contextmanager
+    def activate(self, adapters: Sequence[Optional[str]]) -> Iterator[None]:
+        """在接下来的前向中按行应用适配器
+
+        Args:
+            adapters: 批次中每行使用的适配器名，None表示该行只用基座模型；适配器需已acquire
+        """
+        rows: Dict[str, List[int]] = {}
+        for row, name in enumerate(adapters):
+            if name is not None:
+                rows.setdefault(name, []).append(row)
+        self._groups = [
+            (self._resident[name], torch.tensor(indices, dtype=torch.long))
+            for name, indices in rows.items()
+        ]
+        if self._groups:
+            self.stats['batched_forwards'] += 1
+            if len(self._groups) > 1 or len(rows[next(iter(rows))]) < len(adapters):
+                self.stats['mixed_forwards'] += 1
+        try:
+            yield
+        finally:
+            self._groups = []
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({
+                'adapters': len(self.paths),
+                'max_loaded': self.max_loaded,
+                'resident': list(self._resident),
+                'in_use': {name: count for name, count in self._refcounts.items() if count},
+                'loading': [name for name, future in self._loading.items() if not future.done()],
+                'resident_bytes': sum(adapter.nbytes for adapter in self._resident.values())
+            })
+        lookups = stats['hits'] + stats['loads']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        """移除全部hook并释放常驻与加载中的适配器"""
+        self._loader.shutdown(wait=False, cancel_futures=True)
+        for handle in self._hooks.values():
+            handle.remove()
+        self._hooks.clear()
+        with self._lock:
+            self._resident.clear()
+            self._refcounts.clear()
+            self._loading.clear()
+
+    def _install_hook(self, module_name: str):
+        if module_name in self._hooks:
+            return
+        module = self.model.get_submodule(module_name)
+        self._hooks[module_name] = module.register_forward_hook(
+            lambda module, inputs, output: self._apply(module_name, inputs[0], output)
+        )
+
+    def _apply(self, module_name: str, x: torch.Tensor, output: torch.Tensor) -> Optional[torch.Tensor]:
+        """给各适配器负责的行加上该模块的低秩增量"""
+        for adapter, rows in self._groups:
+            weights = adapter.weights.get(module_name)
+            if weights is None:
+                continue
+            lora_a, lora_b = weights
+            rows = rows.to(x.device)
+            hidden = x.index_select(self.batch_dim, rows).to(lora_a.dtype)
+            delta = (hidden @ lora_a.t()) @ lora_b.t() * adapter.scale
+            output = output.index_add(self.batch_dim, rows, delta.to(output.dtype))
+        return output
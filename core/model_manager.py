@@ -1,19 +1,131 @@
 import os
+import asyncio
+import itertools
+import math
+import threading
+import time
 import yaml
+from contextlib import contextmanager
 import torch
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
 from transformers import AutoModel, AutoTokenizer
-import ollama
-from concurrent.futures import ThreadPoolExecutor
 import logging
 
+from core.admission import DEFAULT_PRIORITY_WEIGHTS, DEFAULT_TENANT, AdmissionQueue, Ticket
+from core.batch_scheduler import BatchScheduler
+from core.cascade import AUTO_MODEL, CascadeRouter, estimate_tokens
+from core.length_predictor import OutputLengthPredictor
+from core.model_worker import ModelWorkerClient, default_socket_dir, worker_authkey
+from core.cpu_inference import prepare_cpu_model
+from core.device_map import (
+    GiB, DeviceMapError, DevicePlan, align_device_map, device_budgets, model_tensor_names, plan_model
+)
+from core.embeddings import DEFAULT_EMBEDDING_MODEL, EMBEDDING_DTYPES, EmbeddingEngine, convert_embeddings
+from core.kv_cache import PagedKVCache
+from core.lora import LoRAManager
+from core.ollama_backend import OllamaBackend
+from core.prefix_cache import PrefixCache
+from core.speculative import SpeculativeScheduler
+from core.response_cache import ResponseCache
+from core.tokenization import TokenizerPool
+from core.semantic_cache import EmbeddingFunction, SemanticCache
+from core.replicas import ModelReplica, ReplicaRouter, plan_replica_devices
+from core.residency import ResidencyManager
+from core.weight_cache import WeightCache
+
+class IncrementalDetokenizer:
+    """逐token增量解码，只输出新增的完整文本片段
+
+    每次只解码上次输出位置附近的一小段token（而不是全部已生成的token），
+    比较加入新token前后的文本得到增量，开销不随输出长度增长。
+    """
+    
+    def __init__(self, tokenizer, pool: Optional[TokenizerPool] = None):
+        self.tokenizer = tokenizer
+        self.pool = pool
+        self.token_ids: List[int] = []
+        # [prefix_offset, read_offset) 为已输出文本末尾的上下文token
+        self.prefix_offset = 0
+        self.read_offset = 0
+    
+    def push(self, token_id: int) -> str:
+        """追加一个token，返回新增的文本（可能为空）"""
+        self.token_ids.append(token_id)
+        prefix_ids, new_ids = self._windows()
+        return self._advance(
+            self.tokenizer.decode(prefix_ids, skip_special_tokens=True),
+            self.tokenizer.decode(new_ids, skip_special_tokens=True)
+        )
+    
+    async def apush(self, token_id: int) -> str:
+        """与push相同，但在分词线程池中解码，不占用事件循环"""
+        self.token_ids.append(token_id)
+        prefix_text, new_text = await self.pool.decode_batch(self._windows())
+        return self._advance(prefix_text, new_text)
+    
+    def _windows(self):
+        return (
+            self.token_ids[self.prefix_offset:self.read_offset],
+            self.token_ids[self.prefix_offset:]
+        )
+    
+    def _advance(self, prefix_text: str, new_text: str) -> str:
+        # 末尾是不完整的多字节字符时先不输出
+        if new_text.endswith("\ufffd") or len(new_text) <= len(prefix_text):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+class ModelState:
+    """模型生命周期状态"""
+    COLD = "cold"
+    LOADING = "loading"
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+
 class ModelManager:
-    def __init__(self, config_path: str = "config/config.yaml"):
+    def __init__(self, config_path: str = "config/config.yaml", out_of_process: Optional[bool] = None):
+        """
+        Args:
+            out_of_process: transformers模型是否运行在独立的工作进程中，None表示按workers.enabled配置
+        """
+        self.config_path = config_path
         self.config = self._load_config(config_path)
+        if out_of_process is None:
+            out_of_process = self.config.get('workers', {}).get('enabled', False)
+        self.out_of_process = out_of_process
+        self.workers: Dict[str, ModelWorkerClient] = {}
         self.models: Dict[str, Dict] = {}
-        self.executors: Dict[str, ThreadPoolExecutor] = {}
+        # LoRA适配器名 -> 基座模型名，请求时适配器名可以作为模型名使用
+        self.adapters: Dict[str, str] = {}
+        self.admission: Dict[str, AdmissionQueue] = {}
+        self.length_predictors: Dict[str, OutputLengthPredictor] = {}
+        self.router = ReplicaRouter(self.config['gpu'].get('routing_policy', 'least_loaded'))
+        # 保护显存预算规划与驱逐，避免并发加载重复占用预算
+        self._residency_lock = threading.Lock()
+        # 请求从确保加载到完成期间固定的模型（引用计数），不可被驱逐；只在事件循环中修改
+        self._pins: Dict[str, int] = {}
         self._init_models()
+        # model为auto时的级联路由，未启用时为None
+        self.cascade = self._create_cascade()
+        self._auto_requests = itertools.count(1)
+        self.residency = self._create_residency_manager()
+        self.ollama = self._create_ollama_backend()
+        self.weight_cache = self._create_weight_cache()
+        self.response_cache = self._create_response_cache()
+        self.semantic_cache: Optional[SemanticCache] = None
+        # 嵌入模型在首次使用时加载，知识库、语义缓存与/embeddings接口共用
+        self.embedding_engine: Optional[EmbeddingEngine] = None
+        self._embedding_lock = threading.Lock()
         self._init_gpu()
+        if self.out_of_process and not self.residency.fits_all():
+            # 每个工作进程只看得到自己的模型，无法跨进程按LRU驱逐，同时常驻会超出显存
+            raise ValueError(
+                "workers.enabled requires all transformers models to fit the GPU memory budget at once: "
+                "models run in separate worker processes and cannot be evicted across processes"
+            )
         
     def _load_config(self, config_path: str) -> dict:
         """加载配置文件"""
@@ -21,7 +133,7 @@ class ModelManager:
             return yaml.safe_load(f)
     
     def _init_gpu(self):
-        """初始化GPU设置"""
+        """初始化GPU设置，没有CUDA时transformers模型以CPU模式运行"""
         if torch.cuda.is_available():
             torch.cuda.set_device(self.config['gpu']['devices'][0])
             for device in self.config['gpu']['devices']:
@@ -29,63 +141,938 @@ class ModelManager:
                     self.config['gpu']['memory_fraction'],
                     device
                 )
+        else:
+            cpu_config = self.config.get('cpu', {})
+            logging.warning(
+                "CUDA is not available, running transformers models on CPU "
+                f"(quantize={cpu_config.get('quantize', 'int8')}, "
+                f"num_threads={cpu_config.get('num_threads') or torch.get_num_threads()})"
+            )
+    
+    def _cpu_config(self, model_name: str) -> dict:
+        """CPU模式配置：全局 cpu 配置与模型的 cpu 配置合并"""
+        cpu_config = {'quantize': 'int8', 'num_threads': None, 'benchmark': False}
+        cpu_config.update(self.config.get('cpu', {}))
+        if model_name in self.models:
+            cpu_config.update(self.models[model_name]['config'].get('cpu', {}))
+        return cpu_config
     
     def _init_models(self):
         """初始化所有配置的模型"""
+        replica_devices = plan_replica_devices(
+            self.config['models']['available'],
+            self.config['gpu']['devices']
+        )
         for model_config in self.config['models']['available']:
             model_name = model_config['name']
             self.models[model_name] = {
                 'config': model_config,
-                'instance': None,
-                'tokenizer': None
+                'tokenizer': None,
+                'tokenizer_pool': None,
+                'state': ModelState.COLD,
+                'error': None,
+                'load_task': None,
+                # 最近一次加载各阶段的耗时（秒）
+                'load_phases': {},
+                # 最近一次热更新的进度（见reload_model）
+                'reload': None,
+                'replicas': [
+                    ModelReplica(model_name, index, device)
+                    for index, device in enumerate(replica_devices[model_name])
+                ]
             }
-            
-            # 为每个模型创建线程池
-            self.executors[model_name] = ThreadPoolExecutor(max_workers=1)
+            self.admission[model_name] = self._create_admission_queue(model_config)
+            self.length_predictors[model_name] = self._create_length_predictor(model_name)
+        
+        for model_config in self.config['models']['available']:
+            for adapter in (model_config.get('lora') or {}).get('adapters', []):
+                if model_config['type'] != 'transformers':
+                    raise ValueError(f"LoRA adapters require a transformers model: {model_config['name']}")
+                if adapter['name'] in self.models or adapter['name'] in self.adapters:
+                    raise ValueError(f"Duplicate model or adapter name: {adapter['name']}")
+                self.adapters[adapter['name']] = model_config['name']
+    
+    def _resolve_model(self, model_name: str) -> Tuple[str, Optional[str]]:
+        """把请求的模型名解析为 (基座模型名, LoRA适配器名)，不是适配器时适配器名为None"""
+        if model_name in self.adapters:
+            return self.adapters[model_name], model_name
+        return model_name, None
+    
+    def _create_cascade(self) -> Optional[CascadeRouter]:
+        """按routing配置创建级联路由，未启用时返回None"""
+        routing_config = self.config.get('routing', {}) or {}
+        if not routing_config.get('enabled', False):
+            return None
+        names = routing_config.get('models') or list(self.models)
+        for name in names:
+            if name not in self.models:
+                raise ValueError(f"Routing model {name} not found")
+        if AUTO_MODEL in self.models or AUTO_MODEL in self.adapters:
+            raise ValueError(f"Model name {AUTO_MODEL} is reserved for cascade routing")
+        escalation_config = routing_config.get('escalation', {}) or {}
+        return CascadeRouter(
+            [self.models[name]['config'] for name in names],
+            min_new_tokens=routing_config.get('min_new_tokens', 64),
+            max_latency=routing_config.get('max_latency'),
+            escalate=escalation_config.get('enabled', True),
+            min_confidence=escalation_config.get('min_confidence', 0.5),
+            log_interval=routing_config.get('log_interval', 100),
+            **({'hedges': escalation_config['hedges']} if 'hedges' in escalation_config else {})
+        )
+    
+    def _create_residency_manager(self) -> ResidencyManager:
+        """按设备显存预算创建常驻管理器
+
+        只管理transformers模型，Ollama模型的显存由Ollama服务自行管理。
+        默认模型固定常驻，其余模型可通过 pinned 配置固定。
+        """
+        residency = ResidencyManager(device_budgets(self.config['gpu']))
+        default_model = self.config['models'].get('default')
+        for model_name, model in self.models.items():
+            model_config = model['config']
+            if model_config['type'] == 'ollama':
+                continue
+            residency.register(
+                model_name,
+                model_config.get('gpu_memory', 0),
+                [replica.device for replica in model['replicas']],
+                pinned=model_config.get('pinned', model_name == default_model)
+            )
+        return residency
+    
+    def _create_weight_cache(self) -> Optional[WeightCache]:
+        """创建本地safetensors权重缓存，未启用时返回None"""
+        cache_config = self.config.get('weight_cache', {})
+        if not cache_config.get('enabled', True):
+            return None
+        return WeightCache(cache_config.get('cache_dir', 'models'))
+    
+    def _create_ollama_backend(self) -> OllamaBackend:
+        """创建所有Ollama模型共享的异步后端，并设置各模型的keep_alive
+
+        固定常驻的模型（默认模型或pinned）使用pinned_keep_alive，一直留在Ollama中；
+        其余模型空闲超过keep_alive后由Ollama释放。
+        """
+        ollama_config = self.config.get('ollama', {})
+        backend = OllamaBackend(
+            host=ollama_config.get('host'),
+            max_connections=ollama_config.get('max_connections', 32),
+            timeout=ollama_config.get('timeout', 300),
+            keep_alive=ollama_config.get('keep_alive', '5m')
+        )
+        default_model = self.config['models'].get('default')
+        for model_name, model in self.models.items():
+            model_config = model['config']
+            if model_config['type'] != 'ollama':
+                continue
+            if 'keep_alive' in model_config:
+                keep_alive = model_config['keep_alive']
+            elif model_config.get('pinned', model_name == default_model):
+                keep_alive = ollama_config.get('pinned_keep_alive', -1)
+            else:
+                keep_alive = backend.default_keep_alive
+            backend.set_keep_alive(model_name, keep_alive)
+        return backend
+    
+    def _worker(self, model_name: str) -> Optional[ModelWorkerClient]:
+        """获取模型工作进程的客户端，模型在本进程中运行时返回None
+
+        Ollama模型本身已运行在Ollama服务进程中，始终在本进程中调用。
+        """
+        if not self.out_of_process or model_name not in self.models:
+            return None
+        if self.models[model_name]['config']['type'] == 'ollama':
+            return None
+        client = self.workers.get(model_name)
+        if client is None:
+            workers_config = self.config.get('workers', {})
+            socket_dir = workers_config.get('socket_dir') or default_socket_dir()
+            client = ModelWorkerClient(
+                model_name,
+                self.config_path,
+                socket_dir=socket_dir,
+                authkey=worker_authkey(socket_dir, workers_config.get('authkey')),
+                start_timeout=workers_config.get('start_timeout', 120),
+                restart_delay=workers_config.get('restart_delay', 1),
+                max_restart_delay=workers_config.get('max_restart_delay', 30)
+            )
+            self.workers[model_name] = client
+        return client
+    
+    def _create_response_cache(self) -> Optional[ResponseCache]:
+        """创建生成结果缓存，未启用时返回None"""
+        cache_config = self.config.get('response_cache', {})
+        if not cache_config.get('enabled', True):
+            return None
+        return ResponseCache(
+            max_entries=cache_config.get('max_entries', 1024),
+            max_bytes=int(cache_config.get('max_memory_mb', 64) * (1 << 20)),
+            ttl=cache_config.get('ttl', 3600),
+            cache_sampled=cache_config.get('cache_sampled', False)
+        )
+    
+    def attach_semantic_cache(self, embedding_function: EmbeddingFunction) -> Optional[SemanticCache]:
+        """按配置启用语义缓存，embedding_function通常是知识库的嵌入函数"""
+        cache_config = self.config.get('semantic_cache', {})
+        if not cache_config.get('enabled', False):
+            return None
+        self.semantic_cache = SemanticCache(
+            embedding_function,
+            threshold=cache_config.get('threshold', 0.92),
+            max_entries=cache_config.get('max_entries', 1000),
+            ttl=cache_config.get('ttl', 3600),
+            cache_sampled=cache_config.get('cache_sampled', False)
+        )
+        return self.semantic_cache
+    
+    def _create_admission_queue(self, model_config: dict) -> AdmissionQueue:
+        """创建模型的有界准入队列
+
+        transformers模型的并发上限为批大小乘以副本数（推测解码逐个执行请求，
+        按副本数），ollama模型使用 ollama.max_concurrency。
+        """
+        scheduler_config = self.config.get('scheduler', {})
+        length_config = scheduler_config.get('length_aware', {}) or {}
+        fair_config = self._fair_queueing_config()
+        if model_config['type'] == 'ollama':
+            default_concurrency = self.config.get('ollama', {}).get('max_concurrency', 4)
+        elif model_config.get('draft_model'):
+            default_concurrency = len(self.models[model_config['name']]['replicas'])
+        else:
+            default_concurrency = (
+                scheduler_config.get('max_batch_size', 8)
+                * len(self.models[model_config['name']]['replicas'])
+            )
+        
+        return AdmissionQueue(
+            model_config['name'],
+            max_concurrency=model_config.get('max_concurrency', default_concurrency),
+            max_queue_depth=scheduler_config.get('max_queue_depth', 64),
+            max_queue_wait=scheduler_config.get('max_queue_wait', 30),
+            priority_weights=fair_config.get('priority_weights', DEFAULT_PRIORITY_WEIGHTS),
+            tenant_weights={
+                tenant['name']: tenant.get('weight', 1.0)
+                for tenant in fair_config.get('tenants', [])
+            },
+            default_priority=fair_config.get('default_priority', 'interactive'),
+            aging_rate=(
+                length_config.get('aging_tokens_per_sec', 20)
+                if length_config.get('enabled', True) else None
+            )
+        )
+    
+    def _create_length_predictor(self, model_name: str) -> OutputLengthPredictor:
+        """创建模型的输出长度预测器（关闭长度感知调度时仍记录误差与延迟，便于与FIFO对比）"""
+        length_config = self.config.get('scheduler', {}).get('length_aware', {}) or {}
+        return OutputLengthPredictor(
+            model_name,
+            history_size=length_config.get('history_size', 1000),
+            prefix_words=length_config.get('prefix_words', 8),
+            log_interval=length_config.get('log_interval', 100)
+        )
+    
+    def _fair_queueing_config(self) -> dict:
+        """获取 security.fair_queueing 配置（优先级权重与租户）"""
+        return self.config.get('security', {}).get('fair_queueing', {}) or {}
+    
+    def resolve_tenant(self, api_key: Optional[str]) -> str:
+        """按API密钥查找租户名，未配置的密钥归入默认租户"""
+        if api_key:
+            for tenant in self._fair_queueing_config().get('tenants', []):
+                if tenant.get('api_key') == api_key:
+                    return tenant['name']
+        return DEFAULT_TENANT
+    
+    def _resolve_priority(self, tenant: Optional[str], priority: Optional[str]) -> Optional[str]:
+        """未指定优先级时使用租户的默认优先级"""
+        if priority:
+            return priority
+        for tenant_config in self._fair_queueing_config().get('tenants', []):
+            if tenant_config['name'] == tenant:
+                return tenant_config.get('default_priority')
+        return None
     
     def load_model(self, model_name: str) -> bool:
-        """加载指定模型"""
+        """同步加载指定模型（不预热）"""
         if model_name not in self.models:
             logging.error(f"Model {model_name} not found in configuration")
             return False
-            
+        if self.is_loaded(model_name):
+            return True
+        
+        self._set_state(model_name, ModelState.LOADING)
+        if (
+            not self._plan_residency(model_name)
+            or not self._reserve_residency(model_name)
+            or not self._load_weights(model_name)
+        ):
+            return False
+        self._set_state(model_name, ModelState.READY)
+        return True
+    
+    def _plan_residency(self, model_name: str) -> bool:
+        """规划未固定设备副本的device_map，把各设备的占用登记到常驻预算，放不下时将模型置为failed状态
+
+        规划需要读取权重文件头（Hub上的模型通过HTTP获取），在线程池（或同步加载的调用线程）中执行；
+        无法规划时副本整体记到一个设备上。
+        """
+        if not self.residency.is_managed(model_name):
+            return True
+        for replica in self.models[model_name]['replicas']:
+            if not self._uses_planned_map(replica):
+                continue
+            try:
+                plan = self.plan_device_map(model_name, replica)
+            except DeviceMapError as e:
+                logging.error(str(e))
+                self._set_state(model_name, ModelState.FAILED, str(e))
+                return False
+            except Exception as e:
+                logging.warning(f"Cannot plan device map for {model_name}: {str(e)}")
+                plan = None
+            split = None
+            if plan is not None:
+                split = {
+                    device: (info['weights'] + info['kv_cache']) / GiB
+                    for device, info in plan.devices.items()
+                    if info['weights'] or info['kv_cache']
+                }
+            with self._residency_lock:
+                self.residency.set_split(model_name, split)
+        return True
+    
+    def _reserve_residency(self, model_name: str) -> bool:
+        """占用模型的显存预算，不足时按LRU驱逐空闲的未固定模型，放不下时将模型置为failed状态
+
+        读取准入队列与请求固定等事件循环中的状态，须在事件循环线程（或同步加载的调用线程）中执行；
+        被驱逐的模型没有进行中的请求，停止其调度器很快。
+        """
+        with self._residency_lock:
+            victims = self.residency.plan_load(model_name, busy=self._busy_models())
+            if victims is None:
+                error = f"Not enough GPU memory budget to load model {model_name}"
+                logging.error(error)
+                self._set_state(model_name, ModelState.FAILED, error)
+                return False
+            for victim in victims:
+                self.unload_model(victim, evicted=True)
+            self.residency.mark_loaded(model_name)
+        return True
+    
+    def _load_weights(self, model_name: str) -> bool:
+        """加载模型权重（需已占用显存预算），失败时将模型置为failed状态"""
         try:
             model_config = self.models[model_name]['config']
+            load_phases = {'replicas': []}
+            self.models[model_name]['load_phases'] = load_phases
             
             if model_config['type'] == 'ollama':
-                # 使用Ollama加载模型
-                self.models[model_name]['instance'] = ollama.Client()
+                # Ollama模型共享异步后端，模型在预热或首个请求时由Ollama加载
+                for replica in self.models[model_name]['replicas']:
+                    replica.instance = self.ollama
             else:
-                # 使用Transformers加载模型
-                self.models[model_name]['tokenizer'] = AutoTokenizer.from_pretrained(
-                    model_name,
-                    trust_remote_code=True
-                )
-                self.models[model_name]['instance'] = AutoModel.from_pretrained(
-                    model_name,
-                    trust_remote_code=True,
-                    device_map="auto"
+                # 使用Transformers加载模型，每个副本固定到各自的设备
+                tokenizer = self._load_tokenizer(model_name)
+                self.models[model_name]['tokenizer'] = tokenizer
+                self.models[model_name]['tokenizer_pool'] = self._create_tokenizer_pool(
+                    model_name, tokenizer
                 )
+                for replica in self.models[model_name]['replicas']:
+                    load_phases['replicas'].append(self._load_replica(
+                        model_name, replica, self.models[model_name]['tokenizer_pool']
+                    ))
             
-            logging.info(f"Successfully loaded model: {model_name}")
+            logging.info(
+                f"Successfully loaded model: {model_name} "
+                f"({len(self.models[model_name]['replicas'])} replicas)"
+            )
             return True
             
         except Exception as e:
             logging.error(f"Error loading model {model_name}: {str(e)}")
+            self.unload_model(model_name)
+            self._set_state(model_name, ModelState.FAILED, str(e))
             return False
     
-    def unload_model(self, model_name: str) -> bool:
+    def _load_tokenizer(self, model_name: str, refresh: bool = False):
+        """加载tokenizer，优先使用本地权重缓存中的副本（refresh时从原始位置加载）"""
+        tokenizer_path = model_name
+        if not refresh and self.weight_cache is not None and self.weight_cache.is_cached(model_name):
+            tokenizer_path = self.weight_cache.path(model_name)
+        return AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+    
+    def _load_replica(
+        self,
+        model_name: str,
+        replica: ModelReplica,
+        tokenizer_pool: TokenizerPool,
+        refresh: bool = False
+    ) -> dict:
+        """加载一个副本的权重（及草稿模型）并启动其调度器，返回各阶段耗时
+
+        Args:
+            refresh: 忽略本地权重缓存，从原始位置重新加载并更新缓存（热更新）
+        """
+        model_config = self.models[model_name]['config']
+        phases = {'replica': replica.index}
+        replica.tokenizer_pool = tokenizer_pool
+        replica.instance = self._prepare_model(
+            model_name,
+            self._load_pretrained(model_name, replica, phases, tokenizer_pool.tokenizer, refresh=refresh),
+            phases
+        )
+        if model_config.get('draft_model'):
+            # 草稿模型与目标模型放在同一设备，需使用相同的tokenizer
+            phases['draft'] = {}
+            replica.draft_instance = self._prepare_model(
+                model_name,
+                self._load_pretrained(
+                    model_config['draft_model']['name'], replica, phases['draft']
+                ),
+                phases['draft']
+            )
+        logging.info(f"Loaded {model_name} replica {replica.index}: {phases}")
+        replica.scheduler = self._create_scheduler(model_name, replica)
+        return phases
+    
+    def _release_replica(self, replica: ModelReplica):
+        """停止副本的调度器并释放其权重"""
+        if replica.scheduler:
+            replica.scheduler.stop()
+            if replica.scheduler.lora is not None:
+                replica.scheduler.lora.close()
+            replica.scheduler = None
+        if replica.instance:
+            del replica.instance
+            replica.instance = None
+        replica.draft_instance = None
+        replica.tokenizer_pool = None
+    
+    def _load_pretrained(
+        self,
+        model_name: str,
+        replica: ModelReplica,
+        phases: dict,
+        tokenizer=None,
+        refresh: bool = False
+    ):
+        """加载transformers模型权重，各阶段耗时写入phases
+
+        已有本地safetensors缓存时以mmap方式直接加载到副本设备；否则（或refresh时）从原始位置加载，
+        并转换到缓存供下次使用。
+        """
+        if not refresh and self.weight_cache is not None and self.weight_cache.is_cached(model_name):
+            phases['source'] = 'cache'
+            device = replica.torch_device
+            if device is None and not torch.cuda.is_available():
+                device = 'cpu'
+            device_map = None
+            if device is None:
+                device_map = self._device_map(model_name, replica, self.weight_cache.path(model_name))
+            return self.weight_cache.load(model_name, device, phases, device_map=device_map)
+        
+        phases['source'] = 'pretrained'
+        start = time.monotonic()
+        model = AutoModel.from_pretrained(
+            model_name,
+            trust_remote_code=True,
+            device_map=self._device_map(model_name, replica, model_name)
+        )
+        phases['read'] = time.monotonic() - start
+        if self.weight_cache is not None:
+            try:
+                phases['convert'] = self.weight_cache.convert(model_name, model, tokenizer)
+            except Exception as e:
+                logging.warning(f"Error converting {model_name} to safetensors cache: {str(e)}")
+        return model
+    
+    def plan_device_map(self, model_name: str, replica: Optional[ModelReplica] = None) -> DevicePlan:
+        """规划模型副本的device_map（不加载权重）
+
+        固定设备的副本只在该设备上规划（检查是否放得下），未固定设备的副本按各设备预算
+        把层切分到 gpu.devices 的所有设备上，并为每个设备上的层预留KV缓存。
+        """
+        model_name, _ = self._resolve_model(model_name)
+        if model_name not in self.models:
+            raise ValueError(f"Model {model_name} not found")
+        if replica is None:
+            replica = self.models[model_name]['replicas'][0]
+        devices = self.config['gpu']['devices'] if replica.device is None else [replica.device]
+        return plan_model(self.config, model_name, devices)
+    
+    def _uses_planned_map(self, replica: ModelReplica) -> bool:
+        """副本是否按规划切分到各GPU（未固定设备、有CUDA且gpu.device_map不为auto）"""
+        return (
+            replica.device is None
+            and torch.cuda.is_available()
+            and self.config['gpu'].get('device_map', 'planned') != 'auto'
+        )
+    
+    def _device_map(self, model_name: str, replica: ModelReplica, path: str) -> Union[str, Dict[str, Union[int, str]]]:
+        """副本加载时使用的device_map
+
+        未固定设备的副本在有CUDA时按规划切分到各GPU（gpu.device_map为auto时交给accelerate）；
+        权重没有safetensors索引等无法规划的情况退回auto，放不下时抛出DeviceMapError。
+        """
+        if not self._uses_planned_map(replica):
+            return replica.device_map
+        try:
+            plan = self.plan_device_map(model_name, replica)
+        except DeviceMapError:
+            raise
+        except Exception as e:
+            logging.warning(f"Cannot plan device map for {model_name}, falling back to auto: {str(e)}")
+            return "auto"
+        logging.info(f"Device map for {model_name} replica {replica.index}:\n{plan.format()}")
+        return align_device_map(plan.device_map, model_tensor_names(path))
+    
+    def _prepare_model(self, model_name: str, model, phases: dict):
+        """没有CUDA时按CPU配置量化模型，并记录量化耗时与解码速度对比"""
+        if torch.cuda.is_available():
+            return model
+        cpu_config = self._cpu_config(model_name)
+        start = time.monotonic()
+        model, phases['cpu'] = prepare_cpu_model(
+            model,
+            quantize=cpu_config['quantize'],
+            num_threads=cpu_config['num_threads'],
+            benchmark=cpu_config['benchmark']
+        )
+        phases['quantize'] = time.monotonic() - start
+        return model
+    
+    async def ensure_loaded(self, model_name: str):
+        """确保模型可用
+
+        冷模型在首次使用时加载并预热；并发的调用方共享同一次加载（single-flight），
+        加载在线程池中执行，不阻塞事件循环。LoRA适配器名对应其基座模型。
+        """
+        model_name, _ = self._resolve_model(model_name)
+        if model_name not in self.models:
+            raise ValueError(f"Model {model_name} not found")
+        worker = self._worker(model_name)
+        if worker is not None:
+            await worker.call('ensure_loaded', model_name)
+            return
+        model = self.models[model_name]
+        if model['state'] == ModelState.READY and self.is_loaded(model_name):
+            self.residency.record_access(model_name, hit=True)
+            return
+        
+        self.residency.record_access(model_name, hit=False)
+        if model['load_task'] is None or model['load_task'].done():
+            model['load_task'] = asyncio.ensure_future(self._load_and_warmup(model_name))
+        await asyncio.shield(model['load_task'])
+    
+    def preload(self, model_names: List[str]) -> List[asyncio.Task]:
+        """在后台加载并预热模型，需在事件循环中调用"""
+        def log_failure(task: asyncio.Task):
+            if not task.cancelled() and task.exception():
+                logging.error(f"Background loading failed: {str(task.exception())}")
+        
+        tasks = []
+        for model_name in model_names:
+            task = asyncio.ensure_future(self.ensure_loaded(model_name))
+            task.add_done_callback(log_failure)
+            tasks.append(task)
+        return tasks
+    
+    async def _load_and_warmup(self, model_name: str):
+        """加载模型权重并执行预热生成"""
+        self._set_state(model_name, ModelState.LOADING)
+        # 在线程池中规划设备切分与加载权重；在事件循环中规划驱逐，与请求的固定、排队互斥
+        loop = asyncio.get_running_loop()
+        loaded = (
+            await loop.run_in_executor(None, self._plan_residency, model_name)
+            and self._reserve_residency(model_name)
+            and await loop.run_in_executor(None, self._load_weights, model_name)
+        )
+        if not loaded:
+            raise RuntimeError(
+                f"Failed to load model {model_name}: {self.models[model_name]['error']}"
+            )
+        
+        self._set_state(model_name, ModelState.WARMING)
+        start = time.monotonic()
+        try:
+            await self._warmup(model_name)
+            self.models[model_name]['load_phases']['warmup'] = time.monotonic() - start
+        except Exception as e:
+            logging.error(f"Error warming up model {model_name}: {str(e)}")
+            self.unload_model(model_name)
+            self._set_state(model_name, ModelState.FAILED, str(e))
+            raise RuntimeError(f"Failed to warm up model {model_name}: {str(e)}")
+        self._set_state(model_name, ModelState.READY)
+    
+    async def _warmup(self, model_name: str, replicas: Optional[List[ModelReplica]] = None):
+        """在每个副本（默认为模型的全部副本）上执行一次短生成，使首个真实请求不承担kernel与显存分配器的初始化开销"""
+        loading_config = self.config.get('loading', {})
+        prompt = loading_config.get('warmup_prompt', 'Hello')
+        warmup_tokens = loading_config.get('warmup_tokens', 8)
+        if warmup_tokens <= 0:
+            return
+        
+        model_config = self.models[model_name]['config']
+        if replicas is None:
+            replicas = self.models[model_name]['replicas']
+        if model_config['type'] == 'ollama':
+            # 副本共享同一个Ollama服务，预热一次即可让模型常驻
+            await self.ollama.generate(model_name, prompt, {'num_predict': warmup_tokens})
+            return
+        
+        async def warmup_replica(replica: ModelReplica):
+            tokenizer_pool = replica.tokenizer_pool
+            input_ids = (
+                await tokenizer_pool.encode(prompt)
+                or [tokenizer_pool.tokenizer.pad_token_id or 0]
+            )
+            await replica.scheduler.generate(input_ids, warmup_tokens, temperature=0)
+        
+        await asyncio.gather(*[warmup_replica(replica) for replica in replicas])
+    
+    async def reload_model(self, model_name: str, rolling: Optional[bool] = None) -> dict:
+        """热更新模型：从原始位置加载新版本权重并切换，期间不中断服务，返回更新进度
+
+        蓝绿更新：显存预算允许两个版本同时常驻时，先加载并预热全部新副本，再一次性切换路由，
+        旧副本上进行中的请求完成（最长loading.drain_timeout秒）后释放旧副本。
+        滚动更新：逐个替换多副本模型的副本；有额外预算时先加载新副本再切换，否则先把旧副本
+        移出路由并排空，再在原设备上加载新副本，其余副本继续服务。
+        rolling为None时预算允许则蓝绿更新，否则多副本模型滚动更新。
+        工作进程模式下转发到模型的工作进程执行。
+        """
+        worker = self._worker(model_name)
+        if worker is not None:
+            return await worker.call('reload_model', model_name, rolling)
+        progress = self._begin_reload(model_name, rolling)
+        await self._run_reload(model_name, progress)
+        return dict(progress)
+    
+    async def start_reload(self, model_name: str, rolling: Optional[bool] = None) -> dict:
+        """在后台开始热更新（见reload_model），立即返回更新进度"""
+        worker = self._worker(model_name)
+        if worker is not None:
+            return await worker.call('start_reload', model_name, rolling)
+        progress = self._begin_reload(model_name, rolling)
+        task = asyncio.ensure_future(self._run_reload(model_name, progress))
+        # 失败已记录在进度中，这里只取出异常避免未处理的警告
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return dict(progress)
+    
+    def get_reload_status(self, model_name: str) -> Optional[dict]:
+        """获取模型最近一次热更新的进度，没有进行过热更新时返回None"""
+        if model_name not in self.models:
+            return None
+        worker = self.workers.get(model_name)
+        if worker is not None and worker.connected:
+            return worker.call_sync('get_reload_status', model_name, timeout=5)
+        progress = self.models[model_name]['reload']
+        return dict(progress) if progress is not None else None
+    
+    def _reloading(self, model_name: str) -> bool:
+        progress = self.models[model_name]['reload']
+        return progress is not None and progress['phase'] not in ('done', 'failed')
+    
+    def _begin_reload(self, model_name: str, rolling: Optional[bool]) -> dict:
+        """检查能否热更新并选择方式，为蓝绿更新预先占用新版本的显存预算"""
+        if model_name not in self.models:
+            raise ValueError(f"Model {model_name} not found")
+        model = self.models[model_name]
+        if model['config']['type'] != 'transformers':
+            raise ValueError(f"Hot reload is only supported for transformers models: {model_name}")
+        if model['state'] != ModelState.READY or not self.is_loaded(model_name):
+            raise RuntimeError(f"Model {model_name} is not loaded")
+        if self._reloading(model_name):
+            raise RuntimeError(f"Model {model_name} is already being reloaded")
+        
+        replicas = model['replicas']
+        reserved = False
+        if not rolling:
+            reserved = self.residency.reserve(
+                ('reload', model_name), model_name, [replica.device for replica in replicas]
+            )
+            if not reserved and (rolling is False or len(replicas) == 1):
+                raise RuntimeError(
+                    f"Not enough GPU memory budget to load {model_name} alongside the running version"
+                )
+        progress = {
+            'mode': 'blue_green' if reserved else 'rolling',
+            'phase': 'loading',
+            'replicas': len(replicas),
+            'replaced': 0,
+            'current_replica': None,
+            'started_at': time.time(),
+            'finished_at': None,
+            'error': None,
+            'load_phases': []
+        }
+        model['reload'] = progress
+        logging.info(f"Reloading {model_name} ({progress['mode']})")
+        return progress
+    
+    async def _run_reload(self, model_name: str, progress: dict):
+        """执行热更新，完成后切换模型级的tokenizer并释放旧版本"""
+        model = self.models[model_name]
+        old_pool = model['tokenizer_pool']
+        new_pool = None
+        try:
+            tokenizer = await asyncio.get_running_loop().run_in_executor(
+                None, self._load_tokenizer, model_name, True
+            )
+            new_pool = self._create_tokenizer_pool(model_name, tokenizer)
+            if progress['mode'] == 'blue_green':
+                await self._reload_blue_green(model_name, progress, new_pool)
+            else:
+                await self._reload_rolling(model_name, progress, new_pool)
+        except BaseException as e:
+            self.residency.release(('reload', model_name))
+            if new_pool is not None and all(r.tokenizer_pool is not new_pool for r in model['replicas']):
+                new_pool.stop()
+            progress.update(phase='failed', error=str(e) or type(e).__name__, finished_at=time.time())
+            logging.error(f"Reload of {model_name} failed: {progress['error']}")
+            raise
+        
+        model['tokenizer'], model['tokenizer_pool'] = tokenizer, new_pool
+        old_pool.stop()
+        # 旧版本生成的缓存结果不再有效（缓存键不含模型版本，直接清空）
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        if self.semantic_cache is not None:
+            for name in [model_name] + [a for a, base in self.adapters.items() if base == model_name]:
+                self.semantic_cache.clear(name)
+        progress.update(phase='done', current_replica=None, finished_at=time.time())
+        logging.info(
+            f"Reloaded {model_name} ({progress['mode']}) in "
+            f"{progress['finished_at'] - progress['started_at']:.2f}s"
+        )
+    
+    async def _reload_blue_green(self, model_name: str, progress: dict, tokenizer_pool: TokenizerPool):
+        """加载并预热全部新副本后一次性切换路由，再排空并释放旧副本"""
+        loop = asyncio.get_running_loop()
+        model = self.models[model_name]
+        old = list(model['replicas'])
+        new = [ModelReplica(model_name, replica.index, replica.device) for replica in old]
+        try:
+            for index, replica in enumerate(new):
+                progress['current_replica'] = replica.index
+                # 第一个副本从原始位置加载并更新本地权重缓存，其余副本从缓存加载
+                progress['load_phases'].append(await loop.run_in_executor(
+                    None, self._load_replica, model_name, replica, tokenizer_pool, index == 0
+                ))
+            progress.update(phase='warming', current_replica=None)
+            await self._warmup(model_name, new)
+        except BaseException:
+            for replica in new:
+                self._release_replica(replica)
+            raise
+        
+        # 路由在事件循环线程中选择副本，替换列表即原子切换
+        model['replicas'] = new
+        progress.update(phase='draining', replaced=len(new))
+        await self._drain(old)
+        self.residency.release(('reload', model_name))
+    
+    async def _reload_rolling(self, model_name: str, progress: dict, tokenizer_pool: TokenizerPool):
+        """逐个替换副本，每次只有一个副本处于更新中"""
+        loop = asyncio.get_running_loop()
+        model = self.models[model_name]
+        key = ('reload', model_name)
+        for position, old in enumerate(list(model['replicas'])):
+            progress['current_replica'] = old.index
+            new = ModelReplica(model_name, old.index, old.device)
+            surge = self.residency.reserve(key, model_name, [old.device])
+            if not surge:
+                if not any(r.is_loaded for r in model['replicas'] if r is not old):
+                    raise RuntimeError(
+                        f"Not enough GPU memory budget to replace the only loaded replica of {model_name}"
+                    )
+                # 没有额外预算：先用未加载的占位副本把旧副本移出路由，排空后在原设备上加载
+                progress['phase'] = 'draining'
+                placeholder = ModelReplica(model_name, old.index, old.device)
+                model['replicas'] = [placeholder if r is old else r for r in model['replicas']]
+                await self._drain([old])
+                old = placeholder
+            try:
+                progress['phase'] = 'loading'
+                progress['load_phases'].append(await loop.run_in_executor(
+                    None, self._load_replica, model_name, new, tokenizer_pool, position == 0
+                ))
+                progress['phase'] = 'warming'
+                await self._warmup(model_name, [new])
+            except BaseException:
+                self._release_replica(new)
+                raise
+            
+            model['replicas'] = [new if r is old else r for r in model['replicas']]
+            progress['replaced'] += 1
+            if surge:
+                progress['phase'] = 'draining'
+                await self._drain([old])
+                self.residency.release(key)
+    
+    async def _drain(self, replicas: List[ModelReplica]):
+        """等待已移出路由的副本完成进行中的请求后释放，超过loading.drain_timeout秒时直接停止"""
+        timeout = self.config.get('loading', {}).get('drain_timeout', 60)
+        deadline = time.monotonic() + timeout
+        while any(replica.in_flight for replica in replicas) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        remaining = sum(replica.in_flight for replica in replicas)
+        if remaining:
+            logging.warning(f"Stopping {remaining} requests still in flight after draining for {timeout}s")
+        for replica in replicas:
+            self._release_replica(replica)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    def _set_state(self, model_name: str, state: str, error: Optional[str] = None):
+        """更新模型状态"""
+        self.models[model_name]['state'] = state
+        self.models[model_name]['error'] = error
+        logging.info(f"Model {model_name} state: {state}")
+    
+    def is_loaded(self, model_name: str) -> bool:
+        """模型是否已有加载完成的副本"""
+        return any(replica.is_loaded for replica in self.models[model_name]['replicas'])
+    
+    def _busy_models(self) -> set:
+        """有请求执行、排队、被请求固定或正在加载的模型，不可被驱逐"""
+        return {
+            model_name for model_name, admission in self.admission.items()
+            if admission.in_flight
+            or admission.queue_depth
+            or self._pins.get(model_name)
+            or self.models[model_name]['state'] in (ModelState.LOADING, ModelState.WARMING)
+            or self._reloading(model_name)
+        }
+    
+    @contextmanager
+    def _pin(self, model_name: str):
+        """请求期间固定模型：确保加载返回后、进入准入队列与选择副本前，不会被其他模型的加载驱逐"""
+        self._pins[model_name] = self._pins.get(model_name, 0) + 1
+        try:
+            yield
+        finally:
+            self._pins[model_name] -= 1
+            if not self._pins[model_name]:
+                del self._pins[model_name]
+    
+    def _create_scheduler(self, model_name: str, replica: ModelReplica) -> BatchScheduler:
+        """为transformers模型副本创建并启动调度器：配置了草稿模型时使用推测解码，否则连续批处理"""
+        scheduler_config = self.config.get('scheduler', {})
+        tokenizer = replica.tokenizer_pool.tokenizer
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id or 0
+        
+        num_threads = None
+        if not torch.cuda.is_available():
+            num_threads = self._cpu_config(model_name)['num_threads']
+        
+        lora = self._create_lora(model_name, replica.instance)
+        if replica.draft_instance is not None:
+            if lora is not None:
+                raise ValueError(f"LoRA adapters are not supported with draft_model: {model_name}")
+            scheduler = SpeculativeScheduler(
+                replica.instance,
+                replica.draft_instance,
+                lookahead=self.models[model_name]['config']['draft_model'].get('lookahead', 4),
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=pad_token_id,
+                name=f"{model_name}-{replica.index}",
+                num_threads=num_threads
+            )
+        else:
+            kv_cache = self._create_kv_cache()
+            scheduler = BatchScheduler(
+                replica.instance,
+                max_batch_size=scheduler_config.get('max_batch_size', 8),
+                max_wait_ms=scheduler_config.get('max_wait_ms', 10),
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=pad_token_id,
+                name=f"{model_name}-{replica.index}",
+                prefix_cache=self._create_prefix_cache(
+                    kv_cache.block_size if kv_cache is not None else None
+                ),
+                num_threads=num_threads,
+                kv_cache=kv_cache,
+                lora=lora,
+                prefill_chunk_size=scheduler_config.get('prefill_chunk_size', 512)
+            )
+        scheduler.start()
+        return scheduler
+    
+    def _create_tokenizer_pool(self, model_name: str, tokenizer) -> TokenizerPool:
+        """创建并启动模型的分词线程池（分词与反分词不在事件循环中执行）"""
+        tokenization_config = self.config.get('tokenization', {})
+        cache_max_mb = tokenization_config.get('cache_max_mb', 64)
+        pool = TokenizerPool(
+            tokenizer,
+            name=model_name,
+            num_workers=tokenization_config.get('workers', 1),
+            max_batch_size=tokenization_config.get('max_batch_size', 64),
+            max_wait_ms=tokenization_config.get('max_wait_ms', 1.0),
+            cache_entries=tokenization_config.get('cache_entries', 4096),
+            cache_max_bytes=cache_max_mb * 1024 * 1024 if cache_max_mb else None
+        )
+        pool.start()
+        return pool
+    
+    def _create_prefix_cache(self, block_size: Optional[int] = None) -> Optional[PrefixCache]:
+        """创建副本的前缀KV缓存，未启用时返回None
+
+        Args:
+            block_size: 启用分页KV缓存时须与其块大小一致（前缀缓存直接共享KV块）
+        """
+        cache_config = self.config.get('scheduler', {}).get('prefix_cache', {})
+        if not cache_config.get('enabled', True):
+            return None
+        return PrefixCache(
+            block_size=block_size or cache_config.get('block_size', 16),
+            max_bytes=int(cache_config.get('max_memory_mb', 512) * (1 << 20))
+        )
+
+    def _create_lora(self, model_name: str, model) -> Optional[LoRAManager]:
+        """为副本创建LoRA适配器管理器，模型未配置适配器时返回None"""
+        lora_config = self.models[model_name]['config'].get('lora') or {}
+        adapters = {adapter['name']: adapter['path'] for adapter in lora_config.get('adapters', [])}
+        if not adapters:
+            return None
+        return LoRAManager(model, adapters, max_loaded=lora_config.get('max_loaded', 4))
+
+    def _create_kv_cache(self) -> Optional[PagedKVCache]:
+        """创建副本的分页KV缓存，未启用时返回None（批次使用连续的KV张量）"""
+        cache_config = self.config.get('scheduler', {}).get('kv_cache', {}) or {}
+        if not cache_config.get('enabled', False):
+            return None
+        return PagedKVCache(
+            block_size=cache_config.get('block_size', 16),
+            max_bytes=int(cache_config.get('max_memory_mb', 1024) * (1 << 20)),
+            swap_max_bytes=int(cache_config.get('swap_max_mb', 1024) * (1 << 20))
+        )
+    
+    def unload_model(self, model_name: str, evicted: bool = False) -> bool:
         """卸载指定模型"""
         if model_name not in self.models:
             return False
+        worker = self.workers.get(model_name)
+        if worker is not None and worker.connected:
+            return worker.call_sync('unload_model', model_name, evicted)
             
         try:
-            if self.models[model_name]['instance']:
-                del self.models[model_name]['instance']
-                self.models[model_name]['instance'] = None
+            model_config = self.models[model_name]['config']
+            if model_config['type'] == 'ollama' and self.is_loaded(model_name):
+                self.ollama.release(model_name)
+            for replica in self.models[model_name]['replicas']:
+                self._release_replica(replica)
+            if self.models[model_name]['tokenizer_pool']:
+                self.models[model_name]['tokenizer_pool'].stop()
+                self.models[model_name]['tokenizer_pool'] = None
             if self.models[model_name]['tokenizer']:
                 del self.models[model_name]['tokenizer']
                 self.models[model_name]['tokenizer'] = None
+            self.residency.mark_unloaded(model_name, evicted=evicted)
+            self._set_state(model_name, ModelState.COLD)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
             return True
         except Exception as e:
             logging.error(f"Error unloading model {model_name}: {str(e)}")
@@ -99,70 +1086,605 @@ class ModelManager:
         temperature: Optional[float] = None,
         top_p: Optional[float] = None,
         use_knowledge: bool = False,
-        knowledge_context: Optional[str] = None
+        knowledge_context: Optional[str] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        usage: Optional[dict] = None
+    ) -> str:
+        """生成文本响应，确定性请求优先从结果缓存返回
+
+        tenant与priority决定请求在准入队列中的加权公平排队（见AdmissionQueue），
+        同一流内按预测的输出长度短者优先。
+        model_name为LoRA适配器名时，由基座模型加载该适配器生成，与其他适配器的请求合批；
+        为auto且启用了routing时由级联路由选择模型（见CascadeRouter）。
+        工作进程模式下整个请求（含缓存与排队）转发到模型的工作进程处理。
+
+        Args:
+            usage: 若提供，写入实际使用的模型（model）、处理的token数（served_tokens）、
+                是否命中缓存（cached），以及transformers模型回答的平均token概率（confidence）
+        """
+        if model_name == AUTO_MODEL and self.cascade is not None:
+            return await self._generate_auto(
+                prompt, max_length, temperature, top_p, use_knowledge, knowledge_context,
+                tenant, priority, usage
+            )
+        if usage is None:
+            usage = {}
+        usage['model'] = model_name
+        requested = model_name
+        model_name, adapter = self._resolve_model(model_name)
+        worker = self._worker(model_name)
+        if worker is not None:
+            return await worker.call(
+                'generate', requested, prompt, max_length, temperature, top_p,
+                use_knowledge, knowledge_context, tenant, priority, usage=usage
+            )
+        
+        question = prompt
+        model_config, prompt, max_length, temperature, top_p = self._prepare_generation(
+            model_name, prompt, max_length, temperature, top_p,
+            use_knowledge, knowledge_context
+        )
+        
+        cache_key = None
+        if self.response_cache is not None and self.response_cache.is_cacheable(temperature):
+            cache_key = ResponseCache.make_key(
+                requested, question, max_length, temperature, top_p,
+                knowledge_context if use_knowledge else None
+            )
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                usage.update(cached=True, served_tokens=0)
+                return response
+        
+        # 语义缓存只用于不带知识库上下文的请求：上下文不同时答案可能不同，
+        # 而不同问题配上相同的检索结果时，整段提示词的嵌入几乎相同
+        embedding = None
+        # 生成参数不同的条目不互相命中（如max_length较小时的截断回答）；适配器名即requested
+        semantic_params = (max_length, temperature, top_p)
+        if (
+            self.semantic_cache is not None
+            and not use_knowledge
+            and self.semantic_cache.is_cacheable(temperature)
+        ):
+            embedding = await asyncio.get_running_loop().run_in_executor(
+                None, self.semantic_cache.embed, question
+            )
+            response = self.semantic_cache.lookup(requested, question, embedding, semantic_params)
+            if response is not None:
+                usage.update(cached=True, served_tokens=0)
+                return response
+        
+        predicted = self.length_predictors[model_name].predict(question, max_length)
+        start = time.monotonic()
+        try:
+            with self._pin(model_name):
+                await self.ensure_loaded(model_name)
+                async with self._admit(model_name, tenant, priority, max_length, predicted) as ticket:
+                    with self._route(model_name) as replica:
+                        response = await self._generate_on_replica(
+                            replica, model_config, prompt, max_length, temperature, top_p, ticket, adapter,
+                            usage=usage
+                        )
+            self._record_length(model_name, question, predicted, ticket, start)
+            usage.update(cached=False, served_tokens=ticket.served_tokens)
+            if 'mean_logprob' in usage:
+                usage['confidence'] = math.exp(usage['mean_logprob'])
+            if cache_key is not None:
+                self.response_cache.set(cache_key, response)
+            if embedding is not None:
+                self.semantic_cache.store(requested, question, response, embedding, semantic_params)
+            return response
+                
+        except asyncio.CancelledError:
+            logging.info(f"Generation for {model_name} cancelled by caller")
+            raise
+        except Exception as e:
+            logging.error(f"Error generating response: {str(e)}")
+            raise
+    
+    async def _generate_on_replica(
+        self,
+        replica: ModelReplica,
+        model_config: dict,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        ticket: Optional[Ticket] = None,
+        adapter: Optional[str] = None,
+        usage: Optional[dict] = None
+    ) -> str:
+        """在指定副本上生成完整响应，并在ticket中记录实际处理与生成的token数
+
+        usage中写入Ollama返回的token数，或transformers模型生成token的平均对数概率。
+        """
+        model_name = model_config['name']
+        if usage is None:
+            usage = {}
+        if model_config['type'] == 'ollama':
+            response = await replica.instance.generate(
+                model_name,
+                prompt,
+                self._ollama_options(max_length, temperature, top_p),
+                usage=usage
+            )
+            if ticket is not None and usage.get('eval_count') is not None:
+                ticket.output_tokens = usage['eval_count']
+                ticket.served_tokens = (usage.get('prompt_eval_count') or 0) + usage['eval_count']
+            return response
+        
+        # 使用Transformers生成，由连续批处理调度器与并发请求合批解码
+        tokenizer_pool = replica.tokenizer_pool
+        input_ids = await self._encode_prompt(tokenizer_pool, prompt, max_length)
+        if ticket is not None:
+            # 请求被取消时至少计入prefill的token数
+            ticket.served_tokens = len(input_ids)
+        
+        output_ids = await replica.scheduler.generate(
+            input_ids,
+            max_new_tokens=max_length - len(input_ids),
+            temperature=temperature,
+            top_p=top_p,
+            adapter=adapter,
+            usage=usage
+        )
+        if ticket is not None:
+            ticket.served_tokens = len(input_ids) + len(output_ids)
+            ticket.output_tokens = len(output_ids)
+        
+        return await tokenizer_pool.decode(output_ids, skip_special_tokens=True)
+    
+    async def generate_stream(
+        self,
+        model_name: str,
+        prompt: str,
+        max_length: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        use_knowledge: bool = False,
+        knowledge_context: Optional[str] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        usage: Optional[dict] = None
+    ) -> AsyncIterator[str]:
+        """流式生成文本响应，逐段产出新增文本
+
+        model_name为auto时由级联路由选择模型（已产出的内容无法撤回，不做升级）；
+        usage中写入实际使用的模型与结束时处理的token数。
+        """
+        if usage is None:
+            usage = {}
+        if model_name == AUTO_MODEL and self.cascade is not None:
+            request_id = next(self._auto_requests)
+            model_name, reason = self._select_model(
+                estimate_tokens(self._build_prompt(prompt, use_knowledge, knowledge_context)), max_length
+            )
+            start = time.monotonic()
+            deltas = self.generate_stream(
+                model_name, prompt, max_length, temperature, top_p,
+                use_knowledge, knowledge_context, tenant, priority, usage
+            )
+            try:
+                async for delta in deltas:
+                    yield delta
+            finally:
+                await deltas.aclose()
+            self.cascade.record(
+                request_id, model_name, reason, time.monotonic() - start, usage.get('served_tokens') or 0
+            )
+            return
+        usage['model'] = model_name
+        requested = model_name
+        model_name, adapter = self._resolve_model(model_name)
+        worker = self._worker(model_name)
+        if worker is not None:
+            deltas = worker.stream(
+                'generate_stream', requested, prompt, max_length, temperature, top_p,
+                use_knowledge, knowledge_context, tenant, priority, usage=usage
+            )
+            try:
+                async for delta in deltas:
+                    yield delta
+            finally:
+                await deltas.aclose()
+            return
+        
+        question = prompt
+        model_config, prompt, max_length, temperature, top_p = self._prepare_generation(
+            model_name, prompt, max_length, temperature, top_p,
+            use_knowledge, knowledge_context
+        )
+        
+        predicted = self.length_predictors[model_name].predict(question, max_length)
+        start = time.monotonic()
+        try:
+            with self._pin(model_name):
+                await self.ensure_loaded(model_name)
+                async with self._admit(model_name, tenant, priority, max_length, predicted) as ticket:
+                    ticket.output_tokens = 0
+                    with self._route(model_name) as replica:
+                        if model_config['type'] == 'ollama':
+                            # Ollama流式响应每段约为一个token
+                            ticket.served_tokens = 0
+                            deltas = replica.instance.stream(
+                                model_name,
+                                prompt,
+                                self._ollama_options(max_length, temperature, top_p)
+                            )
+                            try:
+                                async for delta in deltas:
+                                    ticket.served_tokens += 1
+                                    ticket.output_tokens += 1
+                                    yield delta
+                            finally:
+                                # 调用方提前结束时立即关闭内层流，而不是等垃圾回收
+                                await deltas.aclose()
+                        else:
+                            tokenizer_pool = replica.tokenizer_pool
+                            input_ids = await self._encode_prompt(tokenizer_pool, prompt, max_length)
+                            detokenizer = IncrementalDetokenizer(tokenizer_pool.tokenizer, tokenizer_pool)
+                            ticket.served_tokens = len(input_ids)
+                        
+                            tokens = replica.scheduler.stream(
+                                input_ids,
+                                max_new_tokens=max_length - len(input_ids),
+                                temperature=temperature,
+                                top_p=top_p,
+                                adapter=adapter
+                            )
+                            try:
+                                async for token_id in tokens:
+                                    ticket.served_tokens += 1
+                                    ticket.output_tokens += 1
+                                    delta = await detokenizer.apush(token_id)
+                                    if delta:
+                                        yield delta
+                            finally:
+                                await tokens.aclose()
+            self._record_length(model_name, question, predicted, ticket, start)
+            usage['served_tokens'] = ticket.served_tokens
+                        
+        except (asyncio.CancelledError, GeneratorExit):
+            logging.info(f"Streaming response from {model_name} cancelled by caller")
+            raise
+        except Exception as e:
+            logging.error(f"Error streaming response: {str(e)}")
+            raise
+    
+    async def _generate_auto(
+        self,
+        prompt: str,
+        max_length: Optional[int],
+        temperature: Optional[float],
+        top_p: Optional[float],
+        use_knowledge: bool,
+        knowledge_context: Optional[str],
+        tenant: Optional[str],
+        priority: Optional[str],
+        usage: Optional[dict]
     ) -> str:
-        """生成文本响应"""
+        """由级联路由选择最便宜的合格模型生成，回答置信度低时升级到下一个更大的模型"""
+        request_id = next(self._auto_requests)
+        prompt_tokens = estimate_tokens(self._build_prompt(prompt, use_knowledge, knowledge_context))
+        model_name, reason = self._select_model(prompt_tokens, max_length)
+        escalated_from = None
+        while True:
+            attempt = {}
+            start = time.monotonic()
+            response = await self.generate(
+                model_name, prompt, max_length, temperature, top_p,
+                use_knowledge, knowledge_context, tenant, priority, usage=attempt
+            )
+            confidence = attempt.get('confidence')
+            self.cascade.record(
+                request_id, model_name, reason, time.monotonic() - start,
+                attempt.get('served_tokens') or 0, escalated_from=escalated_from, confidence=confidence
+            )
+            if not self.cascade.escalate or self.cascade.is_confident(response, confidence):
+                break
+            target = self.cascade.escalation_target(model_name, prompt_tokens, max_length)
+            if target is None:
+                break
+            reason = "low confidence" if confidence is not None else "uncertain answer"
+            escalated_from, model_name = model_name, target
+        if usage is not None:
+            usage.update(attempt)
+        return response
+    
+    def _select_model(self, prompt_tokens: int, max_length: Optional[int]) -> Tuple[str, str]:
+        """按估计的提示词token数（含知识库上下文）与各模型的排队情况为auto请求选择模型"""
+        load = {
+            name: (self.admission[name].queue_depth, self.admission[name].max_concurrency)
+            for name in self.cascade.models
+        }
+        return self.cascade.select(prompt_tokens, max_length, load)
+    
+    def _admit(
+        self,
+        model_name: str,
+        tenant: Optional[str],
+        priority: Optional[str],
+        max_length: int,
+        predicted_tokens: Optional[float] = None
+    ):
+        """按租户与优先级进入模型的准入队列，以max_length作为预估的token开销
+
+        生成结束后按实际token数结算（Ollama未返回token数时按预估开销计）。
+        """
+        return self.admission[model_name].slot(
+            tenant,
+            self._resolve_priority(tenant, priority),
+            cost=max_length,
+            predicted_tokens=predicted_tokens
+        )
+    
+    def _record_length(
+        self,
+        model_name: str,
+        question: str,
+        predicted: float,
+        ticket: Ticket,
+        start: float
+    ):
+        """记录完成请求的实际输出长度与端到端延迟，更新长度预测历史"""
+        if ticket.output_tokens is not None:
+            self.length_predictors[model_name].record(
+                question, predicted, ticket.output_tokens, time.monotonic() - start
+            )
+    
+    def _route(self, model_name: str):
+        """选择负载最低的已加载副本，并在请求期间计入其负载"""
+        replicas = self.models[model_name]['replicas']
+        if not any(replica.is_loaded for replica in replicas):
+            raise RuntimeError(f"Model {model_name} is not loaded")
+        return self.router.select(replicas).track()
+    
+    def _prepare_generation(
+        self,
+        model_name: str,
+        prompt: str,
+        max_length: Optional[int],
+        temperature: Optional[float],
+        top_p: Optional[float],
+        use_knowledge: bool,
+        knowledge_context: Optional[str]
+    ):
+        """校验模型并合并生成参数，返回 (模型配置, 提示词, max_length, temperature, top_p)"""
         if model_name not in self.models:
             raise ValueError(f"Model {model_name} not found")
             
         model_config = self.models[model_name]['config']
         
-        # 使用配置或传入的参数
+        # 使用配置或传入的参数（temperature为0表示贪心解码，不能被配置覆盖）
         max_length = max_length or model_config['max_length']
-        temperature = temperature or model_config['temperature']
+        if temperature is None:
+            temperature = model_config['temperature']
         top_p = top_p or model_config['top_p']
         
-        # 构建完整提示词
+        prompt = self._build_prompt(prompt, use_knowledge, knowledge_context)
+        return model_config, prompt, max_length, temperature, top_p
+    
+    @staticmethod
+    def _build_prompt(prompt: str, use_knowledge: bool, knowledge_context: Optional[str]) -> str:
+        """构建完整提示词，带知识库上下文时把上下文放在问题之前"""
         if use_knowledge and knowledge_context:
-            prompt = f"Context: {knowledge_context}\n\nQuestion: {prompt}"
-        
-        try:
-            if model_config['type'] == 'ollama':
-                # 使用Ollama生成
-                response = await self.executors[model_name].submit(
-                    self.models[model_name]['instance'].generate,
-                    model=model_name,
-                    prompt=prompt,
-                    max_tokens=max_length,
-                    temperature=temperature,
-                    top_p=top_p
-                )
-                return response['response']
-            else:
-                # 使用Transformers生成
-                inputs = self.models[model_name]['tokenizer'](
-                    prompt,
-                    return_tensors="pt"
-                ).to(self.models[model_name]['instance'].device)
-                
-                outputs = await self.executors[model_name].submit(
-                    self.models[model_name]['instance'].generate,
-                    **inputs,
-                    max_length=max_length,
-                    temperature=temperature,
-                    top_p=top_p
-                )
-                
-                return self.models[model_name]['tokenizer'].decode(
-                    outputs[0],
-                    skip_special_tokens=True
-                )
-                
-        except Exception as e:
-            logging.error(f"Error generating response: {str(e)}")
-            raise
+            return f"Context: {knowledge_context}\n\nQuestion: {prompt}"
+        return prompt
+    
+    async def _encode_prompt(self, tokenizer_pool: TokenizerPool, prompt: str, max_length: int) -> List[int]:
+        """在分词线程池中编码提示词并检查长度"""
+        input_ids = await tokenizer_pool.encode(prompt)
+        if len(input_ids) >= max_length:
+            raise ValueError(
+                f"Prompt length {len(input_ids)} exceeds max_length {max_length}"
+            )
+        return input_ids
+    
+    def _ollama_options(self, max_length: int, temperature: float, top_p: float) -> dict:
+        """将生成参数转换为Ollama的options"""
+        return {
+            'num_predict': max_length,
+            'temperature': temperature,
+            'top_p': top_p
+        }
+    
+    async def count_tokens(self, model_name: str, text: str) -> int:
+        """统计文本在指定模型下的token数（按文本哈希缓存），模型需已加载"""
+        model_name, _ = self._resolve_model(model_name)
+        worker = self._worker(model_name)
+        if worker is not None:
+            return await worker.call('count_tokens', model_name, text)
+        with self._pin(model_name):
+            await self.ensure_loaded(model_name)
+            tokenizer_pool = self.models[model_name]['tokenizer_pool']
+            if tokenizer_pool is None:
+                raise ValueError(f"Model {model_name} has no local tokenizer")
+            return await tokenizer_pool.count_tokens(text)
+    
+    def _embedding_config(self) -> dict:
+        return self.config.get('embeddings', {})
+
+    def get_embedding_engine(self) -> EmbeddingEngine:
+        """获取嵌入引擎，首次调用时加载嵌入模型（阻塞）"""
+        with self._embedding_lock:
+            if self.embedding_engine is None:
+                self.embedding_engine = self._create_embedding_engine()
+            return self.embedding_engine
+
+    def _create_embedding_engine(self) -> EmbeddingEngine:
+        """加载嵌入模型并启动合批线程"""
+        embedding_config = self._embedding_config()
+        model_path = embedding_config.get('model', DEFAULT_EMBEDDING_MODEL)
+        device = embedding_config.get('device') or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+        start = time.perf_counter()
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModel.from_pretrained(
+            model_path,
+            torch_dtype=torch.float16 if device.startswith('cuda') else torch.float32
+        ).to(device)
+        model.eval()
+        engine = EmbeddingEngine(
+            model,
+            tokenizer,
+            name=model_path,
+            max_batch_size=embedding_config.get('max_batch_size', 64),
+            max_batch_tokens=embedding_config.get('max_batch_tokens', 8192),
+            max_wait_ms=embedding_config.get('max_wait_ms', 2.0),
+            max_length=embedding_config.get('max_length', 256)
+        )
+        engine.start()
+        logging.info(
+            f"Loaded embedding model {model_path} on {device} in {time.perf_counter() - start:.2f}s"
+        )
+        return engine
+
+    def _embedding_dtype(self, dtype: Optional[str]) -> str:
+        dtype = dtype or self._embedding_config().get('dtype', 'float32')
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+        return dtype
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """同步计算float32文本向量，供知识库（Chroma）与语义缓存使用"""
+        return self.get_embedding_engine().embed(texts)
+
+    async def embeddings(
+        self,
+        input_texts: Union[str, Sequence[str]],
+        model_id: Optional[str] = None,
+        dtype: Optional[str] = None
+    ) -> dict:
+        """计算文本向量，并发调用在嵌入引擎中合批
+
+        Args:
+            input_texts: 单条文本或文本列表
+            model_id: 嵌入模型名，None表示使用配置的嵌入模型
+            dtype: 输出精度（float32/float16/int8），None表示使用配置的默认值
+        """
+        model_path = self._embedding_config().get('model', DEFAULT_EMBEDDING_MODEL)
+        if model_id is not None and model_id != model_path:
+            raise ValueError(f"Embedding model {model_id} not found")
+        dtype = self._embedding_dtype(dtype)
+        texts = [input_texts] if isinstance(input_texts, str) else list(input_texts)
+
+        engine = self.embedding_engine
+        if engine is None:
+            engine = await asyncio.get_running_loop().run_in_executor(None, self.get_embedding_engine)
+        vectors, num_tokens = await asyncio.wrap_future(engine.submit(texts))
+        return {
+            'object': 'list',
+            'model': model_path,
+            'dtype': dtype,
+            'data': [
+                {'object': 'embedding', 'index': index, 'embedding': embedding}
+                for index, embedding in enumerate(convert_embeddings(vectors, dtype))
+            ],
+            'usage': {'prompt_tokens': num_tokens, 'total_tokens': num_tokens}
+        }
+
+    def get_embedding_stats(self) -> dict:
+        """获取嵌入引擎的合批与吞吐统计（texts/sec）"""
+        engine = self.embedding_engine
+        stats = {
+            'model': self._embedding_config().get('model', DEFAULT_EMBEDDING_MODEL),
+            'loaded': engine is not None
+        }
+        if engine is not None:
+            stats.update(engine.get_stats())
+        return stats
     
     def get_available_models(self) -> List[str]:
-        """获取所有可用模型列表"""
-        return list(self.models.keys())
+        """获取所有可用模型列表（含LoRA适配器）"""
+        return list(self.models.keys()) + list(self.adapters.keys())
     
     def get_model_config(self, model_name: str) -> Optional[dict]:
-        """获取指定模型的配置"""
+        """获取指定模型的配置，LoRA适配器返回其基座模型的配置"""
+        model_name, _ = self._resolve_model(model_name)
         return self.models.get(model_name, {}).get('config')
     
+    def get_replica_stats(self, model_name: str) -> Optional[List[dict]]:
+        """获取指定模型各副本的负载与批处理调度统计"""
+        if model_name not in self.models:
+            return None
+        return [replica.get_stats() for replica in self.models[model_name]['replicas']]
+    
+    def get_queue_stats(self, model_name: str) -> Optional[dict]:
+        """获取指定模型的排队统计（队列深度、等待时间、拒绝数）"""
+        admission = self.admission.get(model_name)
+        return admission.get_stats() if admission else None
+    
+    def get_model_status(self) -> Dict[str, dict]:
+        """获取各模型的加载状态"""
+        return self._with_worker_stats('get_model_status', {
+            model_name: {
+                'type': model['config']['type'],
+                'state': model['state'],
+                'error': model['error'],
+                'load_phases': model['load_phases'],
+                'reload': dict(model['reload']) if model['reload'] is not None else None,
+                'replicas_loaded': sum(1 for replica in model['replicas'] if replica.is_loaded)
+            }
+            for model_name, model in self.models.items()
+        })
+    
+    def get_residency_stats(self) -> dict:
+        """获取模型常驻命中率、设备预算使用与最近的加载/驱逐事件"""
+        stats = self.residency.get_stats()
+        stats['events'] = self.residency.get_events()
+        return stats
+    
+    def get_routing_stats(self) -> dict:
+        """获取级联路由的各模型开销、节省的开销与最近的路由决策"""
+        if self.cascade is None:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            **self.cascade.get_stats(),
+            'decisions': self.cascade.get_decisions()
+        }
+    
+    def get_response_cache_stats(self) -> dict:
+        """获取精确匹配缓存与语义缓存的命中率与占用"""
+        stats = {'enabled': False}
+        if self.response_cache is not None:
+            stats = {'enabled': True, **self.response_cache.get_stats()}
+        stats['semantic'] = {'enabled': False}
+        if self.semantic_cache is not None:
+            stats['semantic'] = {'enabled': True, **self.semantic_cache.get_stats()}
+        return stats
+    
+    def get_stats(self) -> Dict[str, dict]:
+        """获取所有模型的排队、调度与输出长度预测统计"""
+        return self._with_worker_stats('get_stats', {
+            model_name: {
+                'queue': self.get_queue_stats(model_name),
+                'replicas': self.get_replica_stats(model_name),
+                'output_length': self.length_predictors[model_name].get_stats(),
+                'tokenizer': (
+                    self.models[model_name]['tokenizer_pool'].get_stats()
+                    if self.models[model_name]['tokenizer_pool'] else None
+                )
+            }
+            for model_name in self.models
+        })
+    
+    def _with_worker_stats(self, method: str, stats: Dict[str, dict]) -> Dict[str, dict]:
+        """用工作进程中的状态替换本进程的记录，并附加工作进程的连接与重启统计"""
+        for model_name, worker in self.workers.items():
+            if worker.connected:
+                try:
+                    stats[model_name] = worker.call_sync(method, timeout=5)[model_name]
+                except Exception as e:
+                    logging.warning(f"Error getting {method} from worker for {model_name}: {str(e)}")
+            stats[model_name]['worker'] = worker.get_stats()
+        return stats
+    
     def __del__(self):
-        """清理资源"""
-        for executor in self.executors.values():
-            executor.shutdown()
+        """清理资源（工作进程由其他API进程共用，只断开连接）"""
+        for worker in self.workers.values():
+            worker.close()
         for model_name in self.models:
-            self.unload_model(model_name) 
\ No newline at end of file
+            self.unload_model(model_name)
+        if self.embedding_engine is not None:
+            self.embedding_engine.stop() 
\ No newline at end of file
@@ -0,0 +1,613 @@
+import argparse
+import asyncio
+import fcntl
+import itertools
+import logging
+import os
+import re
+import secrets
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing.connection import AuthenticationError, Client, Connection, Listener
+from typing import AsyncIterator, Dict, Optional, Union
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 工作进程中允许远程调用的ModelManager方法
+WORKER_METHODS = frozenset({
+    'ensure_loaded',
+    'generate',
+    'generate_stream',
+    'count_tokens',
+    'unload_model',
+    'reload_model',
+    'start_reload',
+    'get_reload_status',
+    'get_stats',
+    'get_model_status'
+})
+
+
+class WorkerUnavailableError(RuntimeError):
+    """模型工作进程不可用：启动超时，或崩溃后尚未重新连接"""
+
+
+def default_socket_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), f"llm-platform-{os.getuid()}")
+
+
+def ensure_socket_dir(socket_dir: str) -> str:
+    """创建（或检查已有的）socket目录，目录必须属于当前用户且权限为0700
+
+    目录可能由其他本地用户预先创建（默认路径可以预测），此时拒绝使用，
+    否则其他用户可以在目录中放置socket或读取密钥文件。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(socket_dir)), exist_ok=True)
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(socket_dir)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"Worker socket path {socket_dir} is not a directory")
+    if info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+        raise PermissionError(
+            f"Worker socket directory {socket_dir} must be owned by uid {os.getuid()} with mode 0700 "
+            f"(found uid {info.st_uid}, mode {stat.S_IMODE(info.st_mode):04o})"
+        )
+    return socket_dir
+
+
+def worker_address(socket_dir: str, model_name: str) -> str:
+    """模型工作进程的Unix socket路径（模型名中的特殊字符替换为下划线）"""
+    return os.path.join(socket_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name) + '.sock')
+
+
+def worker_authkey(socket_dir: str, secret: Optional[str] = None) -> bytes:
+    """连接认证密钥：未配置时使用socket目录中的随机密钥文件（0600），首次使用时生成
+
+    同一socket目录下的API进程与工作进程读取同一个密钥文件，其他用户无法读取。
+    """
+    if secret:
+        return secret.encode('utf-8')
+    ensure_socket_dir(socket_dir)
+    path = os.path.join(socket_dir, 'authkey')
+    try:
+        return _read_authkey(path)
+    except FileNotFoundError:
+        pass
+    # 先写入临时文件再以硬链接发布，并发启动的进程只有一个能创建成功，不会读到写了一半的密钥
+    fd, tmp_path = tempfile.mkstemp(dir=socket_dir)
+    try:
+        os.write(fd, secrets.token_bytes(32))
+        os.close(fd)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    return _read_authkey(path)
+
+
+def _read_authkey(path: str) -> bytes:
+    """读取密钥文件，文件必须是当前用户的普通文件且其他用户没有任何权限"""
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        info = os.fstat(fd)
+        if (
+            not stat.S_ISREG(info.st_mode)
+            or info.st_uid != os.getuid()
+            or stat.S_IMODE(info.st_mode) & 0o077
+        ):
+            raise PermissionError(f"Worker authkey file {path} must be owned by uid {os.getuid()} with mode 0600")
+        key = os.read(fd, 64)
+    finally:
+        os.close(fd)
+    if len(key) < 32:
+        raise PermissionError(f"Worker authkey file {path} is truncated")
+    return key
+
+
+def _set_future(future: Future, result=None, exception: Optional[BaseException] = None):
+    """设置Future结果，调用方已取消时忽略"""
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _Stream:
+    """一次流式调用在客户端的接收队列"""
+
+    __slots__ = ('loop', 'queue')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def push(self, kind: str, value):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+
+class ModelWorkerClient:
+    """API进程中连接单个模型工作进程的客户端
+
+    工作进程监听按模型名命名的Unix socket，由持有文件锁的进程独占，
+    因此多个API进程（server.workers）共享同一个工作进程，模型只加载一次。
+    连接时没有工作进程在运行则启动一个；连接断开（工作进程崩溃）时，
+    未完成的调用以WorkerUnavailableError结束，并按指数退避自动重启、重新连接。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        config_path: str,
+        socket_dir: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        start_timeout: float = 120.0,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 30.0
+    ):
+        self.model_name = model_name
+        self.config_path = os.path.abspath(config_path)
+        self.socket_dir = socket_dir or default_socket_dir()
+        self.address = worker_address(self.socket_dir, model_name)
+        self.authkey = authkey or worker_authkey(self.socket_dir)
+        self.start_timeout = start_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.pid: Optional[int] = None
+
+        self._conn: Optional[Connection] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._closed = False
+        # 保护_conn与_pending；连接过程单独加锁，并发调用方共享同一次连接
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Union[Future, _Stream]] = {}
+        self._ids = itertools.count()
+        self.stats: Dict[str, int] = {
+            'requests': 0,
+            'streams': 0,
+            'failed': 0,
+            'spawned': 0,
+            'crashes': 0,
+            'restarts': 0
+        }
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def connect(self):
+        """连接工作进程，没有在运行的工作进程时启动一个（阻塞直到连接成功或超时）"""
+        with self._connect_lock:
+            if self._conn is not None:
+                return
+            if self._closed:
+                raise WorkerUnavailableError(f"Worker client for {self.model_name} is closed")
+
+            deadline = time.monotonic() + self.start_timeout
+            spawned = False
+            while True:
+                try:
+                    conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                    _, _, pid = conn.recv()
+                    break
+                except (OSError, EOFError):
+                    # 工作进程尚未监听，或旧进程正在退出
+                    pass
+                if not spawned:
+                    self._spawn()
+                    spawned = True
+                else:
+                    # 退出码为0表示另一个进程已经启动了工作进程（没抢到文件锁），继续等待连接
+                    code = self._process.poll()
+                    if code not in (None, 0):
+                        raise WorkerUnavailableError(
+                            f"Worker for {self.model_name} exited with code {code}"
+                        )
+                if time.monotonic() > deadline:
+                    raise WorkerUnavailableError(
+                        f"Timed out starting worker for {self.model_name} after {self.start_timeout}s"
+                    )
+                time.sleep(0.1)
+
+            self.pid = pid
+            with self._lock:
+                self._conn = conn
+            threading.Thread(
+                target=self._read,
+                args=(conn,),
+                name=f"worker-client-{self.model_name}",
+                daemon=True
+            ).start()
+            logging.info(f"Connected to worker for {self.model_name} (pid {self.pid})")
+
+    async def ensure_connected(self):
+        """在线程池中连接（或等待正在进行的重启），不阻塞事件循环"""
+        if self._conn is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.connect)
+
+    def _spawn(self):
+        """以独立会话启动工作进程，API进程退出时工作进程不随之退出"""
+        if self._process is not None:
+            # 回收之前启动并已退出的进程
+            self._process.poll()
+        ensure_socket_dir(self.socket_dir)
+        self._process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'core.model_worker',
+                '--config', self.config_path,
+                '--model', self.model_name,
+                '--socket', self.address
+            ],
+            cwd=PROJECT_ROOT,
+            start_new_session=True
+        )
+        self.stats['spawned'] += 1
+        logging.info(f"Started worker for {self.model_name} (pid {self._process.pid})")
+
+    async def call(self, method: str, *args, usage: Optional[dict] = None, **kwargs):
+        """在工作进程中调用ModelManager的方法并返回结果
+
+        Args:
+            usage: 若提供，作为usage参数传给工作进程中的方法，方法写入的内容随结果带回并合并到其中
+        """
+        await self.ensure_connected()
+        if usage is not None:
+            kwargs['usage'] = {}
+        future: Future = Future()
+        req_id = self._request('call', method, args, kwargs, future)
+        self.stats['requests'] += 1
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self._cancel(req_id)
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        if usage is not None:
+            result, remote_usage = result
+            usage.update(remote_usage)
+        return result
+
+    def call_sync(self, method: str, *args, timeout: Optional[float] = None, **kwargs):
+        """同步调用，只在已连接时可用（不会启动工作进程）"""
+        future: Future = Future()
+        req_id = self._request('call', method, args, kwargs, future)
+        try:
+            return future.result(timeout)
+        finally:
+            with self._lock:
+                self._pending.pop(req_id, None)
+
+    async def stream(self, method: str, *args, usage: Optional[dict] = None, **kwargs) -> AsyncIterator:
+        """在工作进程中调用异步生成器方法，逐个产出结果（usage与call相同，在结束时合并）"""
+        await self.ensure_connected()
+        if usage is not None:
+            kwargs['usage'] = {}
+        stream = _Stream(asyncio.get_running_loop())
+        req_id = self._request('stream', method, args, kwargs, stream)
+        self.stats['streams'] += 1
+        finished = False
+        try:
+            while True:
+                kind, value = await stream.queue.get()
+                if kind == 'chunk':
+                    yield value
+                elif kind == 'end':
+                    finished = True
+                    if usage is not None and value:
+                        usage.update(value)
+                    return
+                else:
+                    finished = True
+                    self.stats['failed'] += 1
+                    raise value
+        finally:
+            if not finished:
+                # 调用方提前结束或被取消时通知工作进程取消生成
+                self._cancel(req_id)
+
+    def close(self, stop_worker: bool = False):
+        """断开连接；工作进程在没有API进程连接一段时间后自行退出，stop_worker为True时立即终止"""
+        self._closed = True
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+        if stop_worker and self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if self._process is not None:
+            self._process.poll()
+        self._fail_pending(WorkerUnavailableError(f"Worker client for {self.model_name} is closed"))
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats['connected'] = self.connected
+        stats['pid'] = self.pid
+        stats['pending'] = len(self._pending)
+        return stats
+
+    def _request(self, kind: str, method: str, args, kwargs, waiter) -> int:
+        with self._lock:
+            conn = self._conn
+            if conn is None:
+                raise WorkerUnavailableError(f"Worker for {self.model_name} is not connected")
+            req_id = next(self._ids)
+            self._pending[req_id] = waiter
+        try:
+            with self._send_lock:
+                conn.send((kind, req_id, method, args, kwargs))
+        except (OSError, EOFError) as e:
+            with self._lock:
+                self._pending.pop(req_id, None)
+            raise WorkerUnavailableError(f"Worker for {self.model_name} is not connected") from e
+        return req_id
+
+    def _cancel(self, req_id: int):
+        with self._lock:
+            self._pending.pop(req_id, None)
+            conn = self._conn
+        if conn is None:
+            return
+        try:
+            with self._send_lock:
+                conn.send(('cancel', req_id, None, (), {}))
+        except (OSError, EOFError):
+            pass
+
+    def _read(self, conn: Connection):
+        """接收线程：把结果分发给等待的调用，连接断开时触发重启"""
+        while True:
+            try:
+                kind, req_id, value = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                if kind in ('result', 'error', 'end'):
+                    waiter = self._pending.pop(req_id, None)
+                else:
+                    waiter = self._pending.get(req_id)
+            if isinstance(waiter, Future):
+                if kind == 'error':
+                    _set_future(waiter, exception=value)
+                else:
+                    _set_future(waiter, value)
+            elif waiter is not None:
+                waiter.push(kind, value)
+        self._disconnected(conn)
+
+    def _fail_pending(self, error: Exception):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for waiter in pending.values():
+            if isinstance(waiter, Future):
+                _set_future(waiter, exception=error)
+            else:
+                waiter.push('error', error)
+
+    def _disconnected(self, conn: Connection):
+        with self._lock:
+            if self._conn is not conn:
+                return
+            self._conn = None
+        conn.close()
+        if self._closed:
+            return
+        self.stats['crashes'] += 1
+        logging.error(f"Worker for {self.model_name} (pid {self.pid}) disconnected, restarting")
+        self._fail_pending(WorkerUnavailableError(f"Worker for {self.model_name} exited"))
+
+        delay = self.restart_delay
+        while not self._closed:
+            time.sleep(delay)
+            try:
+                self.connect()
+            except Exception as e:
+                logging.error(f"Error restarting worker for {self.model_name}: {str(e)}")
+                delay = min(delay * 2, self.max_restart_delay)
+                continue
+            self.stats['restarts'] += 1
+            return
+
+
+class _Connection:
+    """工作进程中一个API进程的连接"""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def send(self, message):
+        try:
+            with self.lock:
+                self.conn.send(message)
+        except (OSError, EOFError):
+            # API进程已断开
+            pass
+        except Exception as e:
+            # 结果或异常无法序列化时改为返回RuntimeError
+            kind, req_id, _ = message
+            try:
+                with self.lock:
+                    self.conn.send(('error', req_id, RuntimeError(f"Cannot send {kind}: {str(e)}")))
+            except (OSError, EOFError):
+                pass
+
+
+class _WorkerServer:
+    """工作进程的服务端：每个连接一个接收线程，调用在事件循环中执行"""
+
+    def __init__(self, manager, loop: asyncio.AbstractEventLoop):
+        self.manager = manager
+        self.loop = loop
+        self.connections = 0
+        self.idle_since = time.monotonic()
+
+    def accept(self, listener: Listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError) as e:
+                logging.warning(f"Rejected worker connection: {str(e)}")
+                continue
+            except OSError:
+                # listener已关闭
+                return
+            self.loop.call_soon_threadsafe(self._connected, conn)
+
+    def _connected(self, conn: Connection):
+        state = _Connection(conn)
+        self.connections += 1
+        state.send(('hello', None, os.getpid()))
+        threading.Thread(target=self._read, args=(state,), daemon=True).start()
+
+    def _read(self, state: _Connection):
+        while True:
+            try:
+                message = state.conn.recv()
+            except (EOFError, OSError):
+                break
+            self.loop.call_soon_threadsafe(self._dispatch, state, message)
+        self.loop.call_soon_threadsafe(self._disconnected, state)
+
+    def _disconnected(self, state: _Connection):
+        # API进程断开时取消它发起的全部调用
+        for task in list(state.tasks.values()):
+            task.cancel()
+        state.conn.close()
+        self.connections -= 1
+        if self.connections == 0:
+            self.idle_since = time.monotonic()
+
+    def _dispatch(self, state: _Connection, message):
+        kind, req_id, method, args, kwargs = message
+        if kind == 'cancel':
+            task = state.tasks.pop(req_id, None)
+            if task is not None:
+                task.cancel()
+            return
+        if method not in WORKER_METHODS:
+            state.send(('error', req_id, ValueError(f"Unsupported worker method: {method}")))
+            return
+        if kind == 'stream':
+            coroutine = self._stream(state, req_id, method, args, kwargs)
+        else:
+            coroutine = self._call(state, req_id, method, args, kwargs)
+        task = asyncio.ensure_future(coroutine)
+        state.tasks[req_id] = task
+        task.add_done_callback(lambda _: state.tasks.pop(req_id, None))
+
+    async def _call(self, state: _Connection, req_id: int, method: str, args, kwargs):
+        try:
+            result = getattr(self.manager, method)(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            state.send(('error', req_id, e))
+            return
+        if 'usage' in kwargs:
+            # 调用方传入的usage在本进程中填写，随结果带回
+            result = (result, kwargs['usage'])
+        state.send(('result', req_id, result))
+
+    async def _stream(self, state: _Connection, req_id: int, method: str, args, kwargs):
+        chunks = getattr(self.manager, method)(*args, **kwargs)
+        try:
+            async for chunk in chunks:
+                state.send(('chunk', req_id, chunk))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            state.send(('error', req_id, e))
+            return
+        finally:
+            await chunks.aclose()
+        state.send(('end', req_id, kwargs.get('usage')))
+
+
+async def serve(config_path: str, model_name: str, address: str):
+    """运行模型工作进程：加载模型并处理API进程的调用，没有连接超过linger_seconds后退出"""
+    # 延迟导入，避免与model_manager循环导入
+    from core.model_manager import ModelManager
+
+    manager = ModelManager(config_path, out_of_process=False)
+    workers_config = manager.config.get('workers', {})
+    linger = workers_config.get('linger_seconds', 60)
+    if manager.config.get('semantic_cache', {}).get('enabled', False):
+        manager.attach_semantic_cache(manager.embed_texts)
+
+    listener = Listener(
+        address,
+        family='AF_UNIX',
+        authkey=worker_authkey(os.path.dirname(address), workers_config.get('authkey'))
+    )
+    server = _WorkerServer(manager, asyncio.get_running_loop())
+    threading.Thread(target=server.accept, args=(listener,), daemon=True).start()
+    logging.info(f"Worker for {model_name} listening on {address}")
+
+    # 启动（或崩溃重启）后立即加载并预热，不等第一个请求
+    manager.preload([model_name])
+    try:
+        while server.connections or time.monotonic() - server.idle_since < linger:
+            await asyncio.sleep(0.5)
+        logging.info(f"Worker for {model_name} idle for {linger}s, exiting")
+    finally:
+        listener.close()
+        manager.unload_model(model_name)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run a model in a dedicated worker process")
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--socket', required=True)
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [worker {args.model} pid %(process)d] %(levelname)s %(message)s"
+    )
+
+    # 拒绝使用其他用户可写的socket目录
+    ensure_socket_dir(os.path.dirname(os.path.abspath(args.socket)))
+    # 文件锁保证每个模型只有一个工作进程，锁随进程退出释放
+    lock_file = open(args.socket + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logging.info(f"Worker for {args.model} is already running")
+        return 0
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    asyncio.run(serve(args.config, args.model, args.socket))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
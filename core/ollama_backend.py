@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Optional, Union
+
+import httpx
+import ollama
+
+KeepAlive = Union[float, str]
+
+
+class OllamaBackend:
+    """基于ollama.AsyncClient的Ollama后端
+
+    所有Ollama模型共享同一个异步HTTP连接池，请求不再经过线程池串行执行；
+    每个模型的并发上限由准入队列控制。每次请求都带上该模型的keep_alive，
+    使常用模型常驻Ollama，卸载模型时发送keep_alive=0让Ollama立即释放显存。
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        max_connections: int = 32,
+        timeout: Optional[float] = 300,
+        keep_alive: Optional[KeepAlive] = "5m"
+    ):
+        self.host = host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.default_keep_alive = keep_alive
+        self._keep_alive: Dict[str, Optional[KeepAlive]] = {}
+        self._client: Optional[ollama.AsyncClient] = None
+        self.stats: Dict[str, int] = {
+            'requests': 0,
+            'streams': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'releases': 0
+        }
+
+    @property
+    def client(self) -> ollama.AsyncClient:
+        """共享的异步客户端，首次使用时创建"""
+        if self._client is None:
+            self._client = ollama.AsyncClient(
+                host=self.host,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+
+    @property
+    def _http(self) -> httpx.AsyncClient:
+        """AsyncClient内部的httpx连接池
+
+        ollama 0.1.6（requirements.txt中固定的版本）的AsyncClient既不接受外部传入的httpx客户端，
+        也没有公开base_url与关闭连接池的接口，只能访问其_client属性；升级ollama时需核对这里。
+        """
+        return self.client._client
+
+    def set_keep_alive(self, model_name: str, keep_alive: Optional[KeepAlive]):
+        """设置模型请求携带的keep_alive（如"30m"，-1表示一直常驻）"""
+        self._keep_alive[model_name] = keep_alive
+
+    def keep_alive(self, model_name: str) -> Optional[KeepAlive]:
+        return self._keep_alive.get(model_name, self.default_keep_alive)
+
+    async def generate(
+        self,
+        model_name: str,
+        prompt: str,
+        options: Optional[dict] = None,
+        usage: Optional[dict] = None
+    ) -> str:
+        """生成完整响应，提供usage时写入提示词与生成的token数"""
+        self.stats['requests'] += 1
+        try:
+            response = await self.client.generate(
+                model=model_name,
+                prompt=prompt,
+                options=options,
+                keep_alive=self.keep_alive(model_name)
+            )
+        except asyncio.CancelledError:
+            # 取消会关闭HTTP连接，Ollama随之停止生成
+            self.stats['cancelled'] += 1
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        if usage is not None:
+            usage['prompt_eval_count'] = response.get('prompt_eval_count')
+            usage['eval_count'] = response.get('eval_count')
+        return response['response']
+
+    async def stream(
+        self,
+        model_name: str,
+        prompt: str,
+        options: Optional[dict] = None
+    ) -> AsyncIterator[str]:
+        """流式生成，逐段产出新增文本
+
+        调用方提前结束迭代或被取消时立即关闭流式响应，Ollama随之停止生成。
+        """
+        self.stats['streams'] += 1
+        chunks = None
+        try:
+            chunks = await self.client.generate(
+                model=model_name,
+                prompt=prompt,
+                options=options,
+                stream=True,
+                keep_alive=self.keep_alive(model_name)
+            )
+            async for chunk in chunks:
+                if chunk.get('response'):
+                    yield chunk['response']
+        except (asyncio.CancelledError, GeneratorExit):
+            self.stats['cancelled'] += 1
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            if chunks is not None:
+                await chunks.aclose()
+
+    def release(self, model_name: str) -> bool:
+        """让Ollama立即卸载模型（同步调用，卸载路径不一定运行在事件循环中）"""
+        try:
+            with httpx.Client(base_url=self._http.base_url, timeout=5) as client:
+                response = client.post(
+                    '/api/generate',
+                    json={'model': model_name, 'keep_alive': 0}
+                )
+                response.raise_for_status()
+            self.stats['releases'] += 1
+            return True
+        except Exception as e:
+            logging.warning(f"Error releasing Ollama model {model_name}: {str(e)}")
+            return False
+
+    async def close(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._http.aclose()
+            self._client = None
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats['keep_alive'] = {
+            model_name: self.keep_alive(model_name) for model_name in self._keep_alive
+        }
+        return stats
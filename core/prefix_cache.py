@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+
+class PrefixCache:
+    """按token前缀复用KV缓存的哈希块链
+
+    输入token按block_size切成定长块，每个块以 (父块键, 块内token) 为键保存该块
+    对应的KV缓存。相同前缀（系统提示词、知识库上下文）的请求只需对新的后缀做
+    prefill。总占用超过max_bytes时按最近最少使用顺序淘汰，叶子块先于父块淘汰。
+    相同token在不同namespace（如不同的LoRA适配器）下的KV不同，互不命中。
+
+    缓存值对本类是不透明的，由调用方负责切分与拼接KV张量；
+    值持有外部资源（如分页KV缓存中的块引用）时，on_evict在条目被移除时释放它。
+    """
+
+    def __init__(
+        self,
+        block_size: int = 16,
+        max_bytes: int = 512 << 20,
+        on_evict: Optional[Callable[[Any], None]] = None
+    ):
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.used_bytes = 0
+        # 键 -> (缓存值, 字节数)，按最近使用顺序排列
+        self._blocks: "OrderedDict[Tuple, Tuple[Any, int]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            'lookups': 0,
+            'hits': 0,
+            'tokens_saved': 0,
+            'inserted_blocks': 0,
+            'evicted_blocks': 0
+        }
+
+    def match(
+        self,
+        token_ids: Sequence[int],
+        max_tokens: Optional[int] = None,
+        namespace: Hashable = None
+    ) -> List[Any]:
+        """查找最长的已缓存前缀，返回按顺序排列的块缓存值
+
+        Args:
+            token_ids: 请求的输入token
+            max_tokens: 最多复用的token数（调用方至少需要保留一个token做prefill）
+            namespace: 缓存的命名空间，只匹配同一命名空间下插入的块
+        """
+        limit = len(token_ids) if max_tokens is None else min(max_tokens, len(token_ids))
+        keys = []
+        values = []
+        for key in self._chain(token_ids, limit // self.block_size, namespace):
+            entry = self._blocks.get(key)
+            if entry is None:
+                break
+            keys.append(key)
+            values.append(entry[0])
+
+        self.stats['lookups'] += 1
+        if values:
+            self.stats['hits'] += 1
+            self.stats['tokens_saved'] += len(values) * self.block_size
+            self._touch(keys)
+        return values
+
+    def insert(
+        self,
+        token_ids: Sequence[int],
+        block_value: Callable[[int], Tuple[Any, int]],
+        namespace: Hashable = None
+    ):
+        """缓存token_ids中所有完整的块
+
+        Args:
+            token_ids: 已完成prefill的token
+            block_value: 按块序号返回 (缓存值, 字节数)，只对尚未缓存的块调用
+            namespace: 缓存的命名空间
+        """
+        keys = []
+        chain = self._chain(token_ids, len(token_ids) // self.block_size, namespace)
+        for index, key in enumerate(chain):
+            if key not in self._blocks:
+                value, size = block_value(index)
+                if size > self.max_bytes:
+                    if self.on_evict is not None:
+                        self.on_evict(value)
+                    break
+                self._blocks[key] = (value, size)
+                self.used_bytes += size
+                self.stats['inserted_blocks'] += 1
+            keys.append(key)
+        self._touch(keys)
+        self._evict(protected=set(keys))
+
+    def clear(self):
+        if self.on_evict is not None:
+            for value, _ in self._blocks.values():
+                self.on_evict(value)
+        self._blocks.clear()
+        self.used_bytes = 0
+
+    def evict_lru(self) -> bool:
+        """淘汰最近最少使用的一个块，缓存为空时返回False"""
+        if not self._blocks:
+            return False
+        self._remove(next(iter(self._blocks)))
+        return True
+
+    def get_stats(self) -> Dict:
+        """获取命中率、节省的prefill token数与内存占用"""
+        stats = dict(self.stats)
+        lookups = stats['lookups']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['blocks'] = len(self._blocks)
+        stats['used_bytes'] = self.used_bytes
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _chain(self, token_ids: Sequence[int], num_blocks: int, namespace: Hashable = None):
+        """依次产出前num_blocks个块的键：(父块键的哈希, 块内token)，首块以命名空间作为父块"""
+        parent = namespace
+        for index in range(num_blocks):
+            key = (hash(parent), tuple(token_ids[index * self.block_size:(index + 1) * self.block_size]))
+            yield key
+            parent = key
+
+    def _touch(self, keys: List[Tuple]):
+        # 从叶子到根依次移到末尾，使父块总比子块更晚被淘汰
+        for key in reversed(keys):
+            self._blocks.move_to_end(key)
+
+    def _evict(self, protected: set):
+        while self.used_bytes > self.max_bytes and self._blocks:
+            key = next((k for k in self._blocks if k not in protected), None)
+            if key is None:
+                break
+            self._remove(key)
+
+    def _remove(self, key: Tuple):
+        value, size = self._blocks.pop(key)
+        self.used_bytes -= size
+        self.stats['evicted_blocks'] += 1
+        if self.on_evict is not None:
+            self.on_evict(value)
@@ -0,0 +1,130 @@
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+import torch
+
+
+class ModelReplica:
+    """模型在某个设备槽位上的一个副本
+
+    设备槽位对应 gpu.devices 中的编号；没有CUDA时副本在CPU上运行，
+    槽位仍作为路由和统计的逻辑标识。
+    """
+
+    def __init__(self, model_name: str, index: int, device: Optional[int] = None):
+        self.model_name = model_name
+        self.index = index
+        self.device = device
+        self.instance = None
+        # 推测解码使用的草稿模型
+        self.draft_instance = None
+        self.scheduler = None
+        # 副本使用的分词线程池，滚动更新期间新旧版本的副本可能使用不同的tokenizer
+        self.tokenizer_pool = None
+        self.in_flight = 0
+        self.served = 0
+
+    @property
+    def torch_device(self) -> Optional[str]:
+        """副本实际使用的torch设备，未固定设备时返回None"""
+        if self.device is None:
+            return None
+        return f"cuda:{self.device}" if torch.cuda.is_available() else "cpu"
+
+    @property
+    def device_map(self) -> Union[str, Dict[str, str]]:
+        """传给from_pretrained的device_map"""
+        if self.device is None:
+            return "auto"
+        return {"": self.torch_device}
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.instance is not None
+
+    def free_memory(self) -> Optional[int]:
+        """副本所在GPU的空闲显存（字节），无法获取时返回None"""
+        if self.device is None or not torch.cuda.is_available():
+            return None
+        try:
+            free, _ = torch.cuda.mem_get_info(self.device)
+            return free
+        except Exception as e:
+            logging.error(f"Error getting free memory for device {self.device}: {str(e)}")
+            return None
+
+    @contextmanager
+    def track(self) -> Iterator["ModelReplica"]:
+        """统计路由到该副本、尚未完成的请求数"""
+        self.in_flight += 1
+        try:
+            yield self
+        finally:
+            self.in_flight -= 1
+            self.served += 1
+
+    def get_stats(self) -> Dict:
+        """获取副本状态"""
+        return {
+            'index': self.index,
+            'device': self.device,
+            'loaded': self.is_loaded,
+            'in_flight': self.in_flight,
+            'served': self.served,
+            'free_memory': self.free_memory(),
+            'scheduler': self.scheduler.get_stats() if self.scheduler else None
+        }
+
+
+def plan_replica_devices(model_configs: List[dict], devices: List[int]) -> Dict[str, List[Optional[int]]]:
+    """为每个模型的副本分配设备槽位
+
+    显式声明 devices 的模型按声明放置；只声明 replicas 的模型从上一个模型
+    结束的位置开始轮转分配，使不同模型的副本错开到不同的GPU上；
+    两者都未声明的模型保持单副本、不固定设备（device_map="auto"）。
+    """
+    plan: Dict[str, List[Optional[int]]] = {}
+    offset = 0
+    for model_config in model_configs:
+        name = model_config['name']
+        if model_config.get('devices'):
+            plan[name] = list(model_config['devices'])
+        elif model_config.get('replicas') and devices:
+            count = model_config['replicas']
+            plan[name] = [devices[(offset + i) % len(devices)] for i in range(count)]
+            offset = (offset + count) % len(devices)
+        else:
+            plan[name] = [None]
+    return plan
+
+
+class ReplicaRouter:
+    """在模型的多个副本之间选择负载最低的副本
+
+    least_loaded: 选择未完成请求最少的副本
+    most_free_memory: 选择空闲显存最多的副本，无法获取显存时退化为least_loaded
+    """
+
+    POLICIES = ('least_loaded', 'most_free_memory')
+
+    def __init__(self, policy: str = 'least_loaded'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown routing policy: {policy}")
+        self.policy = policy
+
+    def select(self, replicas: List[ModelReplica]) -> ModelReplica:
+        """从已加载的副本中选择一个"""
+        candidates = [replica for replica in replicas if replica.is_loaded]
+        if not candidates:
+            raise RuntimeError("No loaded replica available")
+
+        if self.policy == 'most_free_memory':
+            memories = [replica.free_memory() for replica in candidates]
+            if all(memory is not None for memory in memories):
+                return max(
+                    zip(candidates, memories),
+                    key=lambda item: (item[1], -item[0].in_flight)
+                )[0]
+
+        return min(candidates, key=lambda replica: (replica.in_flight, replica.served))
@@ -0,0 +1,218 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, Iterable, List, Optional, Set
+
+
+class ResidencyManager:
+    """按设备显存预算管理模型常驻
+
+    每个模型副本按配置中的 gpu_memory（GB）占用所在设备的预算；未固定设备的
+    副本按device_map规划切分到各设备时（见set_split），按规划中各设备的占用记账，
+    否则记到加载时剩余预算最多的设备上。加载冷模型预算不足时，按最近最少使用
+    顺序驱逐未固定（pinned）且空闲的模型。
+    热更新期间新版本的副本通过reserve临时占用额外的预算，与旧版本同时常驻。
+    """
+
+    def __init__(self, device_budgets: Dict[int, float], max_events: int = 1000):
+        self.device_budgets = dict(device_budgets)
+        self._models: Dict[str, dict] = {}
+        # 常驻模型，按最近使用顺序排列（最久未使用的在前）
+        self._resident: "OrderedDict[str, Dict[int, float]]" = OrderedDict()
+        # 临时占用：键 -> (模型名, 各设备占用)
+        self._reserved: Dict[Hashable, tuple] = {}
+        self.events: Deque[dict] = deque(maxlen=max_events)
+        self.stats: Dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'loads': 0,
+            'evictions': 0
+        }
+
+    def register(
+        self,
+        model_name: str,
+        memory: float,
+        devices: Iterable[Optional[int]],
+        pinned: bool = False
+    ):
+        """登记受预算管理的模型：单副本显存占用、副本设备与是否固定常驻"""
+        self._models[model_name] = {
+            'memory': memory,
+            'devices': list(devices),
+            'pinned': pinned,
+            # 未固定设备的副本在各设备上的占用（GB），None表示整体记到一个设备上
+            'split': None
+        }
+
+    def set_split(self, model_name: str, split: Optional[Dict[int, float]]):
+        """设置未固定设备的副本按device_map规划在各设备上的占用（GB），None表示不切分"""
+        if model_name in self._models:
+            self._models[model_name]['split'] = dict(split) if split else None
+
+    def is_managed(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def is_resident(self, model_name: str) -> bool:
+        return model_name in self._resident
+
+    def record_access(self, model_name: str, hit: Optional[bool] = None) -> bool:
+        """记录一次请求访问，返回是否命中常驻模型
+
+        hit 为None时按是否常驻判断；调用方也可以显式指定（如模型仍在加载中）。
+        """
+        if model_name not in self._models:
+            return True
+        if hit is None:
+            hit = model_name in self._resident
+        self.stats['hits' if hit else 'misses'] += 1
+        if model_name in self._resident:
+            self._resident.move_to_end(model_name)
+        return hit
+
+    def plan_load(self, model_name: str, busy: Optional[Set[str]] = None) -> Optional[List[str]]:
+        """规划加载模型需要驱逐的模型（按LRU顺序）
+
+        Returns:
+            需要驱逐的模型列表；即使驱逐所有可驱逐模型也放不下时返回None
+        """
+        if model_name in self._resident or model_name not in self._models:
+            return []
+
+        busy = busy or set()
+        free = self._free_budgets()
+        victims: List[str] = []
+        while self._place(model_name, free) is None:
+            candidates = [
+                name for name in self._resident
+                if name not in victims
+                and name not in busy
+                and not self._models[name]['pinned']
+            ]
+            if not candidates:
+                return None
+            victim = candidates[0]
+            victims.append(victim)
+            for device, memory in self._resident[victim].items():
+                free[device] += memory
+        return victims
+
+    def fits_all(self) -> bool:
+        """所有登记的模型能否同时常驻（不驱逐任何模型）"""
+        free = self._free_budgets()
+        for model_name in self._models:
+            placement = self._place(model_name, free)
+            if placement is None:
+                return False
+            for device, memory in placement.items():
+                free[device] -= memory
+        return True
+
+    def mark_loaded(self, model_name: str):
+        """记录模型已加载"""
+        if model_name not in self._models or model_name in self._resident:
+            return
+        placement = self._place(model_name, self._free_budgets())
+        if placement is None:
+            # 手动加载超出预算时仍记录占用，后续加载会先驱逐
+            placement = self._place(model_name, self._free_budgets(), strict=False)
+        self._resident[model_name] = placement
+        self.stats['loads'] += 1
+        self._record_event('load', model_name, placement)
+
+    def reserve(self, key: Hashable, model_name: str, devices: Iterable[Optional[int]]) -> bool:
+        """为模型在指定设备上的额外副本临时占用预算（不驱逐其他模型），放不下时返回False"""
+        if model_name not in self._models:
+            return True
+        placement = self._place(model_name, self._free_budgets(), devices=list(devices))
+        if placement is None:
+            return False
+        self._reserved[key] = (model_name, placement)
+        self._record_event('reserve', model_name, placement)
+        return True
+
+    def release(self, key: Hashable):
+        """释放reserve占用的预算"""
+        reserved = self._reserved.pop(key, None)
+        if reserved is not None:
+            self._record_event('release', *reserved)
+
+    def mark_unloaded(self, model_name: str, evicted: bool = False):
+        """记录模型已卸载或被驱逐"""
+        placement = self._resident.pop(model_name, None)
+        if placement is None:
+            return
+        if evicted:
+            self.stats['evictions'] += 1
+        self._record_event('evict' if evicted else 'unload', model_name, placement)
+
+    def get_stats(self) -> Dict:
+        """获取命中率、各设备预算使用与常驻模型"""
+        stats = dict(self.stats)
+        accesses = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / accesses if accesses else 0.0
+        used = self._used_budgets()
+        stats['devices'] = {
+            device: {'budget': budget, 'used': used[device]}
+            for device, budget in self.device_budgets.items()
+        }
+        stats['resident'] = list(self._resident)
+        stats['reserved'] = [model_name for model_name, _ in self._reserved.values()]
+        stats['pinned'] = [name for name, info in self._models.items() if info['pinned']]
+        return stats
+
+    def get_events(self, limit: int = 100) -> List[dict]:
+        """获取最近的加载/驱逐事件"""
+        return list(self.events)[-limit:]
+
+    def _used_budgets(self) -> Dict[int, float]:
+        used = {device: 0.0 for device in self.device_budgets}
+        placements = list(self._resident.values()) + [placement for _, placement in self._reserved.values()]
+        for placement in placements:
+            for device, memory in placement.items():
+                used[device] = used.get(device, 0.0) + memory
+        return used
+
+    def _free_budgets(self) -> Dict[int, float]:
+        used = self._used_budgets()
+        return {device: budget - used[device] for device, budget in self.device_budgets.items()}
+
+    def _place(
+        self,
+        model_name: str,
+        free: Dict[int, float],
+        strict: bool = True,
+        devices: Optional[List[Optional[int]]] = None
+    ) -> Optional[Dict[int, float]]:
+        """计算模型各副本（或指定设备上的副本）的设备占用，放不下时返回None（strict为False时忽略预算）"""
+        info = self._models[model_name]
+        remaining = dict(free)
+        placement: Dict[int, float] = {}
+        # 先放固定设备的副本，再把未固定的副本按规划切分，或放到剩余预算最多的设备
+        devices = sorted(info['devices'] if devices is None else devices, key=lambda device: device is None)
+        for device in devices:
+            if device is None and info['split']:
+                for split_device, memory in info['split'].items():
+                    if strict and remaining.get(split_device, 0.0) < memory:
+                        return None
+                    remaining[split_device] = remaining.get(split_device, 0.0) - memory
+                    placement[split_device] = placement.get(split_device, 0.0) + memory
+                continue
+            if device is None:
+                if not remaining:
+                    return None
+                device = max(remaining, key=remaining.get)
+            if strict and remaining.get(device, 0.0) < info['memory']:
+                return None
+            remaining[device] = remaining.get(device, 0.0) - info['memory']
+            placement[device] = placement.get(device, 0.0) + info['memory']
+        return placement
+
+    def _record_event(self, event: str, model_name: str, placement: Dict[int, float]):
+        self.events.append({
+            'time': time.time(),
+            'event': event,
+            'model': model_name,
+            'devices': placement
+        })
+        logging.info(f"Model residency {event}: {model_name} on devices {sorted(placement)}")
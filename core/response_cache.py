@@ -0,0 +1,79 @@
+import hashlib
+import json
+from typing import Dict, Optional
+
+from utils.cache import Cache
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """合并连续空白并去掉首尾空白，使只有空白差异的提示词命中同一条缓存"""
+    return " ".join(prompt.split())
+
+
+class ResponseCache:
+    """生成结果的精确匹配缓存
+
+    以 (模型, 规范化后的提示词, 采样参数, 知识库上下文哈希) 为键，按LRU + 滑动TTL
+    淘汰并限制总字节数。默认只缓存确定性（temperature为0）的请求，采样请求每次
+    结果不同，开启cache_sampled后才缓存。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 << 20,
+        ttl: Optional[float] = 3600,
+        cache_sampled: bool = False
+    ):
+        self.cache_sampled = cache_sampled
+        self._cache = Cache(
+            max_size=max_entries,
+            ttl=ttl,
+            max_bytes=max_bytes,
+            sizeof=lambda response: len(response.encode('utf-8'))
+        )
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'stores': 0}
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        knowledge_context: Optional[str] = None
+    ) -> str:
+        """计算缓存键"""
+        context_hash = None
+        if knowledge_context:
+            context_hash = hashlib.sha256(knowledge_context.encode('utf-8')).hexdigest()
+        payload = json.dumps(
+            [model_name, _normalize_prompt(prompt), max_length, temperature, top_p, context_hash],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_cacheable(self, temperature: float) -> bool:
+        return temperature <= 0 or self.cache_sampled
+
+    def get(self, key: str) -> Optional[str]:
+        response = self._cache.get(key)
+        self.stats['hits' if response is not None else 'misses'] += 1
+        return response
+
+    def set(self, key: str, response: str):
+        self._cache.set(key, response)
+        self.stats['stores'] += 1
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_stats(self) -> Dict:
+        """获取命中率、条目数与占用字节数"""
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['entries'] = self._cache.size()
+        stats['used_bytes'] = self._cache.used_bytes
+        stats['max_bytes'] = self._cache.max_bytes
+        return stats
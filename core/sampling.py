@@ -0,0 +1,51 @@
+import torch
+
+
+def logits_to_probs(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor
+) -> torch.Tensor:
+    """将logits按逐行的temperature/top_p转换为采样概率
+
+    Args:
+        logits: [batch, vocab]
+        temperatures: [batch]，小于等于0表示贪心解码
+        top_ps: [batch]
+
+    Returns:
+        [batch, vocab] 概率分布，贪心行为argmax处的one-hot
+    """
+    logits = logits.float()
+    greedy = temperatures <= 0
+
+    # 温度缩放（贪心行的温度置1，避免除零，之后会被one-hot覆盖）
+    safe_temperatures = torch.where(greedy, torch.ones_like(temperatures), temperatures)
+    probs = torch.softmax(logits / safe_temperatures.unsqueeze(-1).float(), dim=-1)
+
+    # top-p 截断，至少保留概率最大的一个token
+    if bool((top_ps < 1.0).any()):
+        sorted_probs, sorted_idx = torch.sort(probs, dim=-1, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        remove = (cumulative - sorted_probs) > top_ps.unsqueeze(-1).float()
+        sorted_probs = sorted_probs.masked_fill(remove, 0.0)
+        probs = torch.zeros_like(probs).scatter(-1, sorted_idx, sorted_probs)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+
+    if bool(greedy.any()):
+        one_hot = torch.zeros_like(probs).scatter(
+            -1, logits.argmax(dim=-1, keepdim=True), 1.0
+        )
+        probs = torch.where(greedy.unsqueeze(-1), one_hot, probs)
+
+    return probs
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor
+) -> torch.Tensor:
+    """按逐行采样参数从logits中采样下一个token，返回[batch]"""
+    probs = logits_to_probs(logits, temperatures, top_ps)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
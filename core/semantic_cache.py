@@ -0,0 +1,163 @@
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Sequence
+
+import torch
+
+EmbeddingFunction = Callable[[List[str]], Sequence[Sequence[float]]]
+
+
+class SemanticCache:
+    """按提示词语义相似度命中的生成结果缓存
+
+    每个模型一个命名空间，保存历史提示词的归一化向量；新提示词与命名空间内生成参数
+    相同的条目中最相似的提示词余弦相似度不低于threshold时返回其结果。条目按ttl过期，
+    每个命名空间超过max_entries时淘汰最久未命中的条目。命中、未命中与
+    被标记为误命中的查询都记录在审计日志中。
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        threshold: float = 0.92,
+        max_entries: int = 1000,
+        ttl: Optional[float] = 3600,
+        cache_sampled: bool = False,
+        max_audit_events: int = 1000
+    ):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_sampled = cache_sampled
+        # 命名空间 -> 条目id -> 条目，按最近命中顺序排列
+        self._namespaces: Dict[str, "OrderedDict[int, dict]"] = {}
+        self._ids = itertools.count()
+        self.audit: Deque[dict] = deque(maxlen=max_audit_events)
+        self._audit_ids = itertools.count()
+        self.stats: Dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'false_hits': 0,
+            'stores': 0,
+            'evictions': 0
+        }
+
+    def is_cacheable(self, temperature: float) -> bool:
+        return temperature <= 0 or self.cache_sampled
+
+    def embed(self, prompt: str) -> torch.Tensor:
+        """计算提示词的归一化向量（阻塞调用，应在线程池中执行）"""
+        vector = torch.tensor(self.embedding_function([prompt])[0], dtype=torch.float)
+        return vector / vector.norm().clamp(min=1e-12)
+
+    def lookup(
+        self,
+        namespace: str,
+        prompt: str,
+        embedding: torch.Tensor,
+        params: Optional[Hashable] = None
+    ) -> Optional[str]:
+        """查找语义相似的历史提示词，命中时返回其结果
+
+        Args:
+            params: 生成参数（如max_length、temperature、top_p），只匹配参数相同的条目
+        """
+        entries = self._namespaces.get(namespace)
+        if entries:
+            self._purge_expired(entries)
+
+        best_id, similarity = None, None
+        ids = [i for i, entry in entries.items() if entry['params'] == params] if entries else []
+        if ids:
+            similarities = torch.stack([entries[i]['embedding'] for i in ids]) @ embedding
+            index = int(similarities.argmax())
+            best_id, similarity = ids[index], float(similarities[index])
+
+        hit = similarity is not None and similarity >= self.threshold
+        self.stats['hits' if hit else 'misses'] += 1
+        event = {
+            'id': next(self._audit_ids),
+            'time': time.time(),
+            'event': 'hit' if hit else 'miss',
+            'namespace': namespace,
+            'prompt': prompt,
+            'matched_prompt': entries[best_id]['prompt'] if best_id is not None else None,
+            'similarity': similarity,
+            'entry_id': best_id if hit else None
+        }
+        self.audit.append(event)
+        if not hit:
+            return None
+
+        entry = entries[best_id]
+        entries.move_to_end(best_id)
+        entry['expires_at'] = self._expiry()
+        logging.info(
+            f"Semantic cache hit for {namespace} (similarity {similarity:.3f}): "
+            f"{prompt!r} ~ {entry['prompt']!r}"
+        )
+        return entry['response']
+
+    def store(
+        self,
+        namespace: str,
+        prompt: str,
+        response: str,
+        embedding: torch.Tensor,
+        params: Optional[Hashable] = None
+    ):
+        """保存提示词、生成参数及其结果"""
+        entries = self._namespaces.setdefault(namespace, OrderedDict())
+        entries[next(self._ids)] = {
+            'prompt': prompt,
+            'params': params,
+            'response': response,
+            'embedding': embedding,
+            'expires_at': self._expiry()
+        }
+        self.stats['stores'] += 1
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def mark_false_hit(self, event_id: int) -> bool:
+        """将一次命中标记为误命中，并移除对应的缓存条目"""
+        for event in self.audit:
+            if event['id'] == event_id and event['event'] == 'hit':
+                event['event'] = 'false_hit'
+                self.stats['false_hits'] += 1
+                entries = self._namespaces.get(event['namespace'], {})
+                entries.pop(event['entry_id'], None)
+                return True
+        return False
+
+    def clear(self, namespace: Optional[str] = None):
+        if namespace is None:
+            self._namespaces.clear()
+        else:
+            self._namespaces.pop(namespace, None)
+
+    def get_stats(self) -> Dict:
+        """获取命中率、误命中率与各命名空间的条目数"""
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['false_hit_rate'] = stats['false_hits'] / stats['hits'] if stats['hits'] else 0.0
+        stats['threshold'] = self.threshold
+        stats['namespaces'] = {name: len(entries) for name, entries in self._namespaces.items()}
+        return stats
+
+    def get_audit(self, limit: int = 100) -> List[dict]:
+        """获取最近的命中/未命中/误命中记录"""
+        return list(self.audit)[-limit:]
+
+    def _expiry(self) -> float:
+        return float('inf') if self.ttl is None else time.monotonic() + self.ttl
+
+    def _purge_expired(self, entries: "OrderedDict[int, dict]"):
+        now = time.monotonic()
+        for entry_id in [i for i, entry in entries.items() if entry['expires_at'] <= now]:
+            del entries[entry_id]
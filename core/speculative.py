@@ -0,0 +1,200 @@
+import logging
+from typing import Iterable, List, Optional, Tuple, Union
+
+import torch
+
+from core.batch_scheduler import BatchScheduler, GenerationRequest, _kv_layout, _map_cache
+from core.sampling import logits_to_probs
+
+
+class SpeculativeScheduler(BatchScheduler):
+    """使用草稿模型做推测解码的调度器
+
+    每轮由小草稿模型自回归地提出lookahead个token，目标模型一次前向同时验证；
+    按推测采样的接受/拒绝规则（接受概率min(1, p/q)，拒绝时从max(0, p-q)重新采样），
+    输出分布与只用目标模型逐个采样一致。请求逐个执行（batch为1）。
+    """
+
+    def __init__(
+        self,
+        model,
+        draft_model,
+        lookahead: int = 4,
+        eos_token_id: Optional[Union[int, Iterable[int]]] = None,
+        pad_token_id: int = 0,
+        name: str = "model",
+        num_threads: Optional[int] = None
+    ):
+        super().__init__(
+            model,
+            max_batch_size=1,
+            max_wait_ms=0,
+            eos_token_id=eos_token_id,
+            pad_token_id=pad_token_id,
+            name=name,
+            num_threads=num_threads
+        )
+        if lookahead < 1:
+            raise ValueError("lookahead must be at least 1")
+        self.draft_model = draft_model
+        self.lookahead = lookahead
+        self.draft_seq_dim = _kv_layout(draft_model)[1]
+        self.stats.update({'draft_tokens': 0, 'accepted_tokens': 0})
+
+    def get_stats(self):
+        """获取调度统计信息，包括草稿token的接受率"""
+        stats = super().get_stats()
+        drafted = stats['draft_tokens']
+        stats['acceptance_rate'] = stats['accepted_tokens'] / drafted if drafted else 0.0
+        return stats
+
+    def _run(self):
+        """解码主循环：逐个执行请求"""
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        while self._running:
+            for request in self._collect_new_requests():
+                self._active = [request]
+                try:
+                    with torch.inference_mode():
+                        self._speculate(request)
+                    self._complete(request)
+                except Exception as e:
+                    logging.error(f"Error in speculative scheduler for {self.name}: {str(e)}")
+                    self._fail([request], e)
+                finally:
+                    self._reset_batch()
+
+    def _speculate(self, request: GenerationRequest):
+        """对单个请求执行草稿提出、目标验证的推测解码"""
+        logits, target_cache = self._forward(self.model, request.input_ids, None, 0)
+        target_len = len(request.input_ids)
+        vocab_size = logits.shape[-1]
+        self.stats['prefill_tokens'] += target_len
+        token = self._sample(self._probs(request, logits[-1:], vocab_size))[0]
+        request.logprob_sum += float(torch.log_softmax(logits[-1].float(), dim=-1)[token])
+        self._push_token(request, token)
+
+        draft_cache, draft_len = None, 0
+        while not self._is_finished(request):
+            sequence = request.input_ids + request.output_ids
+            # 最后一轮少提议一些，保证总生成数不超过max_new_tokens
+            k = min(self.lookahead, request.max_new_tokens - len(request.output_ids) - 1)
+
+            # 草稿模型自回归提出k个token
+            drafts: List[int] = []
+            draft_probs: List[torch.Tensor] = []
+            pending = sequence[draft_len:]
+            for _ in range(k):
+                draft_logits, draft_cache = self._forward(
+                    self.draft_model, pending, draft_cache, draft_len
+                )
+                draft_len += len(pending)
+                probs = self._probs(request, draft_logits[-1:], vocab_size)
+                token = self._sample(probs)[0]
+                drafts.append(token)
+                draft_probs.append(probs[0])
+                pending = [token]
+
+            # 目标模型一次前向验证全部草稿token
+            pending = sequence[target_len:] + drafts
+            logits, target_cache = self._forward(self.model, pending, target_cache, target_len)
+            target_len += len(pending)
+            target_logits = logits[len(pending) - k - 1:]
+            target_probs = self._probs(request, target_logits, vocab_size)
+
+            new_tokens = self._verify(drafts, draft_probs, target_probs)
+            accepted_now = len(new_tokens) - 1
+            request.draft_tokens += k
+            request.accepted_tokens += accepted_now
+            self.stats['draft_tokens'] += k
+            self.stats['accepted_tokens'] += accepted_now
+            self.stats['decode_steps'] += 1
+            self.stats['batched_sequences'] += 1
+
+            # 与逐个解码一致，按目标模型的分布累计输出token的对数概率（置信度）
+            logprobs = torch.log_softmax(target_logits[:len(new_tokens)].float(), dim=-1)
+            for i, token in enumerate(new_tokens):
+                request.logprob_sum += float(logprobs[i, token])
+                self._push_token(request, token)
+                if self._is_finished(request):
+                    break
+
+            # 丢弃被拒绝的草稿token对应的KV
+            valid = len(sequence) + accepted_now
+            if target_len > valid:
+                target_cache = self._crop(target_cache, valid, self.seq_dim)
+                target_len = valid
+            if draft_len > valid:
+                draft_cache = self._crop(draft_cache, valid, self.draft_seq_dim)
+                draft_len = valid
+
+        if request.draft_tokens:
+            logging.info(
+                f"Speculative decoding for {self.name}: accepted {request.accepted_tokens}/"
+                f"{request.draft_tokens} draft tokens "
+                f"({request.accepted_tokens / request.draft_tokens:.1%})"
+            )
+
+    def _verify(
+        self,
+        drafts: List[int],
+        draft_probs: List[torch.Tensor],
+        target_probs: torch.Tensor
+    ) -> List[int]:
+        """按推测采样规则逐个验证草稿token，返回本轮生成的token
+
+        被拒绝时从残差分布重新采样；全部接受时额外从目标分布采样一个token。
+        """
+        tokens: List[int] = []
+        for i, token in enumerate(drafts):
+            p = target_probs[i]
+            q = draft_probs[i].to(p.device)
+            if float(torch.rand(())) * float(q[token]) < float(p[token]):
+                tokens.append(token)
+                continue
+            residual = (p - q).clamp(min=0)
+            if float(residual.sum()) <= 0:
+                residual = p
+            tokens.append(self._sample((residual / residual.sum()).unsqueeze(0))[0])
+            return tokens
+        tokens.append(self._sample(target_probs[len(drafts):len(drafts) + 1])[0])
+        return tokens
+
+    def _forward(self, model, token_ids: List[int], cache, cache_len: int) -> Tuple[torch.Tensor, object]:
+        """在已有KV缓存之后前向计算token_ids，返回各位置的logits [n, vocab] 与新缓存"""
+        device = model.device
+        total = cache_len + len(token_ids)
+        outputs = model(
+            input_ids=torch.tensor([token_ids], dtype=torch.long, device=device),
+            attention_mask=torch.ones((1, total), dtype=torch.long, device=device),
+            position_ids=torch.arange(cache_len, total, dtype=torch.long, device=device).unsqueeze(0),
+            past_key_values=cache,
+            use_cache=True
+        )
+        return outputs.logits[0], outputs.past_key_values
+
+    @staticmethod
+    def _crop(cache, length: int, seq_dim: int):
+        return _map_cache(cache, lambda t: t.narrow(seq_dim, 0, length))
+
+    @staticmethod
+    def _probs(request: GenerationRequest, logits: torch.Tensor, vocab_size: int) -> torch.Tensor:
+        """按请求的采样参数计算概率，并对齐到目标模型的词表大小
+
+        草稿模型词表较大时截断，较小时补0（草稿模型不会提出这些token）。
+        """
+        logits = logits[:, :vocab_size]
+        rows = logits.shape[0]
+        probs = logits_to_probs(
+            logits,
+            torch.full((rows,), request.temperature, device=logits.device),
+            torch.full((rows,), request.top_p, device=logits.device)
+        )
+        if probs.shape[-1] < vocab_size:
+            probs = torch.nn.functional.pad(probs, (0, vocab_size - probs.shape[-1]))
+        return probs
+
+    @staticmethod
+    def _sample(probs: torch.Tensor) -> List[int]:
+        return torch.multinomial(probs, num_samples=1).squeeze(-1).tolist()
@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from core.batch_scheduler import _call_in_loop, _set_future_exception, _set_future_result
+from utils.cache import Cache
+
+
+class _Job:
+    """一次分词或反分词调用"""
+
+    __slots__ = ('kind', 'payload', 'skip_special_tokens', 'loop', 'future')
+
+    def __init__(self, kind: str, payload, skip_special_tokens: bool, loop: asyncio.AbstractEventLoop):
+        self.kind = kind
+        self.payload = payload
+        self.skip_special_tokens = skip_special_tokens
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+
+
+class TokenizerPool:
+    """在专用线程中合批执行分词与反分词，避免长提示词阻塞事件循环
+
+    工作线程在max_wait窗口内收集并发的调用，编码用fast tokenizer的批量接口
+    （tokenizer(texts)），解码用batch_decode。编码结果按文本哈希缓存在LRU中，
+    重复出现的文本（如知识库片段、系统提示词）不再重复分词。
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        name: str = "model",
+        num_workers: int = 1,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 1.0,
+        cache_entries: int = 4096,
+        cache_max_bytes: Optional[int] = 64 * 1024 * 1024
+    ):
+        self.tokenizer = tokenizer
+        self.name = name
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        # 文本哈希 -> token id元组，按token数估算占用（每个id按8字节计）
+        self.cache = Cache(
+            max_size=cache_entries,
+            ttl=None,
+            max_bytes=cache_max_bytes,
+            sizeof=lambda ids: 8 * len(ids)
+        ) if cache_entries else None
+
+        self._jobs: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        # 统计由事件循环（编码、解码调用）与多个工作线程（合批）共同更新
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            'encode_calls': 0,
+            'decode_calls': 0,
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'batches': 0,
+            'batched_jobs': 0
+        }
+
+    def start(self):
+        """启动工作线程"""
+        if self._running:
+            return
+        self._running = True
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                name=f"tokenizer-{self.name}-{index}",
+                daemon=True
+            )
+            for index in range(self.num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """处理完已提交的调用后停止工作线程，停止期间提交的调用以异常结束"""
+        if not self._running:
+            return
+        self._running = False
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        error = RuntimeError(f"Tokenizer pool for {self.name} stopped")
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                _call_in_loop(job.loop, _set_future_exception, job.future, error)
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    async def encode(self, text: str) -> List[int]:
+        """编码文本为token id（不补齐、不截断）"""
+        key = None
+        ids = None
+        if self.cache is not None:
+            key = self.text_key(text)
+            ids = self.cache.get(key)
+        with self._stats_lock:
+            self.stats['encode_calls'] += 1
+            if key is not None:
+                self.stats['cache_hits' if ids is not None else 'cache_misses'] += 1
+        if ids is not None:
+            return list(ids)
+
+        ids = await self._submit('encode', text)
+        if key is not None:
+            self.cache.set(key, tuple(ids))
+        return list(ids)
+
+    async def count_tokens(self, text: str) -> int:
+        """统计文本的token数（与编码共用缓存）"""
+        return len(await self.encode(text))
+
+    async def decode(self, token_ids: Sequence[int], skip_special_tokens: bool = True) -> str:
+        """将token id解码为文本"""
+        return (await self.decode_batch([token_ids], skip_special_tokens))[0]
+
+    async def decode_batch(
+        self,
+        sequences: Sequence[Sequence[int]],
+        skip_special_tokens: bool = True
+    ) -> List[str]:
+        """批量解码多个token序列"""
+        with self._stats_lock:
+            self.stats['decode_calls'] += len(sequences)
+        return await asyncio.gather(*[
+            self._submit('decode', list(ids), skip_special_tokens) for ids in sequences
+        ])
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        batches = stats['batches']
+        stats['avg_batch_size'] = stats['batched_jobs'] / batches if batches else 0.0
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        stats['cache_hit_rate'] = stats['cache_hits'] / lookups if lookups else 0.0
+        if self.cache is not None:
+            stats['cache_entries'] = self.cache.size()
+            stats['cache_bytes'] = self.cache.used_bytes
+        stats['pending'] = self._jobs.qsize()
+        return stats
+
+    def _submit(self, kind: str, payload, skip_special_tokens: bool = True) -> asyncio.Future:
+        if not self._running:
+            raise RuntimeError(f"Tokenizer pool for {self.name} is not running")
+        job = _Job(kind, payload, skip_special_tokens, asyncio.get_running_loop())
+        self._jobs.put(job)
+        return job.future
+
+    def _run(self):
+        """工作线程主循环：收集一批调用后合批执行"""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            jobs = [job]
+            stop = False
+            deadline = time.monotonic() + self.max_wait
+            while len(jobs) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    job = self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+
+            with self._stats_lock:
+                self.stats['batches'] += 1
+                self.stats['batched_jobs'] += len(jobs)
+            self._process(jobs)
+            if stop:
+                return
+
+    def _process(self, jobs: List[_Job]):
+        """按类型分组后调用tokenizer的批量接口"""
+        groups: Dict[Tuple[str, bool], List[_Job]] = {}
+        for job in jobs:
+            if not job.future.done():
+                groups.setdefault((job.kind, job.skip_special_tokens), []).append(job)
+
+        for (kind, skip_special_tokens), group in groups.items():
+            try:
+                if kind == 'encode':
+                    results = self.tokenizer([job.payload for job in group])['input_ids']
+                else:
+                    results = self.tokenizer.batch_decode(
+                        [job.payload for job in group],
+                        skip_special_tokens=skip_special_tokens
+                    )
+            except Exception as e:
+                logging.error(f"Error in tokenizer pool for {self.name}: {str(e)}")
+                for job in group:
+                    _call_in_loop(job.loop, _set_future_exception, job.future, e)
+                continue
+            for job, result in zip(group, results):
+                _call_in_loop(job.loop, _set_future_result, job.future, result)
@@ -0,0 +1,122 @@
+import glob
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Optional, Union
+
+import transformers
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModel
+
+
+class WeightCache:
+    """预先转换为safetensors的本地权重缓存
+
+    首次加载时把模型保存到 cache_dir/<模型名> 下（safetensors格式，附带config、
+    tokenizer与远程代码）；之后从缓存加载：先在meta设备上构建空模型，再通过mmap
+    逐个读取张量直接放到目标设备，不需要先在CPU上完整复制一份权重。
+    """
+
+    COMPLETE_MARKER = ".complete"
+
+    def __init__(self, cache_dir: str = "models"):
+        self.cache_dir = cache_dir
+
+    def path(self, model_name: str) -> str:
+        return os.path.join(self.cache_dir, model_name.replace("/", "--"))
+
+    def is_cached(self, model_name: str) -> bool:
+        return os.path.exists(os.path.join(self.path(model_name), self.COMPLETE_MARKER))
+
+    def convert(self, model_name: str, model, tokenizer=None) -> float:
+        """将已加载的模型保存到缓存，返回耗时（秒）
+
+        先写入临时目录再重命名，避免进程中断时留下不完整的缓存。
+        """
+        start = time.monotonic()
+        target = self.path(model_name)
+        staging = f"{target}.tmp-{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            model.save_pretrained(staging, safe_serialization=True)
+            if tokenizer is not None:
+                tokenizer.save_pretrained(staging)
+            open(os.path.join(staging, self.COMPLETE_MARKER), "w").close()
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        elapsed = time.monotonic() - start
+        logging.info(f"Converted {model_name} to safetensors cache at {target} in {elapsed:.2f}s")
+        return elapsed
+
+    def load(
+        self,
+        model_name: str,
+        device: Optional[str],
+        phases: Dict[str, float],
+        device_map: Optional[Union[str, Dict[str, Union[int, str]]]] = None
+    ):
+        """从缓存加载模型，并把各阶段耗时写入phases
+
+        device为None（跨GPU切分，按device_map放置，默认由accelerate自动切分）时交给
+        from_pretrained以mmap方式加载，只记录总的read阶段。
+        """
+        path = self.path(model_name)
+        if device is None:
+            start = time.monotonic()
+            model = AutoModel.from_pretrained(
+                path,
+                trust_remote_code=True,
+                device_map=device_map or "auto",
+                low_cpu_mem_usage=True,
+                use_safetensors=True
+            )
+            phases['read'] = time.monotonic() - start
+            return model
+
+        # read: 以mmap方式打开所有分片，只读取文件头
+        start = time.monotonic()
+        files = [
+            safe_open(file, framework="pt", device=device)
+            for file in sorted(glob.glob(os.path.join(path, "*.safetensors")))
+        ]
+        if not files:
+            raise FileNotFoundError(f"No safetensors weights found in {path}")
+        config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+        phases['read'] = time.monotonic() - start
+
+        # materialize: 在meta设备上构建不占内存的模型骨架
+        start = time.monotonic()
+        model = self._empty_model(config)
+        phases['materialize'] = time.monotonic() - start
+
+        # move: 逐个张量从mmap读到目标设备并替换骨架中的参数
+        start = time.monotonic()
+        for file in files:
+            for name in file.keys():
+                set_module_tensor_to_device(model, name, device, value=file.get_tensor(name))
+        model.tie_weights()
+        missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+        if missing:
+            raise RuntimeError(f"Weights missing from cache for {model_name}: {missing[:5]}")
+        # 不在state_dict中的buffer仍在CPU上
+        model.to(device)
+        model.eval()
+        phases['move'] = time.monotonic() - start
+        return model
+
+    @staticmethod
+    def _empty_model(config):
+        """按缓存中记录的模型类构建空模型，远程代码模型使用AutoModel"""
+        architectures = getattr(config, "architectures", None) or []
+        model_class = getattr(transformers, architectures[0], None) if architectures else None
+        with init_empty_weights():
+            if model_class is not None:
+                return model_class._from_config(config, torch_dtype=config.torch_dtype)
+            return AutoModel.from_config(
+                config, trust_remote_code=True, torch_dtype=config.torch_dtype
+            )
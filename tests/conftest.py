@@ -158,4 +158,83 @@ def test_document() -> Generator[Path, None, None]:
     with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
         f.write('This is a test document.\nIt contains some sample text.')
         yield Path(f.name)
-    os.unlink(f.name) 
\ No newline at end of file
+    os.unlink(f.name) 
+
+@pytest.fixture
+def tiny_model():
+    """创建用于CPU测试的随机初始化小模型"""
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+    
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=64,
+        n_positions=256,
+        n_embd=32,
+        n_layer=2,
+        n_head=2
+    )
+    model = GPT2LMHeadModel(config)
+    model.eval()
+    yield model
+
+@pytest.fixture
+def reference_greedy():
+    """参照解码函数：使用HF generate单独贪心解码，返回生成的token id（不含输入）"""
+    import torch
+    
+    def generate(model, prompt, max_new_tokens):
+        with torch.no_grad():
+            output = model.generate(
+                torch.tensor([prompt]),
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=0
+            )
+        return output[0, len(prompt):].tolist()
+    
+    return generate
+
+@pytest.fixture
+def tiny_tokenizer():
+    """创建与tiny_model词表大小一致的词级分词器"""
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+    from transformers import PreTrainedTokenizerFast
+    
+    vocab = {"[PAD]": 0, "[UNK]": 1}
+    vocab.update({f"w{i}": i for i in range(2, 64)})
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    yield PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="[PAD]",
+        unk_token="[UNK]"
+    )
+
+@pytest.fixture
+def tiny_config_path(temp_dir: Path) -> Path:
+    """写入只包含一个transformers小模型的配置文件"""
+    import yaml
+    
+    config = {
+        'models': {
+            'default': 'tiny',
+            'available': [{
+                'name': 'tiny',
+                'type': 'transformers',
+                'size': 'tiny',
+                'gpu_memory': 1,
+                'max_length': 64,
+                'temperature': 0.7,
+                'top_p': 0.9
+            }]
+        },
+        'gpu': {'devices': [0], 'memory_fraction': 0.9},
+        'scheduler': {'max_batch_size': 8, 'max_wait_ms': 5},
+        'weight_cache': {'cache_dir': str(temp_dir / 'models')}
+    }
+    config_path = temp_dir / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    yield config_path
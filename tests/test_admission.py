@@ -0,0 +1,207 @@
+import asyncio
+
+import pytest
+
+from core.admission import AdmissionQueue, ModelOverloadedError, QueueTimeoutError
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    """测试同时执行的请求数不超过上限"""
+    queue = AdmissionQueue("test", max_concurrency=2, max_queue_depth=10)
+    running = 0
+    peak = 0
+
+    async def work():
+        nonlocal running, peak
+        async with queue.slot():
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*[work() for _ in range(8)])
+    assert peak == 2
+    stats = queue.get_stats()
+    assert stats['admitted'] == 8
+    assert stats['in_flight'] == 0
+    assert stats['queue_depth'] == 0
+
+
+@pytest.mark.asyncio
+async def test_reject_when_queue_full():
+    """测试排队已满时立即拒绝"""
+    queue = AdmissionQueue("test", max_concurrency=1, max_queue_depth=1)
+    await queue.acquire()
+    waiter = asyncio.ensure_future(queue.acquire())
+    await asyncio.sleep(0)
+
+    with pytest.raises(ModelOverloadedError):
+        await queue.acquire()
+    assert queue.get_stats()['rejected'] == 1
+
+    queue.release()
+    await waiter
+    queue.release()
+    assert queue.get_stats()['in_flight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_wait_timeout():
+    """测试排队超时后放弃并且不占用名额"""
+    queue = AdmissionQueue("test", max_concurrency=1, max_queue_wait=0.02)
+    await queue.acquire()
+    with pytest.raises(QueueTimeoutError):
+        await queue.acquire()
+    assert queue.get_stats()['timed_out'] == 1
+    assert queue.get_stats()['queue_depth'] == 0
+
+    queue.release()
+    await queue.acquire()
+    assert queue.get_stats()['in_flight'] == 1
+
+
+@pytest.mark.asyncio
+async def test_fifo_handoff():
+    """测试名额按到达顺序移交"""
+    queue = AdmissionQueue("test", max_concurrency=1)
+    order = []
+
+    async def work(i):
+        async with queue.slot():
+            order.append(i)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*[work(i) for i in range(5)])
+    assert order == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_is_skipped():
+    """测试取消的排队请求不会拿走名额"""
+    queue = AdmissionQueue("test", max_concurrency=1)
+    await queue.acquire()
+    cancelled = asyncio.ensure_future(queue.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+
+    queue.release()
+    assert queue.get_stats()['in_flight'] == 0
+    await asyncio.wait_for(queue.acquire(), 0.1)
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_share():
+    """测试批量任务大量排队时交互请求按权重优先获得名额"""
+    queue = AdmissionQueue("test", max_concurrency=1, max_queue_depth=100)
+    await queue.acquire(tenant="script", priority="batch", cost=100)
+    order = []
+
+    async def work(tenant, priority, i):
+        async with queue.slot(tenant, priority, cost=100):
+            order.append((priority, i))
+
+    batch = [asyncio.ensure_future(work("script", "batch", i)) for i in range(8)]
+    await asyncio.sleep(0)
+    interactive = [asyncio.ensure_future(work("user", "interactive", i)) for i in range(2)]
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(*batch, *interactive)
+
+    # interactive权重为batch的4倍，两个交互请求在前两个批量请求完成前就能执行
+    assert [entry for entry in order[:3] if entry[0] == 'interactive'] == [
+        ('interactive', 0), ('interactive', 1)
+    ]
+    # 同一流内仍保持到达顺序
+    assert [i for priority, i in order if priority == 'batch'] == list(range(8))
+
+
+@pytest.mark.asyncio
+async def test_tenant_weights_and_served_tokens():
+    """测试租户权重，以及按实际token数结算已服务token"""
+    queue = AdmissionQueue(
+        "test", max_concurrency=1, tenant_weights={"gold": 3.0}, default_priority="batch"
+    )
+    ticket = await queue.acquire(tenant="gold", cost=50)
+    assert ticket.priority == "batch"
+    order = []
+
+    async def work(tenant):
+        async with queue.slot(tenant, cost=50) as slot_ticket:
+            slot_ticket.served_tokens = 20
+            order.append(tenant)
+
+    tasks = [asyncio.ensure_future(work(tenant)) for tenant in ["silver"] * 3 + ["gold"] * 3]
+    await asyncio.sleep(0)
+    ticket.served_tokens = 40
+    queue.release(ticket)
+    await asyncio.gather(*tasks)
+
+    assert order[:3].count("gold") >= 2
+    stats = queue.get_stats()
+    assert stats['tenants']['gold']['served_tokens'] == 40 + 3 * 20
+    assert stats['tenants']['silver']['served_tokens'] == 3 * 20
+    assert stats['tenants']['silver']['admitted'] == 3
+    assert stats['tenants']['silver']['p99_wait'] >= stats['tenants']['silver']['p50_wait'] > 0
+    assert stats['priorities']['batch']['admitted'] == 7
+
+
+@pytest.mark.asyncio
+async def test_unknown_priority():
+    """测试未知优先级被拒绝且不占用名额"""
+    queue = AdmissionQueue("test", max_concurrency=1)
+    with pytest.raises(ValueError):
+        await queue.acquire(priority="urgent")
+    assert queue.get_stats()['in_flight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_shortest_predicted_first_with_aging():
+    """测试流内按预测长度短者优先，排队足够久的长请求不会被一直插队"""
+    queue = AdmissionQueue("test", max_concurrency=1, aging_rate=10000.0)
+    await queue.acquire()
+    order = []
+
+    async def work(name, predicted):
+        async with queue.slot(cost=100, predicted_tokens=predicted):
+            order.append(name)
+
+    long_task = asyncio.ensure_future(work("long", 2000))
+    await asyncio.sleep(0.05)
+    tasks = [asyncio.ensure_future(work(f"short{i}", 20)) for i in range(2)]
+    tasks.append(asyncio.ensure_future(work("medium", 100)))
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(long_task, *tasks)
+    # long排队50ms后折减到约1500，仍排在短请求之后
+    assert order == ["short0", "short1", "medium", "long"]
+
+    order.clear()
+    await queue.acquire()
+    long_task = asyncio.ensure_future(work("long", 2000))
+    await asyncio.sleep(0.25)
+    tasks = [asyncio.ensure_future(work("short", 20))]
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(long_task, *tasks)
+    # 排队超过0.2秒后老化到0以下，先于新到的短请求
+    assert order == ["long", "short"]
+
+
+@pytest.mark.asyncio
+async def test_fifo_without_aging_rate():
+    """测试未启用长度感知时流内保持到达顺序"""
+    queue = AdmissionQueue("test", max_concurrency=1)
+    await queue.acquire()
+    order = []
+
+    async def work(name, predicted):
+        async with queue.slot(predicted_tokens=predicted):
+            order.append(name)
+
+    tasks = [asyncio.ensure_future(work("long", 2000)), asyncio.ensure_future(work("short", 20))]
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(*tasks)
+    assert order == ["long", "short"]
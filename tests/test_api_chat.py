@@ -0,0 +1,115 @@
+import asyncio
+import importlib
+import os
+
+import httpx
+import pytest
+import yaml
+
+pytest.importorskip('chromadb')
+pytest.importorskip('langchain')
+
+from core.embeddings import EmbeddingEngine
+
+
+@pytest.fixture
+def main(temp_dir, tiny_config_path):
+    """按小模型配置导入api.main（模块导入时读取 config/config.yaml 创建模型管理器与知识库）"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['knowledge_base'] = {'enabled': False}
+    (temp_dir / 'config').mkdir()
+    (temp_dir / 'config' / 'config.yaml').write_text(yaml.safe_dump(config), encoding='utf-8')
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        import api.main
+        module = importlib.reload(api.main)
+    finally:
+        os.chdir(cwd)
+    yield module
+    for model_name in module.model_manager.models:
+        module.model_manager.unload_model(model_name)
+
+
+class _KnowledgeBase:
+    """与Chroma一样在检索时同步调用嵌入函数计算查询向量"""
+
+    def __init__(self, embed):
+        self.embed = embed
+
+    def search(self, query, collection_name="default", n_results=5):
+        self.embed([query])
+        return [{"content": "w10 w11", "metadata": {}, "distance": 0.0}]
+
+
+async def _post_chats(app, payloads):
+    async with httpx.AsyncClient(app=app, base_url='http://test') as client:
+        return await asyncio.gather(*[client.post('/chat', json=payload) for payload in payloads])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_knowledge_base_chats_share_embedding_batch(main, tiny_tokenizer, monkeypatch):
+    """测试并发的知识库请求在线程池中检索，查询向量在嵌入引擎中合批计算"""
+    from transformers import BertConfig, BertModel
+
+    encoder = BertModel(BertConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=64, max_position_embeddings=128
+    ))
+    encoder.eval()
+    engine = EmbeddingEngine(encoder, tiny_tokenizer, max_wait_ms=200)
+    engine.start()
+    main.model_manager.embedding_engine = engine
+    monkeypatch.setattr(main, 'knowledge_base', _KnowledgeBase(main.model_manager.embed_texts))
+
+    contexts = []
+
+    async def generate(prompt, model_name, knowledge_context=None, **kwargs):
+        contexts.append(knowledge_context)
+        return "ok"
+
+    monkeypatch.setattr(main.model_manager, 'generate', generate)
+    try:
+        responses = await _post_chats(main.app, [
+            {'prompt': 'w2 w3', 'use_knowledge_base': True},
+            {'prompt': 'w4 w5', 'use_knowledge_base': True}
+        ])
+    finally:
+        engine.stop()
+    assert [response.status_code for response in responses] == [200, 200]
+    assert contexts == ['w10 w11', 'w10 w11']
+    stats = engine.get_stats()
+    assert stats['texts'] == 2
+    assert stats['batches'] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('error', [
+    ValueError("Model missing not found"),
+    ValueError("Unknown priority urgent, expected one of ['interactive', 'batch', 'background']"),
+    ValueError("Prompt length 80 exceeds max_length 64")
+])
+async def test_client_errors_return_400(main, monkeypatch, error):
+    """测试请求参数错误（ValueError）返回400而不是500，流式接口同样在开始前返回"""
+    async def generate(*args, **kwargs):
+        raise error
+
+    async def generate_stream(*args, **kwargs):
+        raise error
+        yield
+
+    monkeypatch.setattr(main.model_manager, 'generate', generate)
+    monkeypatch.setattr(main.model_manager, 'generate_stream', generate_stream)
+    async with httpx.AsyncClient(app=main.app, base_url='http://test') as client:
+        response = await client.post('/chat', json={'prompt': 'w2 w3'})
+        assert response.status_code == 400
+        assert response.json()['detail'] == str(error)
+        response = await client.post('/chat/stream', json={'prompt': 'w2 w3'})
+        assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_unknown_model_returns_400(main):
+    """测试未知的模型经模型管理器抛出ValueError后返回400"""
+    responses = await _post_chats(main.app, [{'prompt': 'w2 w3', 'model': 'missing'}])
+    assert responses[0].status_code == 400
@@ -0,0 +1,198 @@
+import asyncio
+import time
+
+import pytest
+
+from core.batch_scheduler import BatchScheduler
+
+
+def _prompts(n, base_length=6):
+    """构造长度各不相同的测试提示"""
+    return [
+        [(i * 7 + j) % 60 + 1 for j in range(base_length + i % 4)]
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def scheduler(tiny_model):
+    """创建批处理调度器"""
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=5, name="tiny")
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_generate_matches_reference(scheduler, tiny_model, reference_greedy):
+    """测试并发合批的贪心输出与单独解码一致"""
+    prompts = _prompts(6)
+    results = await asyncio.gather(*[
+        scheduler.generate(p, max_new_tokens=12, temperature=0, top_p=1.0)
+        for p in prompts
+    ])
+    for prompt, result in zip(prompts, results):
+        assert result == reference_greedy(tiny_model, prompt, 12)
+
+
+@pytest.mark.asyncio
+async def test_admit_between_decode_steps(scheduler, tiny_model, reference_greedy):
+    """测试运行中的批次在解码步之间接纳新请求"""
+    long_prompt, short_prompt = _prompts(2)
+    long_task = asyncio.ensure_future(
+        scheduler.generate(long_prompt, max_new_tokens=40, temperature=0, top_p=1.0)
+    )
+    await asyncio.sleep(0.02)
+    short_result = await scheduler.generate(
+        short_prompt, max_new_tokens=5, temperature=0, top_p=1.0
+    )
+    long_result = await long_task
+
+    assert short_result == reference_greedy(tiny_model, short_prompt, 5)
+    assert long_result == reference_greedy(tiny_model, long_prompt, 40)
+
+
+@pytest.mark.asyncio
+async def test_eos_retires_sequence(tiny_model, reference_greedy):
+    """测试生成eos后序列提前结束"""
+    prompt = _prompts(1)[0]
+    reference = reference_greedy(tiny_model, prompt, 10)
+    scheduler = BatchScheduler(tiny_model, eos_token_id=reference[2], name="tiny")
+    scheduler.start()
+    try:
+        result = await scheduler.generate(prompt, max_new_tokens=10, temperature=0)
+    finally:
+        scheduler.stop()
+    assert result == reference[:reference.index(reference[2]) + 1]
+
+
+@pytest.mark.asyncio
+async def test_throughput_scales_with_concurrency(scheduler):
+    """测试总吞吐（tokens/sec）随并发数提升"""
+    async def run(concurrency):
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            scheduler.generate(p, max_new_tokens=32, temperature=0.8, top_p=0.9)
+            for p in _prompts(concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+        return sum(len(r) for r in results) / elapsed
+
+    await run(1)  # 预热
+    single = await run(1)
+    batched = await run(8)
+
+    assert batched > 2 * single
+    assert scheduler.get_stats()['avg_batch_size'] > 1
+
+
+@pytest.mark.asyncio
+async def test_submit_requires_running(tiny_model):
+    """测试未启动的调度器拒绝请求"""
+    scheduler = BatchScheduler(tiny_model)
+    with pytest.raises(RuntimeError):
+        scheduler.submit([1, 2, 3], max_new_tokens=4)
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_tokens_in_order(scheduler, tiny_model, reference_greedy):
+    """测试流式接口逐个产出与非流式一致的token"""
+    prompt = _prompts(1)[0]
+    tokens = [
+        token async for token in scheduler.stream(prompt, max_new_tokens=10, temperature=0)
+    ]
+    assert tokens == reference_greedy(tiny_model, prompt, 10)
+
+
+@pytest.mark.asyncio
+async def test_stream_early_exit_releases_slot(scheduler):
+    """测试提前结束流式迭代后请求移出批次"""
+    prompt = _prompts(1)[0]
+    async for _ in scheduler.stream(prompt, max_new_tokens=200, temperature=0):
+        break
+    await asyncio.sleep(0.05)
+    assert scheduler.get_stats()['active'] == 0
+
+
+@pytest.fixture
+def slow_model(tiny_model):
+    """每次前向计算额外耗时10ms，便于在生成过程中取消"""
+    handle = tiny_model.register_forward_hook(lambda *args: time.sleep(0.01))
+    yield tiny_model
+    handle.remove()
+
+
+@pytest.mark.asyncio
+async def test_cancel_stops_decoding(slow_model):
+    """测试取消生成后请求在下一个解码步移出批次，并统计浪费与节省的token数"""
+    scheduler = BatchScheduler(slow_model, max_batch_size=4, max_wait_ms=5, name="tiny")
+    scheduler.start()
+    try:
+        prompts = _prompts(2)
+        task = asyncio.ensure_future(scheduler.generate(prompts[0], max_new_tokens=200, temperature=0))
+        other = asyncio.ensure_future(scheduler.generate(prompts[1], max_new_tokens=20, temperature=0))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert len(await other) == 20
+        await asyncio.sleep(0.05)
+
+        stats = scheduler.get_stats()
+        assert stats['active'] == 0
+        assert stats['cancelled'] == 1
+        assert stats['completed'] == 1
+        assert 0 < stats['cancelled_tokens'] < 200
+        assert stats['cancelled_tokens'] + stats['saved_tokens'] == 200
+        assert stats['generated_tokens'] == stats['cancelled_tokens'] + 20
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_cancel_pending_request_skips_prefill(slow_model):
+    """测试排队中被取消的请求不做prefill，直接从队列丢弃"""
+    scheduler = BatchScheduler(slow_model, max_batch_size=1, max_wait_ms=0, name="tiny")
+    scheduler.start()
+    try:
+        first, second = _prompts(2)
+        running = asyncio.ensure_future(scheduler.generate(first, max_new_tokens=10, temperature=0))
+        await asyncio.sleep(0.02)
+        waiting = asyncio.ensure_future(scheduler.generate(second, max_new_tokens=10, temperature=0))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await running
+        await asyncio.sleep(0.05)
+
+        stats = scheduler.get_stats()
+        assert stats['prefill_tokens'] == len(first)
+        assert stats['cancelled'] == 1
+        assert stats['cancelled_tokens'] == 0
+        assert stats['saved_tokens'] == 10
+        assert stats['pending'] == 0
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop_timeout_leaves_requests_to_decode_thread(tiny_model):
+    """测试停止超时时解码线程仍在前向计算，由它在该步完成后结束请求，不并发修改批次"""
+    handle = tiny_model.register_forward_hook(lambda *args: time.sleep(0.2))
+    scheduler = BatchScheduler(tiny_model, max_batch_size=1, max_wait_ms=0, name="tiny")
+    scheduler.start()
+    try:
+        first, second = _prompts(2)
+        running = asyncio.ensure_future(scheduler.generate(first, max_new_tokens=10, temperature=0))
+        await asyncio.sleep(0.1)
+        waiting = asyncio.ensure_future(scheduler.generate(second, max_new_tokens=10, temperature=0))
+        await asyncio.sleep(0)
+        scheduler.stop(timeout=0.01)
+        assert not running.done()
+        with pytest.raises(RuntimeError, match='stopped'):
+            await running
+        with pytest.raises(RuntimeError, match='stopped'):
+            await waiting
+        assert scheduler.get_stats()['failed'] == 2
+    finally:
+        handle.remove()
+        scheduler.stop()
@@ -0,0 +1,161 @@
+from unittest.mock import patch
+
+import pytest
+import torch
+import yaml
+
+from core.cascade import CascadeRouter, model_cost
+from core.model_manager import ModelManager
+
+MODELS = [
+    {'name': 'large', 'size': '7b', 'max_length': 4096},
+    {'name': 'small', 'size': '0.5b', 'max_length': 512},
+    {'name': 'medium', 'cost': 2.0, 'max_length': 2048}
+]
+
+
+def test_select_cheapest_model_that_fits():
+    """测试按开销从低到高选择放得下请求、预期延迟在预算内的模型"""
+    router = CascadeRouter(MODELS, min_new_tokens=64, max_latency=2.0, log_interval=0)
+    assert router.models == ['small', 'medium', 'large']
+    assert model_cost(MODELS[0]) == 7.0
+
+    idle = {name: (0, 4) for name in router.models}
+    assert router.select(100, None, idle)[0] == 'small'
+    # 提示词加上最少生成长度超过小模型的max_length
+    assert router.select(480, None, idle)[0] == 'medium'
+    assert router.select(100, 3000, idle)[0] == 'large'
+    assert router.select(5000, None, idle) == ('large', "prompt exceeds every model's max_length")
+
+    # 小模型排队严重时预期延迟超出预算，选择下一个模型
+    for _ in range(5):
+        router.record(0, 'small', 'test', 1.0, 100)
+    assert router.expected_latency('small', 8, 4) == pytest.approx(3.0)
+    assert router.select(100, None, {**idle, 'small': (8, 4)})[0] == 'medium'
+    # 所有模型都超出预算时选择预期延迟最低的
+    for name in ('medium', 'large'):
+        for _ in range(5):
+            router.record(0, name, 'test', 5.0, 100)
+    assert router.select(100, None, {**idle, 'small': (8, 4)})[0] == 'small'
+
+    assert router.escalation_target('small', 100, None) == 'medium'
+    assert router.escalation_target('medium', 480, None) == 'large'
+    assert router.escalation_target('large', 100, None) is None
+
+
+def test_confidence_and_savings():
+    """测试低置信度与不确定回答的判断，以及相对最贵模型节省的开销"""
+    router = CascadeRouter(MODELS, min_confidence=0.4, log_interval=0)
+    assert router.is_confident("Paris", 0.9)
+    assert not router.is_confident("Paris", 0.2)
+    assert not router.is_confident("  ")
+    assert not router.is_confident("I'm not sure, maybe Paris")
+
+    router.record(1, 'small', 'cheapest model that fits', 0.1, 1000)
+    router.record(2, 'small', 'cheapest model that fits', 0.1, 1000)
+    router.record(2, 'large', 'low confidence', 0.5, 1000, escalated_from='small', confidence=0.9)
+    stats = router.get_stats()
+    assert stats['requests'] == 2
+    assert stats['escalations'] == 1
+    assert stats['baseline_cost'] == pytest.approx(14.0)
+    assert stats['cost'] == pytest.approx(0.5 + 0.5 + 7.0)
+    assert stats['saved_cost'] == pytest.approx(6.0)
+    assert stats['models']['large']['requests'] == 1
+    assert router.get_decisions()[-1]['escalated_from'] == 'small'
+
+
+@pytest.fixture
+def cascade_config_path(tiny_config_path):
+    """两个transformers模型：便宜的small（max_length 32）与贵的large，启用auto路由"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    tiny = config['models']['available'][0]
+    config['models']['available'] = [
+        {**tiny, 'name': 'small', 'size': '1b', 'max_length': 32},
+        {**tiny, 'name': 'large', 'size': '7b', 'max_length': 64}
+    ]
+    config['models']['default'] = 'small'
+    config['gpu']['device_memory'] = 4
+    config['cpu'] = {'quantize': None}
+    config['routing'] = {'enabled': True, 'min_new_tokens': 8, 'escalation': {'min_confidence': 0.0}}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    return tiny_config_path
+
+
+def _set_min_confidence(path, value):
+    config = yaml.safe_load(path.read_text(encoding='utf-8'))
+    config['routing']['escalation']['min_confidence'] = value
+    path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+
+@pytest.fixture
+def two_models(tiny_model):
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(1)
+    large = GPT2LMHeadModel(GPT2Config(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2))
+    large.eval()
+    return {'small': tiny_model, 'large': large}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('min_confidence', [0.0, 1.1])
+async def test_auto_routing_in_manager(cascade_config_path, two_models, tiny_tokenizer, min_confidence):
+    """测试model为auto时选择便宜的模型，长提示词路由到大模型，置信度低时升级"""
+    _set_min_confidence(cascade_config_path, min_confidence)
+    manager = ModelManager(str(cascade_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=lambda name, **_: two_models[name]), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            usage = {}
+            short = await manager.generate('auto', 'w2 w3 w4', temperature=0, usage=usage)
+            if min_confidence > 1:
+                # 置信度不可能达到1.1，小模型的回答被大模型重新生成
+                assert usage['model'] == 'large'
+                assert short == await manager.generate('large', 'w2 w3 w4', temperature=0)
+            else:
+                assert usage['model'] == 'small'
+                assert 0 < usage['confidence'] <= 1
+                assert short == await manager.generate('small', 'w2 w3 w4', temperature=0)
+
+            # 估计的提示词长度加上最少生成长度超过small的max_length
+            long_prompt = " ".join(f"w{i % 60 + 2}" for i in range(20))
+            chunks = [delta async for delta in manager.generate_stream('auto', long_prompt, temperature=0, usage=usage)]
+            assert usage['model'] == 'large'
+            assert "".join(chunks) == await manager.generate('large', long_prompt, temperature=0)
+
+            stats = manager.get_routing_stats()
+            assert stats['requests'] == 2
+            assert stats['escalations'] == (1 if min_confidence > 1 else 0)
+            assert [d['model'] for d in stats['decisions']] == (
+                ['small', 'large', 'large'] if min_confidence > 1 else ['small', 'large']
+            )
+            assert stats['saved_cost'] > 0 or min_confidence > 1
+        finally:
+            manager.unload_model('small')
+            manager.unload_model('large')
+
+
+@pytest.mark.asyncio
+async def test_speculative_tier_escalates(cascade_config_path, two_models, tiny_tokenizer):
+    """测试配置了草稿模型（推测解码）的便宜模型同样报告置信度，置信度低时升级"""
+    config = yaml.safe_load(cascade_config_path.read_text(encoding='utf-8'))
+    config['models']['available'][0]['draft_model'] = {'name': 'draft', 'lookahead': 3}
+    config['routing']['escalation']['min_confidence'] = 0.5
+    cascade_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    models = {**two_models, 'draft': two_models['large']}
+
+    manager = ModelManager(str(cascade_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=lambda name, **_: models[name]), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            usage = {}
+            await manager.generate('auto', 'w2 w3 w4', temperature=0, usage=usage)
+            # 随机初始化的小模型生成token的平均概率远低于0.5
+            decisions = manager.get_routing_stats()['decisions']
+            assert decisions[0]['model'] == 'small'
+            assert 0 < decisions[0]['confidence'] < 0.5
+            assert usage['model'] == 'large'
+            assert manager.get_routing_stats()['escalations'] == 1
+        finally:
+            manager.unload_model('small')
+            manager.unload_model('large')
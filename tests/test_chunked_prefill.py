@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from core.batch_scheduler import BatchScheduler
+from core.kv_cache import PagedKVCache
+from core.prefix_cache import PrefixCache
+
+
+def _long_prompt(seed, length=45):
+    return [(seed * 7 + j * 13) % 62 + 2 for j in range(length)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('paged', [False, True])
+async def test_chunked_prefill_matches_single_shot(tiny_model, paged, reference_greedy):
+    """测试分块prefill（含前缀命中后的后缀分块）的结果与整段prefill一致"""
+    kv = PagedKVCache(block_size=4, max_bytes=1 << 20) if paged else None
+    prefix_cache = PrefixCache(block_size=4, max_bytes=1 << 20)
+    scheduler = BatchScheduler(
+        tiny_model, max_batch_size=8, max_wait_ms=5, name="tiny",
+        prefix_cache=prefix_cache, kv_cache=kv, prefill_chunk_size=8
+    )
+    scheduler.start()
+    try:
+        prompts = [_long_prompt(1), _long_prompt(2, 30), [3, 4, 5], [6, 7]]
+        results = await asyncio.gather(*[
+            scheduler.generate(prompt, 12, temperature=0) for prompt in prompts
+        ])
+        for prompt, result in zip(prompts, results):
+            assert result == reference_greedy(tiny_model, prompt, 12)
+        assert scheduler.get_stats()['prefill_chunks'] == 6 + 4
+
+        # 前12个token命中前缀缓存，剩余的后缀仍超过分块大小
+        more = _long_prompt(1)[:12] + _long_prompt(3, 20)
+        assert await scheduler.generate(more, 12, temperature=0) == reference_greedy(tiny_model, more, 12)
+        stats = scheduler.get_stats()
+        assert stats['prefix_cache']['hits'] >= 1
+        assert stats['prefill_chunks'] == 6 + 4 + 3
+        assert stats['prefilling'] == 0
+        if paged:
+            assert stats['kv_cache']['sequences'] == 0
+            assert stats['kv_cache']['used_blocks'] == prefix_cache.get_stats()['blocks']
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_chunks_interleave_with_decode(tiny_model, reference_greedy):
+    """测试长输入的各块之间穿插正在解码序列的解码步，且每次前向不超过分块大小"""
+    forwards = []
+    forward = tiny_model.forward
+
+    def spy(*args, **kwargs):
+        forwards.append(tuple(kwargs['input_ids'].shape))
+        return forward(*args, **kwargs)
+
+    tiny_model.forward = spy
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=5, name="tiny", prefill_chunk_size=8)
+    scheduler.start()
+    try:
+        short = [5, 9, 11]
+        tokens = scheduler.stream(short, 30, temperature=0)
+        first = await tokens.__anext__()
+        long_prompt = _long_prompt(4, 40)
+        long_result = asyncio.ensure_future(scheduler.generate(long_prompt, 4, temperature=0))
+        short_result = [first] + [token async for token in tokens]
+        await long_result
+    finally:
+        scheduler.stop()
+        del tiny_model.forward
+    assert short_result == reference_greedy(tiny_model, short, 30)
+    assert long_result.result() == reference_greedy(tiny_model, long_prompt, 4)
+
+    chunks = [i for i, shape in enumerate(forwards) if shape == (1, 8)]
+    assert len(chunks) == 5
+    # 相邻两块之间恰好一次只含短序列的解码步
+    for before, after in zip(chunks, chunks[1:]):
+        assert forwards[before + 1:after] == [(1, 1)]
+    assert max(shape[0] * shape[1] for shape in forwards) <= 8
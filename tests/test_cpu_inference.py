@@ -0,0 +1,102 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import torch
+import yaml
+
+from core.batch_scheduler import BatchScheduler
+from core.cpu_inference import prepare_cpu_model, quantize_dynamic_int8
+from core.model_manager import ModelManager
+
+
+@pytest.fixture
+def llama_model():
+    """使用nn.Linear的小型Llama模型"""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=64,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=256
+    ))
+    model.eval()
+    return model
+
+
+def test_quantize_linear_layers(llama_model):
+    """测试线性层被替换为动态int8量化层，输出与原模型接近"""
+    input_ids = torch.tensor([[2, 3, 4, 5, 6]])
+    with torch.inference_mode():
+        expected = llama_model(input_ids).logits
+
+    model = quantize_dynamic_int8(llama_model)
+    assert not any(type(module) is torch.nn.Linear for module in model.modules())
+    with torch.inference_mode():
+        logits = model(input_ids).logits
+    assert torch.allclose(logits, expected, atol=0.05)
+
+
+def test_half_precision_is_upcast(llama_model):
+    """测试半精度模型先转换为float32再量化"""
+    model = quantize_dynamic_int8(llama_model.half())
+    with torch.inference_mode():
+        assert model(torch.tensor([[2, 3]])).logits.dtype == torch.float32
+
+
+def test_benchmark_report(llama_model):
+    """测试报告量化前后的解码速度"""
+    _, report = prepare_cpu_model(llama_model, quantize="int8", num_threads=1, benchmark=True)
+    assert report['quantize'] == 'int8'
+    assert report['baseline_tokens_per_sec'] > 0
+    assert report['tokens_per_sec'] > 0
+    assert report['speedup'] == pytest.approx(
+        report['tokens_per_sec'] / report['baseline_tokens_per_sec']
+    )
+
+    with pytest.raises(ValueError):
+        prepare_cpu_model(llama_model, quantize="int4")
+
+
+@pytest.mark.asyncio
+async def test_scheduler_with_quantized_model(llama_model):
+    """测试量化模型在限定线程数的调度器中正常解码"""
+    model, _ = prepare_cpu_model(llama_model)
+    scheduler = BatchScheduler(model, max_wait_ms=5, name="llama", num_threads=1)
+    scheduler.start()
+    try:
+        results = await asyncio.gather(*[
+            scheduler.generate([2 + i, 3, 4], 8, temperature=0) for i in range(4)
+        ])
+    finally:
+        scheduler.stop()
+    assert all(len(result) == 8 for result in results)
+
+
+@pytest.mark.asyncio
+async def test_manager_cpu_mode(tiny_config_path, llama_model, tiny_tokenizer):
+    """测试没有CUDA时模型按cpu配置量化，并在加载记录中报告解码速度"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['cpu'] = {'quantize': 'int8', 'num_threads': 2}
+    config['models']['available'][0]['cpu'] = {'benchmark': True}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.torch.cuda.is_available', return_value=False), \
+            patch('core.model_manager.AutoModel.from_pretrained', return_value=llama_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    try:
+        replica = manager.models['tiny']['replicas'][0]
+        assert replica.scheduler.num_threads == 2
+        assert not any(type(module) is torch.nn.Linear for module in replica.instance.modules())
+        report = manager.get_model_status()['tiny']['load_phases']['replicas'][0]['cpu']
+        assert report['speedup'] > 0
+
+        assert await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+    finally:
+        manager.unload_model('tiny')
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+import yaml
+
+from core.device_map import (
+    GiB, DeviceMapError, align_device_map, group_modules, main, model_tensor_names,
+    plan_device_map, read_weight_sizes
+)
+
+
+def _modules(num_layers=8, layer_gb=1.0):
+    """合成的模型：嵌入、num_layers个相同大小的层、最后的norm与输出头"""
+    return (
+        [('model.embed_tokens', int(0.5 * GiB), False)]
+        + [(f'model.layers.{i}', int(layer_gb * GiB), True) for i in range(num_layers)]
+        + [('model.norm', 1024, False), ('lm_head', int(0.5 * GiB), False)]
+    )
+
+
+def test_plan_balances_layers_by_capacity():
+    """测试层按设备预算连续、成比例地切分，并按层预留KV缓存"""
+    capacities = {0: 16 * GiB, 1: 16 * GiB, 2: 8 * GiB}
+    plan = plan_device_map(_modules(), capacities, kv_cache_bytes=8 * GiB)
+    devices = plan.devices
+
+    assert plan.device_map['model.embed_tokens'] == 0
+    assert plan.device_map['lm_head'] == 2
+    # 层按顺序连续放置
+    order = [plan.device_map[f'model.layers.{i}'] for i in range(8)]
+    assert order == sorted(order)
+    # 最大的预算占用比例最小：嵌入+3层、4层、1层+输出头，分别占用 6.5/16、8/16、2.5/8
+    assert [len(devices[d]['layers']) for d in (0, 1, 2)] == [3, 4, 1]
+    assert max(
+        (info['weights'] + info['kv_cache']) / capacities[d] for d, info in devices.items()
+    ) == pytest.approx(0.5, abs=1e-3)
+    # 每层1G权重 + 1G KV
+    assert devices[1]['kv_cache'] == pytest.approx(4 * GiB)
+    assert sum(info['kv_cache'] for info in devices.values()) == pytest.approx(8 * GiB)
+    for device, info in devices.items():
+        assert info['weights'] + info['kv_cache'] <= capacities[device]
+    assert sum(info['weights'] for info in devices.values()) == sum(size for _, size, _ in _modules())
+
+    # 不同大小的卡：小卡分到的层更少
+    uneven = plan_device_map(_modules(), {0: 4 * GiB, 1: 12 * GiB})
+    assert len(uneven.devices[0]['layers']) < len(uneven.devices[1]['layers'])
+
+    with pytest.raises(DeviceMapError):
+        plan_device_map(_modules(), capacities, kv_cache_bytes=40 * GiB)
+    assert '3-6' in plan.format()
+
+
+def test_read_index_and_align(temp_dir, tiny_model):
+    """测试从分片的safetensors索引读取各层大小，并把规划对应到AutoModel加载的基座模型"""
+    path = temp_dir / 'tiny'
+    tiny_model.save_pretrained(str(path), safe_serialization=True, max_shard_size='50KB')
+    assert (path / 'model.safetensors.index.json').exists()
+
+    sizes = read_weight_sizes(str(path))
+    state = tiny_model.state_dict()
+    for name, size in sizes.items():
+        assert size == state[name].numel() * state[name].element_size()
+
+    modules = group_modules(sizes)
+    names = [name for name, _, _ in modules]
+    assert set(names[:2]) == {'transformer.wte', 'transformer.wpe'}
+    assert names[2:] == ['transformer.h.0', 'transformer.h.1', 'transformer.ln_f']
+    assert [is_layer for _, _, is_layer in modules] == [False, False, True, True, False]
+    total = sum(sizes.values())
+    plan = plan_device_map(modules, {0: total * 0.7, 1: total * 0.7})
+    assert plan.device_map['transformer.h.0'] == 0
+    assert plan.device_map['transformer.h.1'] == 1
+
+    # AutoModel按GPT2Model加载，模块名没有transformer前缀
+    names = model_tensor_names(str(path))
+    aligned = align_device_map(plan.device_map, names)
+    assert aligned['h.0'] == 0 and aligned['h.1'] == 1 and aligned['ln_f'] == 1
+    for name in names:
+        assert any(name == key or name.startswith(key + '.') for key in aligned)
+
+
+def test_dry_run_cli(temp_dir, tiny_model, capsys):
+    """测试命令行dry run按配置打印各模型副本的规划，放不下时返回非零状态"""
+    path = temp_dir / 'tiny'
+    tiny_model.save_pretrained(str(path), safe_serialization=True)
+    total = sum(read_weight_sizes(str(path)).values())
+    config = {
+        'models': {'available': [
+            {'name': str(path), 'type': 'transformers', 'gpu_memory': total * 1.5 / GiB},
+            {'name': 'remote', 'type': 'ollama'}
+        ]},
+        'gpu': {'devices': [0, 1], 'memory_fraction': 0.9},
+        'weight_cache': {'enabled': False}
+    }
+    config_path = temp_dir / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    assert main(['--config', str(config_path), '--device-memory', str(total / GiB), '--json']) == 0
+    plans = json.loads(capsys.readouterr().out)
+    plan = plans[f'{path} replica 0']
+    assert set(plan['devices']) == {'0', '1'}
+    # 声明的gpu_memory超出权重的部分作为KV缓存预留
+    kv = sum(device['kv_cache'] for device in plan['devices'].values())
+    assert kv == pytest.approx(total * 0.5)
+    assert all(device['layers'] for device in plan['devices'].values())
+
+    assert main(['--config', str(config_path), '--device-memory', str(total / 4 / GiB)]) == 1
+    assert 'does not fit' in capsys.readouterr().out
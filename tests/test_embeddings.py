@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import wait
+from unittest.mock import patch
+
+import pytest
+import torch
+
+from core.embeddings import EmbeddingEngine, convert_embeddings
+from core.model_manager import ModelManager
+
+
+@pytest.fixture
+def tiny_encoder():
+    """创建与tiny_tokenizer词表一致的随机初始化小编码器"""
+    from transformers import BertConfig, BertModel
+
+    torch.manual_seed(0)
+    model = BertModel(BertConfig(
+        vocab_size=64,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=128
+    ))
+    model.eval()
+    yield model
+
+
+@pytest.fixture
+def engine(tiny_encoder, tiny_tokenizer):
+    engine = EmbeddingEngine(
+        tiny_encoder,
+        tiny_tokenizer,
+        max_batch_size=64,
+        max_batch_tokens=32,
+        max_wait_ms=20
+    )
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+TEXTS = [
+    "w2 w3",
+    "w4 w5 w6 w7 w8 w9 w10 w11",
+    "w12",
+    "w13 w14 w15 w16",
+    "w17 w18 w19 w20 w21 w22 w23 w24 w25 w26 w27 w28"
+]
+
+
+def test_batched_matches_single(engine):
+    """测试合批（补齐、按长度重排、按token预算切分）与逐条计算的向量一致"""
+    batched = torch.tensor(engine.embed(TEXTS))
+    single = torch.tensor([engine.embed([text])[0] for text in TEXTS])
+    assert batched.shape == (len(TEXTS), 32)
+    assert torch.allclose(batched, single, atol=1e-5)
+    assert torch.allclose(batched.norm(dim=-1), torch.ones(len(TEXTS)), atol=1e-5)
+
+
+def test_concurrent_calls_are_batched(engine):
+    """测试并发调用合并为一批，且每次前向补齐后的token数不超过max_batch_tokens"""
+    futures = [engine.submit([text]) for text in TEXTS * 4]
+    wait(futures)
+    stats = engine.get_stats()
+    assert stats['texts'] == len(TEXTS) * 4
+    assert stats['batches'] < len(futures)
+    assert stats['padded_tokens'] <= stats['forward_passes'] * 32
+    assert stats['texts_per_sec'] > 0
+    vectors, num_tokens = futures[1].result()
+    assert vectors.shape == (1, 32)
+    assert num_tokens == 8
+
+
+def test_convert_embeddings():
+    """测试float16与int8输出"""
+    vectors = torch.nn.functional.normalize(torch.randn(3, 16), dim=-1)
+    half = torch.tensor(convert_embeddings(vectors, 'float16'))
+    assert torch.allclose(half, vectors, atol=1e-3)
+    quantized = convert_embeddings(vectors, 'int8')
+    assert all(isinstance(value, int) and -127 <= value <= 127 for row in quantized for value in row)
+    restored = torch.tensor(quantized, dtype=torch.float32) / 127
+    assert torch.allclose(restored, vectors, atol=1 / 127)
+    with pytest.raises(ValueError):
+        convert_embeddings(vectors, 'int4')
+
+
+@pytest.mark.asyncio
+async def test_manager_embeddings(tiny_config_path, tiny_encoder, tiny_tokenizer):
+    """测试ModelManager懒加载嵌入模型一次，并发请求共用同一个引擎"""
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_encoder) as load, \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            responses = await asyncio.gather(*[
+                manager.embeddings(text) for text in TEXTS
+            ])
+            assert load.call_count == 1
+            assert [len(response['data']) for response in responses] == [1] * len(TEXTS)
+            assert responses[0]['usage']['prompt_tokens'] == 2
+
+            response = await manager.embeddings(TEXTS, dtype='int8')
+            assert response['dtype'] == 'int8'
+            assert isinstance(response['data'][0]['embedding'][0], int)
+            assert len(manager.embed_texts(["w2 w3"])[0]) == 32
+
+            with pytest.raises(ValueError):
+                await manager.embeddings(TEXTS, model_id='unknown')
+            with pytest.raises(ValueError):
+                await manager.embeddings(TEXTS, dtype='int4')
+            assert manager.get_embedding_stats()['texts'] == len(TEXTS) * 2 + 1
+        finally:
+            manager.embedding_engine.stop()
@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+import torch
+
+from core.batch_scheduler import BatchScheduler
+from core.kv_cache import KVCacheFullError, PagedKVCache
+from core.prefix_cache import PrefixCache
+
+
+def _random_cache(batch, length, layers=2):
+    """HF布局的past_key_values：每层 (key, value)，形状 [batch, heads, seq, head_dim]"""
+    return tuple(
+        (torch.randn(batch, 2, length, 4), torch.randn(batch, 2, length, 4))
+        for _ in range(layers)
+    )
+
+
+def _row(cache, row, start, end):
+    return [t[row, :, start:end] for layer in cache for t in layer]
+
+
+def _assert_same(left, right):
+    assert all(torch.equal(a, b) for a, b in zip(left, right))
+
+
+def test_allocate_gather_and_free():
+    """测试按块分配、按块表拼出左侧补齐的KV，以及释放后块回到空闲链表"""
+    kv = PagedKVCache(block_size=4, max_bytes=8 * 4 * 128)
+    cache = _random_cache(2, 6)
+    kv.write('a', cache, 0, 0, 6)
+    kv.write('b', cache, 1, 3, 3)
+    assert kv.num_blocks == 8
+    assert kv.block_table('a') == [0, 1]
+    assert kv.free_blocks == 5
+
+    step = _random_cache(2, 1)
+    kv.append(['a', 'b'], step)
+    assert kv.length('a') == 7 and kv.length('b') == 4
+
+    past, mask = kv.gather(['a', 'b'])
+    assert mask.tolist() == [[1] * 7, [0, 0, 0, 1, 1, 1, 1]]
+    _assert_same(_row(past, 0, 0, 6), _row(cache, 0, 0, 6))
+    _assert_same(_row(past, 0, 6, 7), _row(step, 0, 0, 1))
+    _assert_same(_row(past, 1, 3, 6), _row(cache, 1, 3, 6))
+    _assert_same(_row(past, 1, 6, 7), _row(step, 1, 0, 1))
+
+    stats = kv.get_stats()
+    assert stats['used_blocks'] == 3
+    assert stats['utilization'] == pytest.approx(3 / 8)
+    # 3块共12个槽位存放11个token
+    assert stats['fragmentation'] == pytest.approx(1 / 12)
+
+    kv.free('a')
+    kv.free('b')
+    assert kv.free_blocks == 8
+    assert 'a' not in kv
+    with pytest.raises(KVCacheFullError):
+        kv.write('c', _random_cache(1, 40), 0, 0, 40)
+    assert kv.free_blocks == 8
+
+
+def test_shared_blocks_copy_on_write():
+    """测试共享块的引用计数，以及向共享的未满块追加时先复制"""
+    kv = PagedKVCache(block_size=4, max_bytes=8 * 4 * 128)
+    cache = _random_cache(1, 6)
+    kv.write('a', cache, 0, 0, 6)
+    full, partial = kv.block_table('a')
+
+    # 另一个序列复用完整的第一块
+    kv.write('b', cache, 0, 4, 2, prefix_blocks=[kv.retain(full)])
+    assert kv.block_table('b')[0] == full
+    assert kv.get_stats()['shared_blocks'] == 1
+
+    # 模拟fork：共享未满的最后一块，追加时复制
+    kv.retain(partial)
+    kv._tables['c'] = [kv.retain(full), partial]
+    kv._lengths['c'] = 6
+    assert kv.blocks_needed(['c'], 1) == 1
+    kv.append(['c'], _random_cache(1, 1))
+    assert kv.stats['cow_copies'] == 1
+    assert kv.block_table('c')[1] != partial
+    past, _ = kv.gather(['a', 'c'])
+    # a比c短一个token，左侧补齐1位
+    _assert_same(_row(past, 0, 1, 7), _row(past, 1, 0, 6))
+
+    for seq in ('a', 'b', 'c'):
+        kv.free(seq)
+    assert kv.free_blocks == kv.num_blocks
+
+
+def test_swap_out_and_in():
+    """测试换出到主机内存释放块，换入后KV不变；交换空间不足时拒绝换出"""
+    kv = PagedKVCache(block_size=4, max_bytes=4 * 4 * 128, swap_max_bytes=10 * 128)
+    cache = _random_cache(1, 10)
+    kv.write('a', cache, 0, 0, 10)
+    assert kv.swap_out('a')
+    assert kv.is_swapped('a') and 'a' not in kv
+    assert kv.free_blocks == 4
+    assert kv.get_stats()['swap_used_bytes'] == 10 * 128
+
+    kv.write('b', cache, 0, 0, 10)
+    assert not kv.swap_in('a')
+    assert not kv.swap_out('b')
+    kv.free('b')
+
+    assert kv.swap_in('a')
+    past, _ = kv.gather(['a'])
+    _assert_same(_row(past, 0, 0, 10), _row(cache, 0, 0, 10))
+    assert kv.swap_used_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_paged_scheduler_matches_reference(tiny_model, reference_greedy):
+    """测试分页KV缓存下的合批生成与单独贪心解码一致，前缀缓存共享块而不复制"""
+    kv = PagedKVCache(block_size=4, max_bytes=1 << 20)
+    prefix_cache = PrefixCache(block_size=4, max_bytes=1 << 20)
+    scheduler = BatchScheduler(
+        tiny_model, max_batch_size=8, max_wait_ms=5, name="tiny",
+        prefix_cache=prefix_cache, kv_cache=kv
+    )
+    scheduler.start()
+    try:
+        shared = [(j * 5) % 60 + 2 for j in range(9)]
+        prompts = [shared + [9 + i] * (i + 1) for i in range(4)] + [[3, 4, 5]]
+        results = await asyncio.gather(*[
+            scheduler.generate(prompt, 12, temperature=0) for prompt in prompts
+        ])
+        for prompt, result in zip(prompts, results):
+            assert result == reference_greedy(tiny_model, prompt, 12)
+
+        more = shared + [40, 41]
+        assert await scheduler.generate(more, 12, temperature=0) == reference_greedy(tiny_model, more, 12)
+        stats = scheduler.get_stats()
+        assert stats['prefix_cache']['hits'] >= 1
+        # 序列结束后只剩前缀缓存引用的块
+        assert stats['kv_cache']['sequences'] == 0
+        assert stats['kv_cache']['used_blocks'] == prefix_cache.get_stats()['blocks']
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('swap_max_bytes', [1 << 20, 0])
+async def test_preemption_under_tiny_budget(tiny_model, swap_max_bytes, reference_greedy):
+    """测试KV块不足时抢占序列（换出或重新prefill），所有请求仍得到正确结果"""
+    # tiny模型每个token的KV为 2层 × (k, v) × 32维 × 4字节 = 512字节，预算为10块
+    kv = PagedKVCache(block_size=4, max_bytes=10 * 4 * 512, swap_max_bytes=swap_max_bytes)
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=20, name="tiny", kv_cache=kv)
+    scheduler.start()
+    try:
+        prompts = [[2 + i, 10 + i, 20 + i, 30 + i, 40 + i, 50 + i] for i in range(4)]
+        results = await asyncio.gather(*[
+            scheduler.generate(prompt, 20, temperature=0) for prompt in prompts
+        ])
+        for prompt, result in zip(prompts, results):
+            assert result == reference_greedy(tiny_model, prompt, 20)
+
+        stats = scheduler.get_stats()
+        assert stats['preemptions'] > 0
+        if swap_max_bytes:
+            assert stats['swapped'] == stats['preemptions']
+        else:
+            assert stats['swapped'] == 0
+            assert stats['recomputed_tokens'] > 0
+        assert stats['kv_cache']['peak_used_blocks'] <= 10
+        assert stats['kv_cache']['used_blocks'] == 0
+
+        # 批次为空仍放不下的请求直接失败
+        with pytest.raises(KVCacheFullError):
+            await scheduler.generate(list(range(2, 50)), 4, temperature=0)
+    finally:
+        scheduler.stop()
@@ -0,0 +1,39 @@
+import pytest
+
+from core.length_predictor import OutputLengthPredictor
+
+
+def test_predicts_from_similar_prompts():
+    """测试按相似提示词、长度分桶和全局平均依次估计输出长度"""
+    predictor = OutputLengthPredictor(prefix_words=3, smoothing=0.5)
+    assert predictor.predict("Translate this sentence please", 256) == 256
+
+    predictor.record("Translate this sentence: hello", 256, 10, latency=0.1)
+    predictor.record("Write an essay about the history of computing", 256, 200, latency=2.0)
+
+    # 前缀相同的提示词使用各自的历史
+    assert predictor.predict("translate this sentence: good night", 256) == 10
+    assert predictor.predict("Write an essay about rivers and lakes", 256) == 200
+    # 不超过请求的最大生成长度
+    assert predictor.predict("Write an essay about rivers and lakes", 50) == 50
+    # 没有相似提示词时按长度分桶，再退回全局平均
+    assert predictor.predict("Summarize this text now", 256) == 10
+    assert predictor.predict("x " * 200, 256) == pytest.approx(105)
+
+    predictor.record("Translate this sentence: bye", 10, 20)
+    assert predictor.predict("translate this sentence: thanks", 256) == 15
+
+    stats = predictor.get_stats()
+    assert stats['observations'] == 3
+    assert stats['mean_abs_error'] == pytest.approx((246 + 56 + 10) / 3)
+    assert stats['p99_latency'] == 2.0
+    assert stats['prefix_hits'] == 4
+
+
+def test_history_is_bounded():
+    """测试相似提示词历史按LRU限制条目数"""
+    predictor = OutputLengthPredictor(history_size=2, prefix_words=1)
+    for word in ["a", "b", "c"]:
+        predictor.record(f"{word} prompt", 0, 5)
+    assert predictor.get_stats()['history_entries'] == 2
+
@@ -0,0 +1,167 @@
+import asyncio
+import copy
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+import torch
+import yaml
+from safetensors.torch import save_file
+
+from core.batch_scheduler import BatchScheduler
+from core.lora import LoRAAdapter, LoRAManager
+from core.model_manager import ModelManager
+
+TARGETS = {'attn.c_attn': (32, 96), 'mlp.c_fc': (32, 128)}
+
+
+def _save_adapter(path, seed, rank=4, alpha=8):
+    """按PEFT格式保存一个随机的tiny模型适配器"""
+    generator = torch.Generator().manual_seed(seed)
+    weights = {}
+    for layer in range(2):
+        for target, (fan_in, fan_out) in TARGETS.items():
+            prefix = f"base_model.model.transformer.h.{layer}.{target}"
+            weights[f"{prefix}.lora_A.weight"] = torch.randn(rank, fan_in, generator=generator) * 0.3
+            weights[f"{prefix}.lora_B.weight"] = torch.randn(fan_out, rank, generator=generator) * 0.3
+    path.mkdir(parents=True)
+    save_file(weights, str(path / 'adapter_model.safetensors'))
+    (path / 'adapter_config.json').write_text(json.dumps({
+        'r': rank,
+        'lora_alpha': alpha,
+        'target_modules': list(TARGETS),
+        'fan_in_fan_out': True
+    }))
+    return str(path)
+
+
+def _merged(model, path):
+    """把适配器合并进基座权重的副本，作为参照"""
+    merged = copy.deepcopy(model)
+    adapter = LoRAAdapter.load('ref', path, merged)
+    modules = dict(merged.named_modules())
+    with torch.no_grad():
+        for module_name, (lora_a, lora_b) in adapter.weights.items():
+            # GPT2的Conv1D权重为 [in, out]
+            modules[module_name].weight += adapter.scale * (lora_b @ lora_a).t()
+    return merged
+
+
+@pytest.fixture
+def adapters(temp_dir):
+    return {
+        'a': _save_adapter(temp_dir / 'a', seed=1),
+        'b': _save_adapter(temp_dir / 'b', seed=2)
+    }
+
+
+@pytest.mark.asyncio
+async def test_mixed_adapters_in_one_batch(tiny_model, adapters, reference_greedy):
+    """测试不同适配器与基座模型的请求在同一批次中解码，结果与合并权重后单独解码一致"""
+    lora = LoRAManager(tiny_model, adapters, max_loaded=2)
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=20, name="tiny", lora=lora)
+    scheduler.start()
+    try:
+        prompt = [2, 7, 11, 19, 23]
+        jobs = [(None, prompt), ('a', prompt), ('b', prompt), ('a', [5, 6, 7])]
+        results = await asyncio.gather(*[
+            scheduler.generate(ids, 10, temperature=0, adapter=adapter) for adapter, ids in jobs
+        ])
+        references = {None: tiny_model, 'a': _merged(tiny_model, adapters['a']), 'b': _merged(tiny_model, adapters['b'])}
+        for (adapter, ids), result in zip(jobs, results):
+            assert result == reference_greedy(references[adapter], ids, 10)
+        assert len({tuple(result) for result in results[:3]}) == 3
+
+        stats = scheduler.get_stats()['lora']
+        assert stats['mixed_forwards'] > 0
+        assert stats['in_use'] == {}
+        with pytest.raises(ValueError):
+            scheduler.submit(prompt, 4, adapter='missing')
+    finally:
+        scheduler.stop()
+        lora.close()
+
+
+@pytest.mark.asyncio
+async def test_adapter_lru_paging(tiny_model, adapters, reference_greedy):
+    """测试常驻槽位不足时请求等待适配器换出，适配器按LRU换入换出"""
+    lora = LoRAManager(tiny_model, adapters, max_loaded=1)
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=20, name="tiny", lora=lora)
+    scheduler.start()
+    try:
+        prompt = [3, 9, 27]
+        results = await asyncio.gather(*[
+            scheduler.generate(prompt, 8, temperature=0, adapter=adapter) for adapter in ('a', 'b', 'a')
+        ])
+        assert results[0] == results[2] == reference_greedy(_merged(tiny_model, adapters['a']), prompt, 8)
+        assert results[1] == reference_greedy(_merged(tiny_model, adapters['b']), prompt, 8)
+
+        stats = lora.get_stats()
+        assert stats['evictions'] >= 1
+        assert len(stats['resident']) == 1
+    finally:
+        scheduler.stop()
+        lora.close()
+    # 移除hook后恢复基座模型
+    assert reference_greedy(tiny_model, prompt, 8) == reference_greedy(copy.deepcopy(tiny_model), prompt, 8)
+
+
+@pytest.mark.asyncio
+async def test_adapter_loads_off_scheduler_thread(tiny_model, adapters, reference_greedy):
+    """测试冷适配器在后台加载，加载期间基座模型的请求照常解码；加载失败的请求以异常结束"""
+    load = LoRAAdapter.load
+
+    def slow_load(*args, **kwargs):
+        time.sleep(0.5)
+        return load(*args, **kwargs)
+
+    lora = LoRAManager(tiny_model, dict(adapters, broken=adapters['a'] + '-missing'), max_loaded=2)
+    scheduler = BatchScheduler(tiny_model, max_batch_size=8, max_wait_ms=0, name="tiny", lora=lora)
+    scheduler.start()
+    try:
+        prompt = [4, 8, 15, 16]
+        with patch('core.lora.LoRAAdapter.load', side_effect=slow_load):
+            adapted = asyncio.ensure_future(scheduler.generate(prompt, 8, temperature=0, adapter='a'))
+            await asyncio.sleep(0.05)
+            assert lora.get_stats()['loading'] == ['a']
+            base = await scheduler.generate(prompt, 8, temperature=0)
+            assert not adapted.done()
+            assert await adapted == reference_greedy(_merged(tiny_model, adapters['a']), prompt, 8)
+        assert base == reference_greedy(tiny_model, prompt, 8)
+        with pytest.raises(FileNotFoundError):
+            await scheduler.generate(prompt, 4, temperature=0, adapter='broken')
+        stats = lora.get_stats()
+        assert stats['loads'] == 1
+        assert stats['loading'] == []
+    finally:
+        scheduler.stop()
+        lora.close()
+
+
+@pytest.mark.asyncio
+async def test_manager_serves_adapters(tiny_config_path, tiny_model, tiny_tokenizer, adapters):
+    """测试在配置中声明适配器后可以作为模型名请求，共用同一份基座模型"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['models']['available'][0]['lora'] = {
+        'max_loaded': 2,
+        'adapters': [{'name': 'tiny-a', 'path': adapters['a']}, {'name': 'tiny-b', 'path': adapters['b']}]
+    }
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    assert manager.get_available_models() == ['tiny', 'tiny-a', 'tiny-b']
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model) as load, \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            responses = await asyncio.gather(*[
+                manager.generate(name, 'w2 w3 w4', max_length=16, temperature=0)
+                for name in ('tiny', 'tiny-a', 'tiny-b')
+            ])
+            assert load.call_count == 1
+            assert len(set(responses)) == 3
+            assert await manager.generate('tiny-a', 'w2 w3 w4', max_length=16, temperature=0) == responses[1]
+            lora_stats = manager.get_stats()['tiny']['replicas'][0]['scheduler']['lora']
+            assert sorted(lora_stats['resident']) == ['tiny-a', 'tiny-b']
+        finally:
+            manager.unload_model('tiny')
@@ -1,6 +1,9 @@
+import asyncio
 import pytest
+import yaml
 from unittest.mock import MagicMock, patch
-from core.model_manager import ModelManager
+from core.admission import ModelOverloadedError
+from core.model_manager import ModelManager, ModelState, IncrementalDetokenizer
 
 @pytest.fixture
 def model_manager(test_config):
@@ -92,4 +95,153 @@ def test_parallel_inference(model_manager):
     assert isinstance(responses, list)
     assert len(responses) == len(prompts)
     assert all(isinstance(r, str) for r in responses)
- 
\ No newline at end of file
+
+@pytest.fixture
+def tiny_manager(tiny_config_path, tiny_model, tiny_tokenizer):
+    """创建已加载tiny模型的模型管理器"""
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    yield manager
+    manager.unload_model('tiny')
+
+def test_incremental_detokenizer(tiny_tokenizer):
+    """测试增量解码的拼接结果与整体解码一致"""
+    token_ids = [3, 5, 0, 7, 9]
+    detokenizer = IncrementalDetokenizer(tiny_tokenizer)
+    text = "".join(detokenizer.push(token_id) for token_id in token_ids)
+    assert text == tiny_tokenizer.decode(token_ids, skip_special_tokens=True)
+
+@pytest.mark.asyncio
+async def test_generate_stream(tiny_manager):
+    """测试流式生成逐段返回文本"""
+    deltas = [
+        delta async for delta in tiny_manager.generate_stream(
+            'tiny', 'w2 w3 w4', max_length=20
+        )
+    ]
+    assert len(deltas) > 1
+    assert all(deltas)
+    assert len("".join(deltas).split()) <= 17
+
+@pytest.mark.asyncio
+async def test_generate_rejects_burst(tiny_manager):
+    """测试突发请求超出排队上限时快速拒绝，其余请求正常完成"""
+    admission = tiny_manager.admission['tiny']
+    admission.max_concurrency = 2
+    admission.max_queue_depth = 2
+    
+    results = await asyncio.gather(*[
+        tiny_manager.generate('tiny', 'w2 w3', max_length=30)
+        for _ in range(8)
+    ], return_exceptions=True)
+    
+    rejected = [r for r in results if isinstance(r, ModelOverloadedError)]
+    completed = [r for r in results if isinstance(r, str)]
+    assert len(rejected) == 4
+    assert len(completed) == 4
+    assert tiny_manager.get_queue_stats('tiny')['rejected'] == 4
+
+@pytest.mark.asyncio
+async def test_concurrent_cold_requests_load_once(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试冷模型的并发请求只触发一次加载，加载并预热后进入ready状态"""
+    manager = ModelManager(str(tiny_config_path))
+    assert manager.get_model_status()['tiny']['state'] == ModelState.COLD
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model) as load, \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            results = await asyncio.gather(*[
+                manager.generate('tiny', 'w2 w3 w4', max_length=20) for _ in range(4)
+            ])
+            assert all(isinstance(result, str) for result in results)
+            assert load.call_count == 1
+            assert manager.get_model_status()['tiny']['state'] == ModelState.READY
+            scheduler_stats = manager.get_replica_stats('tiny')[0]['scheduler']
+            assert scheduler_stats['completed'] == 5
+        finally:
+            manager.unload_model('tiny')
+    assert manager.get_model_status()['tiny']['state'] == ModelState.COLD
+
+@pytest.mark.asyncio
+async def test_failed_load_is_retried(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试加载失败时进入failed状态，下一个请求会重新加载"""
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=[OSError("boom"), tiny_model]), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            with pytest.raises(RuntimeError):
+                await manager.generate('tiny', 'w2 w3', max_length=20)
+            status = manager.get_model_status()['tiny']
+            assert status['state'] == ModelState.FAILED
+            assert 'boom' in status['error']
+            assert not manager.residency.is_resident('tiny')
+            
+            await manager.generate('tiny', 'w2 w3', max_length=20)
+            assert manager.get_model_status()['tiny']['state'] == ModelState.READY
+        finally:
+            manager.unload_model('tiny')
+
+@pytest.mark.asyncio
+async def test_deterministic_responses_are_cached(tiny_manager):
+    """测试确定性请求命中结果缓存，不再经过模型"""
+    first = await tiny_manager.generate('tiny', 'w2  w3 w4', max_length=20, temperature=0)
+    second = await tiny_manager.generate('tiny', ' w2 w3 w4 ', max_length=20, temperature=0)
+    assert second == first
+    assert tiny_manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 1
+
+    # 不同的采样参数、知识库上下文或采样请求不命中
+    await tiny_manager.generate('tiny', 'w2 w3 w4', max_length=24, temperature=0)
+    await tiny_manager.generate(
+        'tiny', 'w2 w3 w4', max_length=30, temperature=0,
+        use_knowledge=True, knowledge_context='w5 w6'
+    )
+    await tiny_manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0.7)
+    await tiny_manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0.7)
+    assert tiny_manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 5
+
+    stats = tiny_manager.get_response_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+    assert stats['entries'] == 3
+
+@pytest.mark.asyncio
+async def test_tenant_stats(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试按API密钥识别租户，并记录各租户与优先级的已服务token数"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['security'] = {'fair_queueing': {'tenants': [
+        {'name': 'batch-jobs', 'api_key': 'secret', 'weight': 2, 'default_priority': 'batch'}
+    ]}}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    manager = ModelManager(str(tiny_config_path))
+    assert manager.resolve_tenant('secret') == 'batch-jobs'
+    assert manager.resolve_tenant('unknown') == 'default'
+    assert manager.resolve_tenant(None) == 'default'
+    assert manager.admission['tiny'].tenant_weights == {'batch-jobs': 2}
+
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0.7, tenant='batch-jobs')
+            deltas = [
+                delta async for delta in manager.generate_stream(
+                    'tiny', 'w2 w3', max_length=10, temperature=0.7, priority='background'
+                )
+            ]
+        finally:
+            manager.unload_model('tiny')
+
+    stats = manager.get_queue_stats('tiny')
+    assert 3 < stats['tenants']['batch-jobs']['served_tokens'] <= 20
+    assert stats['priorities']['batch']['admitted'] == 1
+    assert 2 + len(deltas) <= stats['priorities']['background']['served_tokens'] <= 10
+
+@pytest.mark.asyncio
+async def test_manager_records_output_length(tiny_manager):
+    """测试生成完成后记录实际输出长度，下一次相似请求使用该历史"""
+    await tiny_manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0.7)
+    stats = tiny_manager.get_stats()['tiny']['output_length']
+    assert stats['observations'] == 1
+    assert stats['p50_latency'] > 0
+    assert tiny_manager.length_predictors['tiny'].predict('w2 w3 w4', 100) <= 17
+    assert tiny_manager.admission['tiny'].aging_rate == 20
@@ -0,0 +1,130 @@
+import os
+import signal
+import stat
+
+import pytest
+import yaml
+
+from core.model_manager import ModelManager
+from core.model_worker import WorkerUnavailableError, ensure_socket_dir, worker_authkey
+from core.weight_cache import WeightCache
+
+
+@pytest.fixture
+def worker_config_path(temp_dir, tiny_config_path, tiny_model, tiny_tokenizer):
+    """启用工作进程模式，并预先把小模型转换到权重缓存供工作进程加载"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['workers'] = {
+        'enabled': True,
+        'socket_dir': str(temp_dir / 'sock'),
+        'start_timeout': 60,
+        'restart_delay': 0.1,
+        'linger_seconds': 2
+    }
+    WeightCache(config['weight_cache']['cache_dir']).convert('tiny', tiny_model, tiny_tokenizer)
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    yield tiny_config_path
+
+
+@pytest.mark.asyncio
+async def test_generate_in_worker(worker_config_path):
+    """测试工作进程中的生成结果与进程内一致，多个API进程共享同一个工作进程"""
+    local = ModelManager(str(worker_config_path), out_of_process=False)
+    expected = await local.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+    local.unload_model('tiny')
+
+    manager = ModelManager(str(worker_config_path))
+    other = ModelManager(str(worker_config_path))
+    try:
+        usage = {}
+        assert await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0, usage=usage) == expected
+        # 工作进程中填写的usage随结果带回（级联路由依赖其中的置信度）
+        assert usage['served_tokens'] > 3
+        assert 0 < usage['confidence'] <= 1
+        usage = {}
+        chunks = [
+            delta async for delta in manager.generate_stream(
+                'tiny', 'w2 w3 w4', max_length=20, temperature=0, usage=usage
+            )
+        ]
+        assert "".join(chunks) == expected
+        assert usage['served_tokens'] > 3
+        assert await manager.count_tokens('tiny', 'w2 w3 w4') == 3
+
+        status = manager.get_model_status()['tiny']
+        assert status['state'] == 'ready'
+        assert status['worker']['pid'] != os.getpid()
+        assert manager.get_stats()['tiny']['queue']['admitted'] >= 2
+
+        # 另一个API进程连接到已在运行的工作进程，不会再次加载模型
+        assert await other.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0) == expected
+        assert other.workers['tiny'].pid == manager.workers['tiny'].pid
+        assert other.workers['tiny'].stats['spawned'] == 0
+    finally:
+        other.workers['tiny'].close()
+        manager.workers['tiny'].close(stop_worker=True)
+
+
+@pytest.mark.asyncio
+async def test_worker_restarts_after_crash(worker_config_path):
+    """测试工作进程崩溃时进行中的请求失败，之后自动重启并恢复服务"""
+    manager = ModelManager(str(worker_config_path))
+    worker = None
+    try:
+        await manager.ensure_loaded('tiny')
+        worker = manager.workers['tiny']
+        first_pid = worker.pid
+
+        deltas = manager.generate_stream('tiny', 'w2 w3 w4', max_length=200, temperature=0.7)
+        await deltas.__anext__()
+        os.kill(first_pid, signal.SIGKILL)
+        with pytest.raises(WorkerUnavailableError):
+            async for _ in deltas:
+                pass
+
+        assert await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+        assert worker.pid != first_pid
+        assert worker.stats['crashes'] == 1
+        assert worker.stats['restarts'] == 1
+    finally:
+        if worker is not None:
+            worker.close(stop_worker=True)
+
+
+def test_rejects_budget_that_needs_eviction(worker_config_path):
+    """测试工作进程模式下所有模型无法同时放入显存预算时拒绝启动（无法跨进程驱逐）"""
+    config = yaml.safe_load(worker_config_path.read_text(encoding='utf-8'))
+    base = config['models']['available'][0]
+    config['models']['available'] = [base, dict(base, name='tiny-a')]
+    config['gpu']['device_memory'] = 1.5
+    config['gpu']['memory_fraction'] = 1.0
+    worker_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    with pytest.raises(ValueError, match='GPU memory budget'):
+        ModelManager(str(worker_config_path))
+    # 进程内运行时仍按LRU驱逐
+    ModelManager(str(worker_config_path), out_of_process=False)
+
+
+def test_authkey_and_socket_dir_permissions(temp_dir):
+    """测试未配置密钥时生成随机的0600密钥文件，并拒绝使用权限不是0700的socket目录"""
+    socket_dir = str(temp_dir / 'sock')
+    key = worker_authkey(socket_dir)
+    assert len(key) == 32
+    assert worker_authkey(socket_dir) == key
+    assert stat.S_IMODE(os.stat(socket_dir).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(os.path.join(socket_dir, 'authkey')).st_mode) == 0o600
+    # 不同部署的密钥不同，不能由路径推算
+    assert worker_authkey(str(temp_dir / 'other')) != key
+    assert worker_authkey(socket_dir, 'secret') == b'secret'
+
+    os.chmod(socket_dir, 0o755)
+    with pytest.raises(PermissionError):
+        ensure_socket_dir(socket_dir)
+    with pytest.raises(PermissionError):
+        worker_authkey(socket_dir)
+
+    os.chmod(socket_dir, 0o700)
+    os.chmod(os.path.join(socket_dir, 'authkey'), 0o644)
+    with pytest.raises(PermissionError):
+        worker_authkey(socket_dir)
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import yaml
+
+from core.model_manager import ModelManager
+from core.ollama_backend import OllamaBackend
+
+
+class _StandInOllama(BaseHTTPRequestHandler):
+    """模拟Ollama的 /api/generate：回显提示词，流式时逐词返回"""
+
+    delay = 0.3
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消请求时连接已关闭
+            pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(body)
+        if not body.get('prompt'):
+            self._send_json({'model': body['model'], 'response': '', 'done': True})
+            return
+
+        time.sleep(self.delay)
+        words = [f"{word} " for word in body['prompt'].split()]
+        if not body.get('stream'):
+            self._send_json({'model': body['model'], 'response': "".join(words), 'done': True})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for word in words:
+            self.wfile.write((json.dumps({'response': word, 'done': False}) + "\n").encode())
+            self.wfile.flush()
+        self.wfile.write((json.dumps({'response': '', 'done': True}) + "\n").encode())
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ollama_server():
+    """在随机端口启动模拟Ollama服务"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInOllama)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def ollama_manager(tiny_config_path, ollama_server):
+    """创建连接模拟Ollama服务的模型管理器"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['models']['available'].extend([
+        {'name': 'stand-in', 'type': 'ollama', 'max_length': 64, 'temperature': 0.7, 'top_p': 0.9},
+        {'name': 'stand-in-pinned', 'type': 'ollama', 'pinned': True,
+         'max_length': 64, 'temperature': 0.7, 'top_p': 0.9}
+    ])
+    config['ollama'] = {
+        'host': f"http://127.0.0.1:{ollama_server.server_address[1]}",
+        'max_concurrency': 4,
+        'keep_alive': '10m'
+    }
+    config['loading'] = {'warmup_tokens': 0}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    return ModelManager(str(tiny_config_path))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_do_not_serialize(ollama_manager, ollama_server):
+    """测试同一模型的并发请求并行执行，而不是排队串行"""
+    start = time.monotonic()
+    results = await asyncio.gather(*[
+        ollama_manager.generate('stand-in', f'hello {i}') for i in range(4)
+    ])
+    elapsed = time.monotonic() - start
+
+    assert results == [f'hello {i} ' for i in range(4)]
+    assert elapsed < 3 * _StandInOllama.delay
+    await ollama_manager.ollama.close()
+
+
+@pytest.mark.asyncio
+async def test_streaming(ollama_manager):
+    """测试流式生成逐段返回"""
+    deltas = [delta async for delta in ollama_manager.generate_stream('stand-in', 'a b c')]
+    assert deltas == ['a ', 'b ', 'c ']
+    await ollama_manager.ollama.close()
+
+
+@pytest.mark.asyncio
+async def test_keep_alive(ollama_manager, ollama_server):
+    """测试请求携带各模型的keep_alive，卸载时通知Ollama立即释放"""
+    await ollama_manager.generate('stand-in', 'hi')
+    await ollama_manager.generate('stand-in-pinned', 'hi')
+    assert [(r['model'], r['keep_alive']) for r in ollama_server.requests] == [
+        ('stand-in', '10m'),
+        ('stand-in-pinned', -1)
+    ]
+
+    assert ollama_manager.unload_model('stand-in')
+    assert ollama_server.requests[-1] == {'model': 'stand-in', 'keep_alive': 0}
+    assert ollama_manager.get_model_status()['stand-in']['state'] == 'cold'
+    await ollama_manager.ollama.close()
+
+
+@pytest.mark.asyncio
+async def test_cancel_closes_request(ollama_manager):
+    """测试调用方取消时关闭Ollama请求并释放执行名额"""
+    task = asyncio.ensure_future(ollama_manager.generate('stand-in', 'slow request'))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    stream = ollama_manager.generate_stream('stand-in', 'a b c d')
+    assert await stream.__anext__() == 'a '
+    await stream.aclose()
+
+    assert ollama_manager.ollama.get_stats()['cancelled'] == 2
+    queue = ollama_manager.get_queue_stats('stand-in')
+    assert queue['cancelled'] == 2
+    assert queue['in_flight'] == 0
+    assert queue['tenants']['default']['served_tokens'] >= 1
+    await ollama_manager.ollama.close()
+
+
+@pytest.mark.asyncio
+async def test_http_pool_of_pinned_ollama_client(ollama_server):
+    """测试固定版本的ollama.AsyncClient内部持有httpx连接池，释放模型与关闭连接池依赖于此"""
+    backend = OllamaBackend(host=f"http://127.0.0.1:{ollama_server.server_address[1]}")
+    assert isinstance(backend._http, httpx.AsyncClient)
+    assert backend.release('stand-in')
+    assert ollama_server.requests[-1] == {'model': 'stand-in', 'keep_alive': 0}
+    http = backend._http
+    await backend.close()
+    assert http.is_closed
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from core.batch_scheduler import BatchScheduler
+from core.prefix_cache import PrefixCache
+
+
+def test_match_longest_cached_prefix():
+    """测试只匹配完整且连续的已缓存块"""
+    cache = PrefixCache(block_size=2, max_bytes=100)
+    cache.insert([1, 2, 3, 4, 5], lambda index: (f"block{index}", 10))
+    assert cache.get_stats()['blocks'] == 2
+
+    assert cache.match([1, 2, 3, 4, 9]) == ["block0", "block1"]
+    assert cache.match([1, 2, 3, 4], max_tokens=3) == ["block0"]
+    assert cache.match([1, 2, 9, 4]) == ["block0"]
+    assert cache.match([9, 2, 3, 4]) == []
+
+    stats = cache.get_stats()
+    assert stats['lookups'] == 4
+    assert stats['hits'] == 3
+    assert stats['tokens_saved'] == 8
+
+
+def test_insert_skips_cached_blocks():
+    """测试已缓存的块不会重复计算"""
+    cache = PrefixCache(block_size=2, max_bytes=100)
+    cache.insert([1, 2, 3, 4], lambda index: (index, 10))
+    computed = []
+    cache.insert([1, 2, 3, 4, 5, 6], lambda index: (computed.append(index) or index, 10))
+    assert computed == [2]
+    assert cache.used_bytes == 30
+
+
+def test_lru_eviction_under_memory_cap():
+    """测试超出内存上限时淘汰最久未使用的叶子块"""
+    cache = PrefixCache(block_size=2, max_bytes=30)
+    cache.insert([1, 2, 3, 4], lambda index: (f"a{index}", 10))
+    cache.insert([5, 6], lambda index: (f"b{index}", 10))
+    cache.match([1, 2, 3, 4])
+    cache.insert([7, 8], lambda index: (f"c{index}", 10))
+
+    assert cache.used_bytes <= 30
+    assert cache.match([5, 6]) == []
+    assert cache.match([1, 2, 3, 4]) == ["a0", "a1"]
+    assert cache.get_stats()['evicted_blocks'] == 1
+
+    # 父块比子块更晚淘汰
+    cache.insert([9, 10], lambda index: (f"d{index}", 10))
+    cache.insert([11, 12], lambda index: (f"e{index}", 10))
+    assert cache.match([1, 2, 3, 4]) == ["a0"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_reuses_shared_prefix(tiny_model, reference_greedy):
+    """测试共享前缀的请求复用KV缓存，输出与完整prefill一致"""
+    prefix_cache = PrefixCache(block_size=4, max_bytes=1 << 20)
+    scheduler = BatchScheduler(
+        tiny_model, max_batch_size=8, max_wait_ms=5, name="tiny", prefix_cache=prefix_cache
+    )
+    scheduler.start()
+    try:
+        shared = [(j * 5) % 60 + 2 for j in range(13)]
+        first = shared + [7, 8]
+        assert await scheduler.generate(first, 10, temperature=0) == reference_greedy(tiny_model, first, 10)
+        prefill_before = scheduler.get_stats()['prefill_tokens']
+
+        prompts = [shared + [9 + i, 20 + i, 30] for i in range(4)]
+        results = await asyncio.gather(*[
+            scheduler.generate(prompt, 10, temperature=0) for prompt in prompts
+        ])
+        for prompt, result in zip(prompts, results):
+            assert result == reference_greedy(tiny_model, prompt, 10)
+
+        stats = scheduler.get_stats()
+        assert stats['prefill_tokens'] - prefill_before == 4 * (len(prompts[0]) - 12)
+        assert stats['prefix_cache']['hits'] == 4
+        assert stats['prefix_cache']['tokens_saved'] == 4 * 12
+    finally:
+        scheduler.stop()
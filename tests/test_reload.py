@@ -0,0 +1,118 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import torch
+import yaml
+
+from core.model_manager import ModelManager
+
+
+@pytest.fixture
+def tiny_model_v2():
+    """与tiny_model结构相同、权重不同的新版本"""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(1)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2))
+    model.eval()
+    yield model
+
+
+def _expected(model, tokenizer, prompt, max_length):
+    """HF generate贪心解码的参照文本"""
+    input_ids = tokenizer(prompt)['input_ids']
+    with torch.no_grad():
+        output = model.generate(
+            torch.tensor([input_ids]),
+            max_new_tokens=max_length - len(input_ids),
+            do_sample=False,
+            pad_token_id=0
+        )
+    return tokenizer.decode(output[0, len(input_ids):], skip_special_tokens=True)
+
+
+def _write_config(path, **updates):
+    config = yaml.safe_load(path.read_text(encoding='utf-8'))
+    # 不量化，便于与HF generate的结果逐token比较
+    config['cpu'] = {'quantize': None}
+    for section, values in updates.items():
+        config[section].update(values)
+    path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+
+@pytest.mark.asyncio
+async def test_blue_green_reload(tiny_config_path, tiny_model, tiny_model_v2, tiny_tokenizer):
+    """测试蓝绿更新：进行中的请求在旧版本上完成，切换后的请求使用新版本，旧副本被释放"""
+    _write_config(tiny_config_path)
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=[tiny_model, tiny_model_v2]), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            before = await manager.generate('tiny', 'w2 w3 w4', max_length=16, temperature=0)
+            assert before == _expected(tiny_model, tiny_tokenizer, 'w2 w3 w4', 16)
+
+            old_replica = manager.models['tiny']['replicas'][0]
+            deltas = manager.generate_stream('tiny', 'w5 w6', max_length=60, temperature=0)
+            chunks = [await deltas.__anext__()]
+            reload_task = asyncio.ensure_future(manager.reload_model('tiny'))
+            chunks += [delta async for delta in deltas]
+            assert "".join(chunks) == _expected(tiny_model, tiny_tokenizer, 'w5 w6', 60)
+
+            progress = await reload_task
+            assert progress['mode'] == 'blue_green'
+            assert progress['phase'] == 'done'
+            assert progress['replaced'] == 1
+            assert old_replica.instance is None
+            assert manager.models['tiny']['replicas'][0] is not old_replica
+            assert manager.get_model_status()['tiny']['reload']['phase'] == 'done'
+            assert manager.residency.get_stats()['reserved'] == []
+
+            # 结果缓存中旧版本的响应已清除
+            after = await manager.generate('tiny', 'w2 w3 w4', max_length=16, temperature=0)
+            assert after == _expected(tiny_model_v2, tiny_tokenizer, 'w2 w3 w4', 16)
+            assert after != before
+
+            with pytest.raises(ValueError):
+                await manager.reload_model('unknown')
+        finally:
+            manager.unload_model('tiny')
+
+
+@pytest.mark.asyncio
+async def test_rolling_reload_without_headroom(tiny_config_path, tiny_model, tiny_model_v2, tiny_tokenizer):
+    """测试预算只够一份副本时逐个替换副本，更新期间的请求都成功"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['models']['available'][0]['replicas'] = 2
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+    _write_config(tiny_config_path, gpu={'devices': [0, 1], 'device_memory': 1.2})
+
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=[tiny_model, tiny_model_v2]), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        try:
+            await manager.ensure_loaded('tiny')
+            with pytest.raises(RuntimeError):
+                # 没有额外预算时不能蓝绿更新
+                await manager.reload_model('tiny', rolling=False)
+
+            reload_task = asyncio.ensure_future(manager.reload_model('tiny'))
+            expected = {
+                _expected(model, tiny_tokenizer, 'w7 w8', 24) for model in (tiny_model, tiny_model_v2)
+            }
+            while not reload_task.done():
+                # 更新期间至少有一个副本在服务，请求不会失败（接近贪心的采样请求不经过结果缓存）
+                response = await manager.generate('tiny', 'w7 w8', max_length=24, temperature=0.0001)
+                assert response in expected
+            progress = reload_task.result()
+            assert progress['mode'] == 'rolling'
+            assert progress['replaced'] == 2
+            assert len(progress['load_phases']) == 2
+            assert all(replica.is_loaded for replica in manager.models['tiny']['replicas'])
+
+            responses = await asyncio.gather(*[
+                manager.generate('tiny', 'w7 w8', max_length=24, temperature=0) for _ in range(4)
+            ])
+            assert set(responses) == {_expected(tiny_model_v2, tiny_tokenizer, 'w7 w8', 24)}
+        finally:
+            manager.unload_model('tiny')
@@ -0,0 +1,98 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import yaml
+
+from core.model_manager import ModelManager
+from core.replicas import ModelReplica, ReplicaRouter, plan_replica_devices
+
+
+def _loaded_replica(index, device=None, in_flight=0):
+    replica = ModelReplica("test", index, device)
+    replica.instance = object()
+    replica.in_flight = in_flight
+    return replica
+
+
+def test_plan_replica_devices():
+    """测试副本设备分配：显式设备、轮转分配与默认单副本"""
+    plan = plan_replica_devices(
+        [
+            {'name': 'a', 'replicas': 2},
+            {'name': 'b', 'replicas': 3},
+            {'name': 'c', 'devices': [1, 1]},
+            {'name': 'd'}
+        ],
+        [0, 1, 2, 3]
+    )
+    assert plan == {
+        'a': [0, 1],
+        'b': [2, 3, 0],
+        'c': [1, 1],
+        'd': [None]
+    }
+
+
+def test_least_loaded_routing():
+    """测试选择未完成请求最少的副本"""
+    replicas = [
+        _loaded_replica(0, 0, in_flight=3),
+        _loaded_replica(1, 1, in_flight=1),
+        _loaded_replica(2, 2, in_flight=2)
+    ]
+    assert ReplicaRouter().select(replicas).index == 1
+
+
+def test_skip_unloaded_replicas():
+    """测试跳过未加载的副本"""
+    replicas = [ModelReplica("test", 0, 0), _loaded_replica(1, 1, in_flight=5)]
+    assert ReplicaRouter().select(replicas).index == 1
+    with pytest.raises(RuntimeError):
+        ReplicaRouter().select([ModelReplica("test", 0, 0)])
+
+
+def test_most_free_memory_routing():
+    """测试按空闲显存选择副本，无法获取显存时退化为最少负载"""
+    replicas = [_loaded_replica(0, 0, in_flight=0), _loaded_replica(1, 1, in_flight=4)]
+    router = ReplicaRouter('most_free_memory')
+
+    with patch.object(ModelReplica, 'free_memory', side_effect=[1 << 30, 4 << 30]):
+        assert router.select(replicas).index == 1
+    assert router.select(replicas).index == 0
+
+
+def test_track_counts_in_flight():
+    """测试请求期间计入副本负载"""
+    replica = _loaded_replica(0)
+    with replica.track():
+        assert replica.in_flight == 1
+    assert replica.in_flight == 0
+    assert replica.served == 1
+
+
+@pytest.mark.asyncio
+async def test_requests_spread_across_replicas(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试并发请求被分配到多个副本"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['models']['available'][0]['replicas'] = 2
+    config['gpu']['devices'] = [0, 1]
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    try:
+        replicas = manager.models['tiny']['replicas']
+        assert [replica.device for replica in replicas] == [0, 1]
+        assert manager.admission['tiny'].max_concurrency == 16
+
+        await asyncio.gather(*[
+            manager.generate('tiny', 'w2 w3 w4', max_length=20) for _ in range(8)
+        ])
+        stats = manager.get_replica_stats('tiny')
+        assert [s['served'] for s in stats] == [4, 4]
+        assert all(s['scheduler']['completed'] == 4 for s in stats)
+    finally:
+        manager.unload_model('tiny')
@@ -0,0 +1,219 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import yaml
+
+from core.device_map import GiB, DevicePlan
+from core.model_manager import ModelManager
+from core.residency import ResidencyManager
+
+
+@pytest.fixture
+def residency():
+    """创建两张卡、每张20GB预算的常驻管理器"""
+    manager = ResidencyManager({0: 20, 1: 20})
+    manager.register('a', 16, [0])
+    manager.register('b', 16, [0])
+    manager.register('c', 16, [None])
+    manager.register('pinned', 16, [1], pinned=True)
+    return manager
+
+
+def test_load_within_budget(residency):
+    """测试预算足够时无需驱逐"""
+    assert residency.plan_load('a') == []
+    residency.mark_loaded('a')
+    assert residency.is_resident('a')
+    assert residency.get_stats()['devices'][0]['used'] == 16
+
+
+def test_evict_lru(residency):
+    """测试预算不足时驱逐最久未使用的模型"""
+    residency.mark_loaded('a')
+    assert residency.plan_load('b') == ['a']
+    residency.mark_unloaded('a', evicted=True)
+    residency.mark_loaded('b')
+    stats = residency.get_stats()
+    assert stats['evictions'] == 1
+    assert [e['event'] for e in residency.get_events()] == ['load', 'evict', 'load']
+
+
+def test_unpinned_replica_uses_free_device(residency):
+    """测试未固定设备的副本放在剩余预算最多的设备上"""
+    residency.mark_loaded('a')
+    assert residency.plan_load('c') == []
+    residency.mark_loaded('c')
+    assert residency.get_stats()['devices'][1]['used'] == 16
+
+
+def test_pinned_and_busy_not_evicted(residency):
+    """测试固定常驻和正在使用的模型不会被驱逐"""
+    residency.mark_loaded('pinned')
+    residency.mark_loaded('a')
+    # c 只能放到1号卡之外的0号卡，需驱逐a
+    assert residency.plan_load('c') == ['a']
+    assert residency.plan_load('c', busy={'a'}) is None
+
+
+def test_lru_order_follows_access(residency):
+    """测试访问会更新LRU顺序"""
+    manager = ResidencyManager({0: 40})
+    for name in ('a', 'b', 'c'):
+        manager.register(name, 16, [0])
+    manager.mark_loaded('a')
+    manager.mark_loaded('b')
+    manager.record_access('a')
+    assert manager.plan_load('c') == ['b']
+
+
+def test_hit_ratio(residency):
+    """测试命中率统计"""
+    residency.mark_loaded('a')
+    assert residency.record_access('a')
+    assert not residency.record_access('b')
+    assert residency.get_stats()['hit_ratio'] == 0.5
+
+
+def test_reserve_extra_copy(residency):
+    """测试热更新期间为第二份副本临时占用预算，放不下时拒绝"""
+    residency.mark_loaded('a')
+    assert not residency.reserve('reload', 'a', [0])
+    assert residency.reserve('reload', 'a', [None])
+    stats = residency.get_stats()
+    assert stats['devices'][1]['used'] == 16
+    assert stats['reserved'] == ['a']
+    # 临时占用计入预算，其他模型放不下
+    assert residency.plan_load('pinned') is None
+    residency.release('reload')
+    assert residency.get_stats()['devices'][1]['used'] == 0
+    assert residency.plan_load('pinned') == []
+
+
+def test_unpinned_replica_charges_planned_split(residency):
+    """测试按device_map切分到多张卡的未固定副本按规划的各设备占用记账"""
+    residency.mark_loaded('pinned')
+    # 不切分时整体放到剩余预算最多的0号卡
+    assert residency.plan_load('c') == []
+    residency.set_split('c', {0: 6, 1: 10})
+    # 1号卡只剩4GB，固定常驻的模型不能驱逐
+    assert residency.plan_load('c') is None
+    residency.mark_unloaded('pinned')
+    residency.mark_loaded('a')
+    assert residency.plan_load('c') == ['a']
+    residency.mark_unloaded('a', evicted=True)
+    residency.mark_loaded('c')
+    stats = residency.get_stats()
+    assert stats['devices'][0]['used'] == 6
+    assert stats['devices'][1]['used'] == 10
+
+
+def test_manager_charges_device_map_split(tiny_config_path):
+    """测试模型管理器把未固定副本的device_map规划登记到常驻预算"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    base = config['models']['available'][0]
+    config['models']['available'] = [dict(base, name='tiny'), dict(base, name='tiny-a')]
+    config['gpu'].update(devices=[0, 1], device_memory=2, memory_fraction=1.0)
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    plan = DevicePlan({}, {
+        0: {'capacity': 2 * GiB, 'weights': GiB // 4, 'kv_cache': GiB / 4, 'layers': [0], 'modules': []},
+        1: {'capacity': 2 * GiB, 'weights': GiB // 4, 'kv_cache': GiB / 4, 'layers': [1], 'modules': []}
+    })
+    with patch.object(manager, '_uses_planned_map', return_value=True), \
+            patch.object(manager, 'plan_device_map', return_value=plan):
+        assert manager._plan_residency('tiny-a')
+    manager.residency.mark_loaded('tiny-a')
+    devices = manager.get_residency_stats()['devices']
+    assert devices[0]['used'] == pytest.approx(0.5)
+    assert devices[1]['used'] == pytest.approx(0.5)
+
+
+@pytest.mark.asyncio
+async def test_cold_model_evicts_lru(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试请求冷模型时按需加载并驱逐其他模型"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    base = config['models']['available'][0]
+    config['models']['available'] = [
+        dict(base, name='tiny'),
+        dict(base, name='tiny-a'),
+        dict(base, name='tiny-b')
+    ]
+    config['gpu']['device_memory'] = 2
+    config['gpu']['memory_fraction'] = 1.0
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    manager.config['gpu']['devices'] = [0]
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        await manager.generate('tiny', 'w2 w3', max_length=10)
+        await manager.generate('tiny-a', 'w2 w3', max_length=10)
+        assert manager.is_loaded('tiny') and manager.is_loaded('tiny-a')
+
+        # 预算只够两个模型，默认模型tiny固定常驻，驱逐tiny-a
+        await manager.generate('tiny-b', 'w2 w3', max_length=10)
+        assert manager.is_loaded('tiny')
+        assert not manager.is_loaded('tiny-a')
+        assert manager.is_loaded('tiny-b')
+
+    stats = manager.get_residency_stats()
+    assert stats['evictions'] == 1
+    assert stats['misses'] == 3
+    for name in manager.models:
+        manager.unload_model(name)
+
+
+@pytest.mark.asyncio
+async def test_request_pins_model_until_dispatched(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试请求确保模型加载后、进入准入队列前，其他模型的加载不会驱逐该模型"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    base = config['models']['available'][0]
+    config['models']['available'] = [dict(base, name=name) for name in ('tiny', 'tiny-a', 'tiny-b')]
+    config['gpu']['device_memory'] = 2
+    config['gpu']['memory_fraction'] = 1.0
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    manager.config['gpu']['devices'] = [0]
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        await manager.ensure_loaded('tiny')
+        await manager.ensure_loaded('tiny-a')
+
+        # tiny-a的请求停在确保加载与进入准入队列之间
+        admit = manager._admit
+        entered, resume = asyncio.Event(), asyncio.Event()
+
+        def paused_admit(model_name, *args):
+            slot = admit(model_name, *args)
+
+            class Paused:
+                async def __aenter__(self):
+                    if model_name == 'tiny-a':
+                        entered.set()
+                        await resume.wait()
+                    return await slot.__aenter__()
+
+                async def __aexit__(self, *exc):
+                    return await slot.__aexit__(*exc)
+
+            return Paused()
+
+        manager._admit = paused_admit
+        request = asyncio.ensure_future(manager.generate('tiny-a', 'w2 w3', max_length=10))
+        await entered.wait()
+        # tiny为默认模型固定常驻，tiny-a被请求固定，tiny-b放不下
+        with pytest.raises(RuntimeError, match='GPU memory budget'):
+            await manager.ensure_loaded('tiny-b')
+        resume.set()
+        assert await request
+        assert manager._pins == {}
+
+        # 请求完成后tiny-a可被驱逐
+        await manager.ensure_loaded('tiny-b')
+        assert not manager.is_loaded('tiny-a')
+
+    for name in manager.models:
+        manager.unload_model(name)
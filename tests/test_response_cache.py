@@ -0,0 +1,35 @@
+from core.response_cache import ResponseCache
+
+
+def test_key_normalizes_prompt():
+    """测试只有空白差异的提示词得到相同的键"""
+    key = ResponseCache.make_key('m', 'hello  world', 64, 0, 0.9)
+    assert ResponseCache.make_key('m', ' hello world\n', 64, 0, 0.9) == key
+    assert ResponseCache.make_key('m', 'hello world', 64, 0, 0.8) != key
+    assert ResponseCache.make_key('other', 'hello world', 64, 0, 0.9) != key
+    assert ResponseCache.make_key('m', 'hello world', 64, 0, 0.9, 'context') != key
+
+
+def test_cacheable_requests():
+    """测试默认只缓存确定性请求"""
+    assert ResponseCache().is_cacheable(0)
+    assert not ResponseCache().is_cacheable(0.7)
+    assert ResponseCache(cache_sampled=True).is_cacheable(0.7)
+
+
+def test_byte_cap_evicts_lru():
+    """测试超出字节上限时淘汰最久未使用的响应"""
+    cache = ResponseCache(max_entries=10, max_bytes=10)
+    cache.set('a', 'aaaa')
+    cache.set('b', 'bbbb')
+    assert cache.get('a') == 'aaaa'
+    cache.set('c', 'cccc')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    stats = cache.get_stats()
+    assert stats['entries'] == 2
+    assert stats['used_bytes'] == 8
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
@@ -0,0 +1,148 @@
+import time
+
+import pytest
+import torch
+import yaml
+
+from core.semantic_cache import SemanticCache
+
+
+def _bag_of_words(texts):
+    """按词计数的简单嵌入函数，词序不同的提示词相似度为1"""
+    vocabulary = ['what', 'is', 'the', 'capital', 'of', 'france', 'weather', 'today']
+    return [[text.lower().split().count(word) for word in vocabulary] for text in texts]
+
+
+@pytest.fixture
+def cache():
+    return SemanticCache(_bag_of_words, threshold=0.9, max_entries=2, ttl=1)
+
+
+def test_paraphrase_hits(cache):
+    """测试相似提示词命中，不相似的提示词未命中"""
+    cache.store('m', 'what is the capital of france', 'Paris', cache.embed('what is the capital of france'))
+
+    prompt = 'the capital of france is what'
+    assert cache.lookup('m', prompt, cache.embed(prompt)) == 'Paris'
+    prompt = 'weather today'
+    assert cache.lookup('m', prompt, cache.embed(prompt)) is None
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert [event['event'] for event in cache.get_audit()] == ['hit', 'miss']
+    assert cache.get_audit()[0]['similarity'] == pytest.approx(1.0)
+
+
+def test_namespaces_are_isolated(cache):
+    """测试不同模型的缓存互不命中"""
+    embedding = cache.embed('weather today')
+    cache.store('a', 'weather today', 'sunny', embedding)
+    assert cache.lookup('b', 'weather today', embedding) is None
+    assert cache.lookup('a', 'weather today', embedding) == 'sunny'
+
+
+def test_max_entries_and_ttl(cache):
+    """测试条目数上限淘汰最久未命中的条目，过期条目不再命中"""
+    prompts = ['what is the capital of france', 'weather today', 'the the the']
+    for prompt in prompts:
+        cache.store('m', prompt, prompt.upper(), cache.embed(prompt))
+    assert cache.get_stats()['namespaces'] == {'m': 2}
+    assert cache.lookup('m', prompts[0], cache.embed(prompts[0])) is None
+
+    time.sleep(1.1)
+    assert cache.lookup('m', prompts[1], cache.embed(prompts[1])) is None
+    assert cache.get_stats()['namespaces'] == {'m': 0}
+
+
+
+def test_generation_params_must_match(cache):
+    """测试生成参数不同的条目不命中"""
+    embedding = cache.embed('weather today')
+    cache.store('m', 'weather today', 'sun', embedding, params=(16, 0, 0.9))
+    assert cache.lookup('m', 'today weather', embedding, params=(2048, 0, 0.9)) is None
+    assert cache.lookup('m', 'today weather', embedding, params=(16, 0, 0.5)) is None
+    assert cache.lookup('m', 'today weather', embedding, params=(16, 0, 0.9)) == 'sun'
+
+
+def test_mark_false_hit(cache):
+    """测试标记误命中后移除条目并计入统计"""
+    embedding = cache.embed('weather today')
+    cache.store('m', 'weather today', 'sunny', embedding)
+    cache.lookup('m', 'today weather', embedding)
+    event_id = cache.get_audit()[-1]['id']
+
+    assert cache.mark_false_hit(event_id)
+    assert not cache.mark_false_hit(event_id)
+    assert cache.get_audit()[-1]['event'] == 'false_hit'
+    assert cache.lookup('m', 'today weather', embedding) is None
+    assert cache.get_stats()['false_hits'] == 1
+
+
+@pytest.mark.asyncio
+async def test_manager_semantic_cache(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试模型管理器对释义相同的提示词返回缓存结果"""
+    from unittest.mock import patch
+    from core.model_manager import ModelManager
+
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['semantic_cache'] = {'enabled': True, 'threshold': 0.99}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    def embed(texts):
+        return [[text.split().count(f"w{i}") for i in range(2, 64)] for text in texts]
+
+    manager = ModelManager(str(tiny_config_path))
+    manager.attach_semantic_cache(embed)
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    try:
+        first = await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+        assert await manager.generate('tiny', 'w4 w3 w2', max_length=20, temperature=0) == first
+        await manager.generate('tiny', 'w5 w6', max_length=20, temperature=0)
+        assert manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 2
+        assert manager.get_response_cache_stats()['semantic']['hits'] == 1
+        # max_length不同的释义不命中max_length=20时生成的回答
+        await manager.generate('tiny', 'w4 w3 w2', max_length=30, temperature=0)
+        assert manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 3
+        assert manager.get_response_cache_stats()['semantic']['hits'] == 1
+    finally:
+        manager.unload_model('tiny')
+
+
+@pytest.mark.asyncio
+async def test_manager_skips_semantic_cache_with_knowledge_context(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试不同问题配上相同的知识库上下文时不互相命中语义缓存"""
+    from unittest.mock import patch
+    from core.model_manager import ModelManager
+
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['semantic_cache'] = {'enabled': True, 'threshold': 0.9}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    def embed(texts):
+        # 与嵌入模型一样截断输入：长上下文在前时只看得到上下文
+        return [[text.split()[:8].count(f"w{i}") for i in range(2, 64)] for text in texts]
+
+    manager = ModelManager(str(tiny_config_path))
+    manager.attach_semantic_cache(embed)
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model), \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    try:
+        context = " ".join(f"w{i}" for i in range(10, 22))
+        prompts = [manager._build_prompt(q, True, context) for q in ('w2 w3', 'w5 w6')]
+        # 完整提示词截断后的嵌入相同，若参与语义缓存会互相命中
+        assert torch.equal(manager.semantic_cache.embed(prompts[0]), manager.semantic_cache.embed(prompts[1]))
+
+        for question in ('w2 w3', 'w5 w6'):
+            await manager.generate(
+                'tiny', question, max_length=40, temperature=0, use_knowledge=True, knowledge_context=context
+            )
+        assert manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 2
+        stats = manager.get_response_cache_stats()['semantic']
+        assert stats['hits'] == 0
+        assert stats['stores'] == 0
+    finally:
+        manager.unload_model('tiny')
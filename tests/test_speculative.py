@@ -0,0 +1,128 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import torch
+import yaml
+
+from core.batch_scheduler import BatchScheduler
+from core.model_manager import ModelManager
+from core.speculative import SpeculativeScheduler
+
+
+@pytest.fixture
+def draft_model():
+    """与tiny_model词表相同、参数不同的草稿模型"""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(1)
+    model = GPT2LMHeadModel(GPT2Config(
+        vocab_size=64,
+        n_positions=256,
+        n_embd=16,
+        n_layer=1,
+        n_head=2
+    ))
+    model.eval()
+    return model
+
+
+async def _generate_all(scheduler, prompts, max_new_tokens):
+    scheduler.start()
+    try:
+        return await asyncio.gather(*[
+            scheduler.generate(prompt, max_new_tokens, temperature=0) for prompt in prompts
+        ])
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lookahead", [1, 3, 5])
+async def test_greedy_matches_target(tiny_model, draft_model, lookahead, reference_greedy):
+    """测试贪心解码时推测解码的输出与只用目标模型一致"""
+    prompts = [[(i * 11 + j) % 60 + 2 for j in range(5 + i)] for i in range(3)]
+    scheduler = SpeculativeScheduler(tiny_model, draft_model, lookahead=lookahead, name="tiny")
+    results = await _generate_all(scheduler, prompts, 20)
+
+    for prompt, result in zip(prompts, results):
+        assert result == reference_greedy(tiny_model, prompt, 20)
+    stats = scheduler.get_stats()
+    assert stats['completed'] == 3
+    assert stats['draft_tokens'] > 0
+
+
+@pytest.mark.asyncio
+async def test_identical_draft_accepts_everything(tiny_model, reference_greedy):
+    """测试草稿模型与目标模型相同时全部接受，每轮生成lookahead+1个token"""
+    scheduler = SpeculativeScheduler(tiny_model, tiny_model, lookahead=4, name="tiny")
+    prompt = [2, 3, 4, 5]
+    results = await _generate_all(scheduler, [prompt], 21)
+
+    assert results[0] == reference_greedy(tiny_model, prompt, 21)
+    stats = scheduler.get_stats()
+    assert stats['acceptance_rate'] == 1.0
+    assert stats['decode_steps'] == 4
+
+
+
+@pytest.mark.asyncio
+async def test_reports_target_logprobs(tiny_model, draft_model):
+    """测试推测解码按目标模型的分布报告输出token的平均对数概率（与逐个解码一致）及草稿/接受token数"""
+    prompt = [5, 9, 11, 13]
+    usages = []
+    for scheduler in (
+        SpeculativeScheduler(tiny_model, draft_model, lookahead=3, name="tiny"),
+        BatchScheduler(tiny_model, max_batch_size=1, max_wait_ms=0, name="tiny")
+    ):
+        usage = {}
+        scheduler.start()
+        try:
+            await scheduler.generate(prompt, 16, temperature=0, usage=usage)
+        finally:
+            scheduler.stop()
+        usages.append(usage)
+    assert usages[0]['mean_logprob'] < 0
+    assert usages[0]['mean_logprob'] == pytest.approx(usages[1]['mean_logprob'], abs=1e-4)
+    assert 0 < usages[0]['draft_tokens'] <= 15
+    assert 0 <= usages[0]['accepted_tokens'] <= usages[0]['draft_tokens']
+    assert 'draft_tokens' not in usages[1]
+
+def test_verify_preserves_target_distribution(tiny_model, draft_model):
+    """测试接受/拒绝规则产生的首个token分布等于目标分布"""
+    scheduler = SpeculativeScheduler(tiny_model, draft_model, name="tiny")
+    p = torch.tensor([0.5, 0.2, 0.2, 0.1])
+    q = torch.tensor([0.1, 0.6, 0.1, 0.2])
+    torch.manual_seed(0)
+    counts = torch.zeros(4)
+    trials = 20000
+    for _ in range(trials):
+        token = int(torch.multinomial(q, 1))
+        first = scheduler._verify([token], [q], torch.stack([p, p]))[0]
+        counts[first] += 1
+    assert torch.allclose(counts / trials, p, atol=0.015)
+
+
+@pytest.mark.asyncio
+async def test_manager_uses_draft_model(tiny_config_path, tiny_model, draft_model, tiny_tokenizer):
+    """测试配置draft_model时模型管理器使用推测解码"""
+    config = yaml.safe_load(tiny_config_path.read_text(encoding='utf-8'))
+    config['models']['available'][0]['draft_model'] = {'name': 'tiny-draft', 'lookahead': 3}
+    tiny_config_path.write_text(yaml.safe_dump(config), encoding='utf-8')
+
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', side_effect=[tiny_model, draft_model]) as load, \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer):
+        assert manager.load_model('tiny')
+    try:
+        assert load.call_args_list[1].args[0] == 'tiny-draft'
+        scheduler = manager.models['tiny']['replicas'][0].scheduler
+        assert isinstance(scheduler, SpeculativeScheduler)
+        assert scheduler.lookahead == 3
+        assert manager.admission['tiny'].max_concurrency == 1
+
+        response = await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+        assert response
+        assert manager.get_replica_stats('tiny')[0]['scheduler']['completed'] == 1
+    finally:
+        manager.unload_model('tiny')
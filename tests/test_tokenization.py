@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import pytest
+
+from core.model_manager import IncrementalDetokenizer
+from core.tokenization import TokenizerPool
+
+
+class _SlowTokenizer:
+    """每次批量调用额外耗时，用于检查事件循环不被阻塞"""
+
+    def __init__(self, tokenizer, delay: float):
+        self.tokenizer = tokenizer
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, texts):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.tokenizer(texts)
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return self.tokenizer.batch_decode(sequences, skip_special_tokens=skip_special_tokens)
+
+
+@pytest.fixture
+def pool(tiny_tokenizer):
+    pool = TokenizerPool(tiny_tokenizer, name="tiny", max_wait_ms=5)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_are_batched(pool, tiny_tokenizer):
+    """测试并发的编码与解码合批执行，结果与直接调用tokenizer一致"""
+    texts = [f"w{i} w{i + 1} w{i + 2}" for i in range(2, 40)]
+    results = await asyncio.gather(*[pool.encode(text) for text in texts])
+    assert results == [tiny_tokenizer(text)['input_ids'] for text in texts]
+
+    decoded = await pool.decode_batch(results)
+    assert decoded == texts
+
+    stats = pool.get_stats()
+    assert stats['encode_calls'] == len(texts)
+    assert stats['batches'] < 2 * len(texts)
+    assert stats['avg_batch_size'] > 1
+
+
+@pytest.mark.asyncio
+async def test_token_cache(pool):
+    """测试相同文本的编码结果与token数从缓存返回"""
+    context = " ".join(f"w{i}" for i in range(2, 60))
+    first = await pool.encode(context)
+    assert await pool.count_tokens(context) == len(first) == 58
+    # 返回副本，调用方修改不会影响缓存
+    first.append(0)
+    assert await pool.encode(context) == first[:-1]
+
+    stats = pool.get_stats()
+    assert stats['cache_hits'] == 2
+    assert stats['cache_misses'] == 1
+    assert stats['batches'] == 1
+    assert stats['cache_bytes'] == 8 * 58
+
+
+@pytest.mark.asyncio
+async def test_event_loop_not_blocked(tiny_tokenizer):
+    """测试分词在工作线程中执行，事件循环上的其他任务照常运行"""
+    tokenizer = _SlowTokenizer(tiny_tokenizer, delay=0.2)
+    pool = TokenizerPool(tokenizer, name="slow", max_wait_ms=5, cache_entries=0)
+    pool.start()
+    try:
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.gather(*[pool.encode(f"w{i} w3") for i in range(2, 10)])
+        task.cancel()
+        assert ticks >= 10
+        assert tokenizer.calls <= 2
+    finally:
+        pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_incremental_detokenizer_in_pool(pool, tiny_tokenizer):
+    """测试在线程池中增量解码的拼接结果与整体解码一致"""
+    token_ids = [3, 5, 0, 7, 9, 11]
+    detokenizer = IncrementalDetokenizer(tiny_tokenizer, pool)
+    deltas = [await detokenizer.apush(token_id) for token_id in token_ids]
+    assert "".join(deltas) == tiny_tokenizer.decode(token_ids, skip_special_tokens=True)
+    # 每次只解码最近的几个token
+    assert detokenizer.prefix_offset > 0
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_submitted_calls(tiny_tokenizer):
+    """测试停止前已提交的调用仍会完成，停止后的调用以异常结束"""
+    pool = TokenizerPool(_SlowTokenizer(tiny_tokenizer, delay=0.2), name="slow", cache_entries=0)
+    pool.start()
+    first = asyncio.ensure_future(pool.encode("w2"))
+    await asyncio.sleep(0.05)
+    pending = asyncio.ensure_future(pool.encode("w3"))
+    await asyncio.sleep(0)
+    await asyncio.get_running_loop().run_in_executor(None, pool.stop)
+    assert await first == [2]
+    assert await pending == [3]
+    with pytest.raises(RuntimeError):
+        await pool.encode("w4")
+
+
+@pytest.mark.asyncio
+async def test_stats_consistent_with_multiple_workers(tiny_tokenizer):
+    """测试多个工作线程并发合批时统计不丢失更新"""
+    pool = TokenizerPool(tiny_tokenizer, name="tiny", num_workers=4, max_batch_size=1, max_wait_ms=0)
+    pool.start()
+    try:
+        sequences = [[i % 60 + 2] for i in range(2000)]
+        await pool.decode_batch(sequences)
+    finally:
+        pool.stop()
+    stats = pool.get_stats()
+    assert stats['decode_calls'] == len(sequences)
+    assert stats['batches'] == stats['batched_jobs'] == len(sequences)
@@ -0,0 +1,65 @@
+import glob
+import os
+from unittest.mock import patch
+
+import pytest
+import torch
+
+from core.model_manager import ModelManager
+from core.weight_cache import WeightCache
+
+
+def test_convert_and_load(temp_dir, tiny_model, tiny_tokenizer):
+    """测试转换后从缓存加载的模型与原模型输出一致"""
+    cache = WeightCache(str(temp_dir / 'models'))
+    assert not cache.is_cached('org/tiny')
+    cache.convert('org/tiny', tiny_model, tiny_tokenizer)
+    assert cache.is_cached('org/tiny')
+    assert os.path.isdir(temp_dir / 'models' / 'org--tiny')
+
+    phases = {}
+    model = cache.load('org/tiny', 'cpu', phases)
+    assert type(model) is type(tiny_model)
+    assert set(phases) == {'read', 'materialize', 'move'}
+    assert model.lm_head.weight.data_ptr() == model.transformer.wte.weight.data_ptr()
+
+    input_ids = torch.tensor([[2, 3, 4, 5]])
+    with torch.no_grad():
+        assert torch.allclose(model(input_ids).logits, tiny_model(input_ids).logits)
+
+
+def test_interrupted_conversion_is_not_cached(temp_dir, tiny_model):
+    """测试转换失败时不会留下被认为完整的缓存"""
+    cache = WeightCache(str(temp_dir / 'models'))
+    with patch.object(type(tiny_model), 'save_pretrained', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            cache.convert('tiny', tiny_model)
+    assert not cache.is_cached('tiny')
+    assert glob.glob(cache.path('tiny') + '*') == []
+
+
+@pytest.mark.asyncio
+async def test_reload_uses_cache(tiny_config_path, tiny_model, tiny_tokenizer):
+    """测试首次加载转换到缓存，之后的加载直接从缓存读取并记录各阶段耗时"""
+    manager = ModelManager(str(tiny_config_path))
+    with patch('core.model_manager.AutoModel.from_pretrained', return_value=tiny_model) as load, \
+            patch('core.model_manager.AutoTokenizer.from_pretrained', return_value=tiny_tokenizer) as load_tokenizer:
+        try:
+            await manager.ensure_loaded('tiny')
+            phases = manager.get_model_status()['tiny']['load_phases']
+            assert phases['replicas'][0]['source'] == 'pretrained'
+            assert 'convert' in phases['replicas'][0]
+            assert 'warmup' in phases
+            first = await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0)
+
+            manager.unload_model('tiny')
+            manager.response_cache.clear()
+            await manager.ensure_loaded('tiny')
+            phases = manager.get_model_status()['tiny']['load_phases']
+            assert phases['replicas'][0]['source'] == 'cache'
+            assert {'read', 'materialize', 'move'} <= set(phases['replicas'][0])
+            assert load.call_count == 1
+            assert load_tokenizer.call_args.args[0] == manager.weight_cache.path('tiny')
+            assert await manager.generate('tiny', 'w2 w3 w4', max_length=20, temperature=0) == first
+        finally:
+            manager.unload_model('tiny')
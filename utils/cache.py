@@ -0,0 +1,107 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+
+class Cache:
+    """线程安全的LRU + TTL缓存
+
+    条目数超过max_size或估算大小超过max_bytes时淘汰最久未使用的条目；
+    ttl为滑动过期时间（秒），每次get命中都会重新计时，None表示不过期。
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: Optional[float] = 3600,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = sys.getsizeof
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.used_bytes = 0
+        # 键 -> (值, 过期时间, 字节数)，按最近使用顺序排列
+        self._data: "OrderedDict[Hashable, Tuple[Any, float, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """获取缓存值，命中时刷新过期时间"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at, size = entry
+            if self._expired(expires_at):
+                self._remove(key)
+                return default
+            self._data[key] = (value, self._expiry(), size)
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """写入缓存值，必要时按LRU淘汰"""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, self._expiry(), size)
+            self.used_bytes += size
+            while len(self._data) > self.max_size or (
+                self.max_bytes is not None and self.used_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key: Hashable):
+        """删除缓存值，键不存在时忽略"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.used_bytes = 0
+
+    def exists(self, key: Hashable) -> bool:
+        """判断键是否存在且未过期（不刷新过期时间）"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and not self._expired(entry[1])
+
+    def keys(self) -> List[Hashable]:
+        return [key for key, _ in self.items()]
+
+    def values(self) -> List[Any]:
+        return [value for _, value in self.items()]
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """获取所有未过期的条目，同时清理已过期的条目"""
+        with self._lock:
+            self._purge_expired()
+            return [(key, entry[0]) for key, entry in self._data.items()]
+
+    def size(self) -> int:
+        with self._lock:
+            self._purge_expired()
+            return len(self._data)
+
+    def _expiry(self) -> float:
+        return float('inf') if self.ttl is None else time.monotonic() + self.ttl
+
+    @staticmethod
+    def _expired(expires_at: float) -> bool:
+        return time.monotonic() >= expires_at
+
+    def _purge_expired(self):
+        for key in [key for key, entry in self._data.items() if self._expired(entry[1])]:
+            self._remove(key)
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._data.pop(key)
+        self.used_bytes -= size